@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+"""
+Upload and download analytics shared by the servers
+
+Raw upload rows are only kept for a retention window. Every upload and
+download also bumps hourly and daily rollups plus all-time totals per file
+type, in the same transaction, so statistics and time-series queries read
+a bounded number of rollup rows no matter how much history there is.
+
+Uploads are keyed by the stable file ID kept in each file's metadata, so a
+download updates exactly one row through a unique index.
+"""
+
+import os
+import sqlite3
+from datetime import datetime, timedelta
+from metrics import DB_SECONDS, timed
+
+RETENTION_DAYS = int(os.environ.get('ANALYTICS_RETENTION_DAYS', 30))
+HOURLY_RETENTION_DAYS = int(os.environ.get('ANALYTICS_HOURLY_RETENTION_DAYS', 90))
+MAX_BUCKETS = 5000
+
+HOUR_FORMAT = '%Y-%m-%d %H:00'
+DAY_FORMAT = '%Y-%m-%d'
+BUCKETS = {
+    # bucket: (rollup table, SQL expression of the bucket key, step)
+    'hour': ('rollup_hourly', 'bucket', timedelta(hours=1)),
+    'day': ('rollup_daily', 'bucket', timedelta(days=1)),
+    'month': ('rollup_daily', 'substr(bucket, 1, 7)', timedelta(days=30)),
+}
+DEFAULT_SPANS = {'hour': timedelta(hours=48), 'day': timedelta(days=30), 'month': timedelta(days=365)}
+
+def file_type_of(filename):
+    return os.path.splitext(filename)[1].lower() or 'unknown'
+
+class AnalyticsDB:
+    def __init__(self, db_path='analytics.db'):
+        self.db_path = db_path
+        self.init_db()
+
+    def connect(self):
+        # Worker processes share the database, wait for a busy lock instead of failing
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def init_db(self):
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS uploads (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                filename TEXT,
+                file_size INTEGER,
+                file_type TEXT,
+                upload_time TIMESTAMP,
+                ip_address TEXT,
+                compressed_size INTEGER,
+                download_count INTEGER DEFAULT 0,
+                is_compressed BOOLEAN DEFAULT 0,
+                file_id TEXT,
+                last_download TIMESTAMP
+            )
+        ''')
+        for table in ('rollup_hourly', 'rollup_daily'):
+            cursor.execute(f'''
+                CREATE TABLE IF NOT EXISTS {table} (
+                    bucket TEXT,
+                    file_type TEXT,
+                    uploads INTEGER DEFAULT 0,
+                    bytes INTEGER DEFAULT 0,
+                    compressed_bytes INTEGER DEFAULT 0,
+                    downloads INTEGER DEFAULT 0,
+                    PRIMARY KEY (bucket, file_type)
+                )
+            ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS rollup_totals (
+                file_type TEXT PRIMARY KEY,
+                uploads INTEGER DEFAULT 0,
+                bytes INTEGER DEFAULT 0,
+                compressed_bytes INTEGER DEFAULT 0,
+                downloads INTEGER DEFAULT 0
+            )
+        ''')
+        cursor.execute('CREATE TABLE IF NOT EXISTS analytics_meta (key TEXT PRIMARY KEY, value TEXT)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_uploads_time ON uploads (upload_time)')
+        conn.commit()
+
+        cursor.execute('BEGIN IMMEDIATE')
+        # Databases from before file IDs get the column, old rows keep a NULL ID
+        cursor.execute('PRAGMA table_info(uploads)')
+        columns = [column[1] for column in cursor.fetchall()]
+        if 'file_id' not in columns:
+            cursor.execute('ALTER TABLE uploads ADD COLUMN file_id TEXT')
+        # Likewise for download times, which the recompression worker reads
+        if 'last_download' not in columns:
+            cursor.execute('ALTER TABLE uploads ADD COLUMN last_download TIMESTAMP')
+        cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_uploads_file_id ON uploads (file_id)')
+
+        # Databases from before the rollups existed are folded in once
+        cursor.execute("SELECT 1 FROM analytics_meta WHERE key = 'rollups_backfilled'")
+        if cursor.fetchone() is None:
+            cursor.execute('''
+                SELECT upload_time, file_type, file_size, compressed_size, download_count FROM uploads
+            ''')
+            for upload_time, file_type, file_size, compressed_size, download_count in cursor.fetchall():
+                when = datetime.fromisoformat(str(upload_time))
+                self._bump(cursor, when, file_type or 'unknown', 1, file_size or 0, compressed_size or 0, download_count or 0)
+            cursor.execute("INSERT INTO analytics_meta (key, value) VALUES ('rollups_backfilled', ?)",
+                           (datetime.now().isoformat(),))
+        conn.commit()
+        conn.close()
+
+    def _bump(self, cursor, when, file_type, uploads, size, compressed, downloads):
+        """Add to the hourly, daily and total rollups of a file type"""
+        values = (file_type, uploads, size, compressed, downloads)
+        for table, fmt in (('rollup_hourly', HOUR_FORMAT), ('rollup_daily', DAY_FORMAT)):
+            cursor.execute(f'''
+                INSERT INTO {table} (bucket, file_type, uploads, bytes, compressed_bytes, downloads)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (bucket, file_type) DO UPDATE SET
+                    uploads = uploads + excluded.uploads,
+                    bytes = bytes + excluded.bytes,
+                    compressed_bytes = compressed_bytes + excluded.compressed_bytes,
+                    downloads = downloads + excluded.downloads
+            ''', (when.strftime(fmt),) + values)
+        cursor.execute('''
+            INSERT INTO rollup_totals (file_type, uploads, bytes, compressed_bytes, downloads)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (file_type) DO UPDATE SET
+                uploads = uploads + excluded.uploads,
+                bytes = bytes + excluded.bytes,
+                compressed_bytes = compressed_bytes + excluded.compressed_bytes,
+                downloads = downloads + excluded.downloads
+        ''', values)
+
+    def log_upload(self, file_id, filename, file_size, file_type, ip_address, compressed_size, is_compressed):
+        self.log_uploads([(file_id, filename, file_size, file_type, ip_address, compressed_size, is_compressed)])
+
+    @timed(DB_SECONDS, 'log_uploads')
+    def log_uploads(self, uploads):
+        """Log a batch of (file_id, filename, file_size, file_type, ip_address, compressed_size, is_compressed)
+        in one transaction"""
+        now = datetime.now()
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.executemany('''
+            INSERT INTO uploads (file_id, filename, file_size, file_type, upload_time, ip_address, compressed_size, is_compressed)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', [(file_id, filename, file_size, file_type, now, ip_address, compressed_size, is_compressed)
+              for file_id, filename, file_size, file_type, ip_address, compressed_size, is_compressed in uploads])
+        for file_id, filename, file_size, file_type, ip_address, compressed_size, is_compressed in uploads:
+            self._bump(cursor, now, file_type, 1, file_size, compressed_size, 0)
+        conn.commit()
+        conn.close()
+
+    @timed(DB_SECONDS, 'increment_download')
+    def increment_download(self, file_id, filename):
+        """Count a download of the upload with this file ID.
+
+        Files stored before file IDs existed have none, their downloads
+        only reach the rollups.
+        """
+        now = datetime.now()
+        conn = self.connect()
+        cursor = conn.cursor()
+        if file_id:
+            cursor.execute('UPDATE uploads SET download_count = download_count + 1, last_download = ? WHERE file_id = ?',
+                           (now, file_id))
+        self._bump(cursor, now, file_type_of(filename), 0, 0, 0, 1)
+        conn.commit()
+        conn.close()
+
+    @timed(DB_SECONDS, 'last_downloads')
+    def last_downloads(self, file_ids):
+        """{file ID: time of its last download} for the given IDs, files never downloaded are left out"""
+        file_ids = list(file_ids)
+        found = {}
+        conn = self.connect()
+        cursor = conn.cursor()
+        # In batches, SQLite limits the number of parameters
+        for start in range(0, len(file_ids), 500):
+            batch = file_ids[start:start + 500]
+            cursor.execute(f'''
+                SELECT file_id, last_download FROM uploads
+                WHERE last_download IS NOT NULL AND file_id IN ({','.join('?' * len(batch))})
+            ''', batch)
+            for file_id, last_download in cursor.fetchall():
+                found[file_id] = datetime.fromisoformat(str(last_download))
+        conn.close()
+        return found
+
+    @timed(DB_SECONDS, 'compact')
+    def compact(self, now=None):
+        """Drop raw rows and hourly rollups past their retention, the daily rollups keep the history"""
+        now = now or datetime.now()
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM uploads WHERE upload_time < ?', (now - timedelta(days=RETENTION_DAYS),))
+        removed = cursor.rowcount
+        cursor.execute('DELETE FROM rollup_hourly WHERE bucket < ?',
+                       ((now - timedelta(days=HOURLY_RETENTION_DAYS)).strftime(HOUR_FORMAT),))
+        conn.commit()
+        conn.close()
+        return removed
+
+    @timed(DB_SECONDS, 'get_stats')
+    def get_stats(self):
+        conn = self.connect()
+        cursor = conn.cursor()
+
+        # Total files and size
+        cursor.execute('SELECT SUM(uploads), SUM(bytes), SUM(compressed_bytes) FROM rollup_totals')
+        total_files, total_size, total_compressed = cursor.fetchone()
+
+        # Today's uploads
+        today = datetime.now().strftime(DAY_FORMAT)
+        cursor.execute('SELECT SUM(uploads) FROM rollup_daily WHERE bucket = ?', (today,))
+        today_uploads = cursor.fetchone()[0]
+
+        # Popular file types
+        cursor.execute('SELECT file_type, uploads FROM rollup_totals WHERE uploads > 0 ORDER BY uploads DESC LIMIT 5')
+        popular_types = cursor.fetchall()
+
+        conn.close()
+
+        return {
+            'total_files': total_files or 0,
+            'total_size': total_size or 0,
+            'total_compressed': total_compressed or 0,
+            'today_uploads': today_uploads or 0,
+            'popular_types': popular_types,
+            'compression_ratio': round((1 - (total_compressed or 1) / (total_size or 1)) * 100, 1) if total_size else 0
+        }
+
+    @timed(DB_SECONDS, 'query')
+    def query(self, start=None, end=None, bucket='day'):
+        """Time series of uploads, bytes and downloads between two ISO dates.
+
+        Raises ValueError for unknown buckets, unreadable dates or ranges
+        with more than MAX_BUCKETS buckets.
+        """
+        if bucket not in BUCKETS:
+            raise ValueError(f"bucket must be one of {', '.join(BUCKETS)}")
+        table, key, step = BUCKETS[bucket]
+        end = datetime.fromisoformat(end) if end else datetime.now()
+        start = datetime.fromisoformat(start) if start else end - DEFAULT_SPANS[bucket]
+        if start > end:
+            raise ValueError("from must not be after to")
+        if (end - start) / step > MAX_BUCKETS:
+            raise ValueError(f"Range too large for {bucket} buckets, use a coarser bucket")
+
+        fmt = HOUR_FORMAT if bucket == 'hour' else DAY_FORMAT
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            SELECT {key} AS period, file_type, SUM(uploads), SUM(bytes), SUM(compressed_bytes), SUM(downloads)
+            FROM {table}
+            WHERE bucket >= ? AND bucket <= ?
+            GROUP BY period, file_type
+            ORDER BY period
+        ''', (start.strftime(fmt), end.strftime(fmt)))
+        rows = cursor.fetchall()
+        conn.close()
+
+        series = []
+        for period, file_type, uploads, size, compressed, downloads in rows:
+            if not series or series[-1]['bucket'] != period:
+                series.append({'bucket': period, 'uploads': 0, 'bytes': 0, 'compressed_bytes': 0,
+                               'downloads': 0, 'by_type': {}})
+            point = series[-1]
+            point['uploads'] += uploads
+            point['bytes'] += size
+            point['compressed_bytes'] += compressed
+            point['downloads'] += downloads
+            point['by_type'][file_type] = {'uploads': uploads, 'bytes': size,
+                                           'compressed_bytes': compressed, 'downloads': downloads}
+
+        return {'bucket': bucket, 'from': start.isoformat(), 'to': end.isoformat(), 'series': series}
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+Egress bandwidth shaping for downloads
+
+Every download is a transfer with its own token bucket. Its rate is the
+smallest of the per-transfer limit, its client's per-IP limit split evenly
+across that client's open transfers, and the global limit split evenly
+across all open transfers. A bulk download therefore never takes more than
+its share, and small downloads running next to it finish at full share
+instead of waiting behind it.
+
+Limits are bytes per second, 0 means unlimited. They are per process.
+"""
+
+import os
+import time
+import threading
+
+SHAPE_CHUNK_SIZE = 64 * 1024
+BURST_SECONDS = 0.25
+
+def _env_rate(name):
+    try:
+        return max(0, int(os.environ.get(name, 0)))
+    except ValueError:
+        return 0
+
+class ShapedTransfer:
+    """Token bucket of one download"""
+
+    def __init__(self, manager, client_ip):
+        self.manager = manager
+        self.client_ip = client_ip
+        # Start with a full bucket, refills are capped at the burst size
+        self.tokens = float('inf')
+        self.updated = time.monotonic()
+        self.bytes_sent = 0
+
+    def throttle(self, amount, rate):
+        """Block until amount bytes may be sent at rate bytes per second"""
+        now = time.monotonic()
+        if rate:
+            burst = max(rate * BURST_SECONDS, SHAPE_CHUNK_SIZE)
+            self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+            self.tokens -= amount
+            if self.tokens < 0:
+                delay = -self.tokens / rate
+                self.manager.record_delay(delay)
+                time.sleep(delay)
+                # The sleep paid off the debt
+                self.tokens = 0.0
+                now += delay
+        self.updated = now
+        self.bytes_sent += amount
+        self.manager.record_sent(amount)
+
+class BandwidthManager:
+    """Shapes concurrent downloads to per-transfer, per-IP and global limits"""
+
+    def __init__(self, global_rate=None, per_ip_rate=None, per_transfer_rate=None):
+        self.global_rate = _env_rate('BANDWIDTH_GLOBAL') if global_rate is None else global_rate
+        self.per_ip_rate = _env_rate('BANDWIDTH_PER_IP') if per_ip_rate is None else per_ip_rate
+        self.per_transfer_rate = _env_rate('BANDWIDTH_PER_TRANSFER') if per_transfer_rate is None else per_transfer_rate
+        self._lock = threading.Lock()
+        self._active = 0
+        self._active_by_ip = {}
+        self.bytes_sent = 0
+        self.transfers = 0
+        self.throttled_seconds = 0.0
+
+    def configure(self, global_rate=None, per_ip_rate=None, per_transfer_rate=None):
+        """Change limits at runtime, open transfers pick them up on their next chunk"""
+        for value in (global_rate, per_ip_rate, per_transfer_rate):
+            if value is not None and (not isinstance(value, int) or isinstance(value, bool) or value < 0):
+                raise ValueError("Limits must be non-negative integers (bytes per second, 0 = unlimited)")
+        with self._lock:
+            if global_rate is not None:
+                self.global_rate = global_rate
+            if per_ip_rate is not None:
+                self.per_ip_rate = per_ip_rate
+            if per_transfer_rate is not None:
+                self.per_transfer_rate = per_transfer_rate
+
+    def open(self, client_ip):
+        with self._lock:
+            self._active += 1
+            self._active_by_ip[client_ip] = self._active_by_ip.get(client_ip, 0) + 1
+            self.transfers += 1
+        return ShapedTransfer(self, client_ip)
+
+    def close(self, transfer):
+        with self._lock:
+            self._active -= 1
+            remaining = self._active_by_ip[transfer.client_ip] - 1
+            if remaining:
+                self._active_by_ip[transfer.client_ip] = remaining
+            else:
+                del self._active_by_ip[transfer.client_ip]
+
+    def rate_for(self, transfer):
+        """Current fair share of a transfer in bytes per second, 0 when unlimited"""
+        with self._lock:
+            rates = []
+            if self.per_transfer_rate:
+                rates.append(self.per_transfer_rate)
+            if self.per_ip_rate:
+                rates.append(self.per_ip_rate / self._active_by_ip.get(transfer.client_ip, 1))
+            if self.global_rate:
+                rates.append(self.global_rate / max(self._active, 1))
+        return min(rates) if rates else 0
+
+    def record_sent(self, amount):
+        with self._lock:
+            self.bytes_sent += amount
+
+    def record_delay(self, delay):
+        with self._lock:
+            self.throttled_seconds += delay
+
+    def shape(self, client_ip, chunks):
+        """Yield chunks no faster than the limits allow, split into small slices"""
+        transfer = self.open(client_ip)
+        try:
+            for chunk in chunks:
+                rate = self.rate_for(transfer)
+                if not rate:
+                    # Unlimited, pass the chunk through whole
+                    transfer.throttle(len(chunk), 0)
+                    yield chunk
+                    continue
+                for offset in range(0, len(chunk), SHAPE_CHUNK_SIZE):
+                    piece = chunk[offset:offset + SHAPE_CHUNK_SIZE]
+                    transfer.throttle(len(piece), self.rate_for(transfer))
+                    yield piece
+        finally:
+            self.close(transfer)
+
+    def limits(self):
+        return {
+            'global_rate': self.global_rate,
+            'per_ip_rate': self.per_ip_rate,
+            'per_transfer_rate': self.per_transfer_rate
+        }
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                self.limits(),
+                active_transfers=self._active,
+                active_by_ip=dict(self._active_by_ip),
+                bytes_sent=self.bytes_sent,
+                transfers=self.transfers,
+                throttled_seconds=round(self.throttled_seconds, 3)
+            )
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+Small-file download latency while a bulk transfer streams
+
+Uploads a set of small files and one bulk file larger than the machine's
+memory, then measures small-file downloads on an idle server and while the
+bulk file is downloaded, once with the page cache hints for bulk I/O and
+once without (BULK_IO_MB set out of reach). Without hints the bulk stream
+pushes the small files out of the page cache and their downloads wait for
+the disk.
+
+Defaults to ultra_fast_server.py: the other servers keep small decoded files
+in their content cache, which hides what the page cache does.
+
+Usage:
+    python3 benchmarks/cache_pressure.py
+    python3 benchmarks/cache_pressure.py --bulk-size 4GB --small-files 500 --json report.json
+"""
+
+import os
+import sys
+import json
+import random
+import shutil
+import argparse
+import tempfile
+import subprocess
+import http.client
+from concurrent.futures import ProcessPoolExecutor
+from upload_scaling import ROOT, free_port, wait_for_server
+from load import SERVERS, parse_size, format_size, body_chunks, percentile, download_client
+
+HINTS_OFF_MB = str(1024 * 1024 * 1024)
+
+def memory_total():
+    with open('/proc/meminfo') as f:
+        for line in f:
+            if line.startswith('MemTotal:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+def start_server(server, workdir, port, hints):
+    env = dict(os.environ, PORT=str(port), PYTHONPATH=ROOT)
+    env.pop('BULK_IO_MB', None)
+    if not hints:
+        env['BULK_IO_MB'] = HINTS_OFF_MB
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, server)], cwd=workdir, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if not wait_for_server(port):
+        process.terminate()
+        raise RuntimeError(f"{server} did not start")
+    return process
+
+def upload(port, name, kind, size):
+    """PUT a generated file, returns its stored name"""
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=3600)
+    conn.request('PUT', f'/upload/{name}', body=body_chunks(kind, size), headers={'Content-Length': str(size)})
+    response = conn.getresponse()
+    payload = response.read()
+    conn.close()
+    if response.status != 200:
+        raise RuntimeError(f"upload of {name} failed with {response.status}")
+    return json.loads(payload)['filename']
+
+def small_latencies(port, names, rng, until):
+    """Download random small files until until() is true, returns seconds per download"""
+    latencies = []
+    while not until(len(latencies)):
+        latencies.append(download_client(port, [rng.choice(names)])[0][0])
+    return latencies
+
+def summary(latencies):
+    return {
+        'requests': len(latencies),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2)
+    }
+
+def run_mode(pool, server, workdir, small, bulk, hints, samples):
+    port = free_port()
+    process = start_server(server, workdir, port, hints)
+    try:
+        rng = random.Random(1)
+        # Twice, so the small files count as frequently used pages
+        download_client(port, small + small)
+        idle = small_latencies(port, small, rng, lambda count: count >= samples)
+
+        transfer = pool.submit(download_client, port, [bulk])
+        busy = small_latencies(port, small, rng, lambda count: count and transfer.done())
+        seconds, received = transfer.result()[0]
+    finally:
+        process.terminate()
+        process.wait()
+    return {
+        'hints': hints,
+        'idle': summary(idle),
+        'during_bulk': summary(busy),
+        'bulk_mb_per_second': round(received / seconds / 1024 ** 2, 2)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Small-file latency during a bulk download, with and without page cache hints')
+    parser.add_argument('--server', default='ultra_fast_server.py', choices=SERVERS)
+    parser.add_argument('--bulk-size', help='size of the bulk file (default: 1.5x the memory of this machine)')
+    parser.add_argument('--small-files', type=int, default=200)
+    parser.add_argument('--small-size', default='64KB')
+    parser.add_argument('--samples', type=int, default=500, help='small downloads on the idle server')
+    parser.add_argument('--json', help='write the report to this file')
+    args = parser.parse_args()
+
+    bulk_size = parse_size(args.bulk_size) if args.bulk_size else int(memory_total() * 1.5) // 1024 ** 2 * 1024 ** 2
+    small_size = parse_size(args.small_size)
+    workdir = tempfile.mkdtemp(prefix='btransfer-cache-')
+    print(f"🗄️ {args.server}: {args.small_files} x {format_size(small_size)} small files, "
+          f"bulk file of {format_size(bulk_size)}")
+    try:
+        port = free_port()
+        process = start_server(args.server, workdir, port, True)
+        try:
+            small = [upload(port, f'small_{index}.bin', 'random', small_size) for index in range(args.small_files)]
+            bulk = upload(port, 'bulk.bin', 'random', bulk_size)
+        finally:
+            process.terminate()
+            process.wait()
+
+        results = []
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            for hints in (False, True):
+                result = run_mode(pool, args.server, workdir, small, bulk, hints, args.samples)
+                results.append(result)
+                idle, busy = result['idle'], result['during_bulk']
+                print(f"  hints {'on ' if hints else 'off'}  idle p50 {idle['p50_ms']:7.2f} p99 {idle['p99_ms']:7.2f} ms  "
+                      f"during bulk p50 {busy['p50_ms']:7.2f} p99 {busy['p99_ms']:7.2f} ms ({busy['requests']} requests)  "
+                      f"bulk {result['bulk_mb_per_second']:8.2f} MB/s")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'server': args.server, 'bulk_size': bulk_size, 'small_size': small_size,
+                       'small_files': args.small_files, 'results': results}, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks of the codec hot paths of server.py
+
+Times should_compress_file, compress_file_data, decompress_file_data, Fernet
+encryption and decryption and the multipart splitting of uploads, over text,
+JSON, random binary and already compressed media at several sizes. Each case
+reports the time per call, MB/s and the peak memory allocated during one call
+(from tracemalloc), also as a multiple of the input size.
+
+Results are compared with a stored baseline and the run fails when a case
+got slower or allocates more than the tolerance allows. Baselines are
+machine specific, save one on the machine that checks against it.
+
+Usage:
+    python3 benchmarks/hot_paths.py --save          # store benchmarks/hot_paths_baseline.json
+    python3 benchmarks/hot_paths.py                 # compare against it, exit 1 on regressions
+    python3 benchmarks/hot_paths.py --sizes 4KB 64MB --tolerance 0.25 --json run.json
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tracemalloc
+from upload_scaling import ROOT, make_payload, multipart_body
+from load import parse_size, format_size
+
+sys.path.insert(0, ROOT)
+from cryptography.fernet import Fernet
+from multipart_stream import MultipartReader
+from server import should_compress_file, compress_file_data, decompress_file_data
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'hot_paths_baseline.json')
+
+# Corpus name: file name the server would see
+CORPORA = {'text': 'corpus.txt', 'json': 'corpus.json', 'binary': 'corpus.bin', 'media': 'corpus.mp4'}
+
+def make_corpus(kind, size):
+    rng = random.Random(f'{kind}{size}')
+    if kind == 'text':
+        return make_payload(size)
+    if kind == 'json':
+        records = []
+        length = 0
+        while length < size:
+            record = json.dumps({'id': len(records), 'name': f'user{rng.randint(0, 99999)}',
+                                 'score': round(rng.random() * 100, 3), 'tags': rng.sample(['a', 'b', 'c', 'd', 'e'], 2),
+                                 'active': rng.random() < 0.5})
+            records.append(record)
+            length += len(record) + 2
+        return ('[' + ',\n'.join(records) + ']').encode()[:size]
+    # Random bytes stand in for media, compressed formats look the same to zlib
+    return rng.randbytes(size)
+
+def measure(function, min_time, repeats=3):
+    """Seconds per call, best of repeats runs of at least min_time each"""
+    function()
+    best = None
+    for _ in range(repeats):
+        calls = 0
+        started = time.perf_counter()
+        while True:
+            function()
+            calls += 1
+            elapsed = time.perf_counter() - started
+            if elapsed >= min_time:
+                break
+        per_call = elapsed / calls
+        best = per_call if best is None else min(best, per_call)
+    return best
+
+def peak_allocated(function):
+    """Peak bytes allocated during one call"""
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        function()
+        return tracemalloc.get_traced_memory()[1] - before
+    finally:
+        tracemalloc.stop()
+
+def cases(sizes):
+    """(name, input bytes, function) of every case"""
+    fernet = Fernet(Fernet.generate_key())
+    yield 'should_compress_file', 0, lambda: should_compress_file('report.final.txt', 4096)
+    for size in sizes:
+        label = format_size(size)
+        for kind, filename in CORPORA.items():
+            data = make_corpus(kind, size)
+            yield f'compress/{kind}/{label}', size, lambda data=data, filename=filename: compress_file_data(data, filename)
+            payload, _, was_compressed = compress_file_data(data, filename)
+            if was_compressed:
+                yield (f'decompress/{kind}/{label}', size,
+                       lambda payload=payload, filename=filename: decompress_file_data(payload, filename, True))
+
+        data = make_corpus('binary', size)
+        token = fernet.encrypt(data)
+        yield f'encrypt/{label}', size, lambda data=data: fernet.encrypt(data)
+        yield f'decrypt/{label}', size, lambda token=token: fernet.decrypt(token)
+
+        body = multipart_body('corpus.bin', data, 'benchboundary')
+        def split(body=body):
+            for part in MultipartReader(io.BytesIO(body), 'benchboundary', len(body)):
+                part.drain()
+        yield f'multipart/{label}', size, split
+
+def run(sizes, min_time):
+    results = {}
+    for name, size, function in cases(sizes):
+        seconds = measure(function, min_time)
+        peak = peak_allocated(function)
+        results[name] = {
+            'us_per_call': round(seconds * 1e6, 2),
+            'mb_per_second': round(size / seconds / (1024 * 1024), 1) if size else None,
+            'alloc_peak_bytes': peak,
+            'alloc_ratio': round(peak / size, 2) if size else None
+        }
+        result = results[name]
+        throughput = f"{result['mb_per_second']:9.1f} MB/s" if size else ' ' * 14
+        ratio = f"x{result['alloc_ratio']:.2f}" if size else ''
+        print(f"  {name:28} {result['us_per_call']:12.2f} µs  {throughput}  "
+              f"alloc {result['alloc_peak_bytes']:>11,} B {ratio}")
+    return results
+
+def compare(results, baseline, tolerance):
+    """Regressions against a baseline: slower calls or bigger allocations beyond the tolerance"""
+    regressions = []
+    for name, result in results.items():
+        old = baseline.get(name)
+        if old is None:
+            continue
+        if result['us_per_call'] > old['us_per_call'] * (1 + tolerance):
+            regressions.append(f"{name}: {old['us_per_call']} -> {result['us_per_call']} µs per call")
+        # A few hundred bytes of bookkeeping are noise, not a regression
+        if result['alloc_peak_bytes'] > old['alloc_peak_bytes'] * (1 + tolerance) + 1024:
+            regressions.append(f"{name}: {old['alloc_peak_bytes']:,} -> {result['alloc_peak_bytes']:,} bytes allocated")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-benchmark compression, encryption and multipart parsing')
+    parser.add_argument('--sizes', nargs='+', default=['4KB', '256KB', '4MB'])
+    parser.add_argument('--min-time', type=float, default=0.2, help='seconds per timing run (default: 0.2)')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='baseline file to compare with or save to')
+    parser.add_argument('--save', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.15,
+                        help='relative slowdown or allocation growth that fails the run (default: 0.15)')
+    parser.add_argument('--json', help='write results to this file')
+    args = parser.parse_args()
+
+    print("🔬 Codec micro-benchmarks")
+    results = run([parse_size(size) for size in args.sizes], args.min_time)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"💾 Baseline saved to {args.baseline}")
+        return
+    if not os.path.exists(args.baseline):
+        print(f"ℹ️ No baseline at {args.baseline}, run with --save to store one")
+        return
+
+    with open(args.baseline) as f:
+        regressions = compare(results, json.load(f), args.tolerance)
+    if regressions:
+        print(f"❌ {len(regressions)} regressions beyond {args.tolerance:.0%}:")
+        for line in regressions:
+            print(f"  {line}")
+        sys.exit(1)
+    print(f"✅ Within {args.tolerance:.0%} of the baseline")
+
+if __name__ == '__main__':
+    main()
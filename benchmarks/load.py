@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+"""
+End-to-end load test of the three servers
+
+Every cell of the matrix (server x compression level x file size x
+compressibility x concurrency) gets a freshly started server in an empty
+directory. Clients in separate processes first upload their files over raw
+PUT, then download them all again. For each phase the report holds
+throughput, p50/p99 request latency and server CPU seconds per GB; peak RSS
+covers the whole cell. The upload phase also reports the stored size over
+the uploaded size and, from /metrics, the levels the server picked.
+
+--compression-levels runs the matrix with COMPRESSION_LEVEL set to each
+value, e.g. the adaptive controller against the old fixed level 6. Reports
+without the field count as level 6.
+
+Bodies are streamed from a repeated 1MB block, so even 2GB files do not
+have to fit in the client's memory. Reads the server's CPU time and memory
+from /proc, so it needs Linux.
+
+Usage:
+    python3 benchmarks/load.py --json report.json
+    python3 benchmarks/load.py --servers server.py --sizes 1MB 2GB --concurrency 1 --rounds 1
+    python3 benchmarks/load.py --json new.json --baseline report.json --tolerance 0.15
+    python3 benchmarks/load.py --servers server.py --compression-levels 6 auto --concurrency 1 4 8
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import shutil
+import platform
+import argparse
+import tempfile
+import itertools
+import subprocess
+import http.client
+from datetime import datetime
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+from upload_scaling import ROOT, free_port, wait_for_server, make_payload
+from upload_cpu import cpu_seconds
+
+SERVERS = ['server.py', 'simple_server.py', 'ultra_fast_server.py']
+KINDS = ['text', 'mixed', 'random']
+# Level of reports from before COMPRESSION_LEVEL existed
+DEFAULT_LEVEL = '6'
+BLOCK = 1024 * 1024
+MAX_ROUNDS = 200
+UNITS = {'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3}
+
+# Report fields compared against a baseline and whether higher is better
+COMPARED = {'mb_per_second': True, 'p50_ms': False, 'p99_ms': False, 'cpu_seconds_per_gb': False}
+
+def parse_size(text):
+    """Bytes of a size like 1KB, 16MB or 2GB"""
+    text = text.upper()
+    for unit, factor in UNITS.items():
+        if text.endswith(unit):
+            return int(float(text[:-len(unit)]) * factor)
+    return int(text)
+
+def format_size(size):
+    for unit, factor in reversed(UNITS.items()):
+        if size >= factor and size % factor == 0:
+            return f'{size // factor}{unit}'
+    return f'{size}B'
+
+@lru_cache(maxsize=None)
+def make_block(kind):
+    """1MB of text, random bytes or half of each"""
+    rng = random.Random(kind)
+    if kind == 'text':
+        return make_payload(BLOCK)
+    if kind == 'random':
+        return rng.randbytes(BLOCK)
+    return make_payload(BLOCK // 2) + rng.randbytes(BLOCK // 2)
+
+def body_chunks(kind, size):
+    block = make_block(kind)
+    remaining = size
+    while remaining > 0:
+        yield block[:remaining]
+        remaining -= len(block)
+
+def percentile(samples, fraction):
+    """Nearest-rank percentile"""
+    ordered = sorted(samples)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+def peak_rss(pid):
+    """Highest resident set size of a process so far, in bytes"""
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+def upload_client(port, kind, size, rounds, client_id):
+    """Upload rounds files, return [(seconds, stored name)]"""
+    results = []
+    for index in range(rounds):
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=600)
+        started = time.perf_counter()
+        conn.request('PUT', f'/upload/load_{client_id}_{index}.bin', body=body_chunks(kind, size),
+                     headers={'Content-Length': str(size)})
+        response = conn.getresponse()
+        payload = response.read()
+        elapsed = time.perf_counter() - started
+        conn.close()
+        if response.status != 200:
+            raise RuntimeError(f"upload failed with {response.status}")
+        results.append((elapsed, json.loads(payload)['filename']))
+    return results
+
+def download_client(port, names):
+    """Download files, return [(seconds, bytes)]"""
+    results = []
+    for name in names:
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=600)
+        started = time.perf_counter()
+        conn.request('GET', f'/download/{name}')
+        response = conn.getresponse()
+        received = 0
+        while True:
+            chunk = response.read(BLOCK)
+            if not chunk:
+                break
+            received += len(chunk)
+        elapsed = time.perf_counter() - started
+        conn.close()
+        if response.status != 200:
+            raise RuntimeError(f"download failed with {response.status}")
+        results.append((elapsed, received))
+    return results
+
+def phase_summary(latencies, total_bytes, elapsed, cpu):
+    return {
+        'requests': len(latencies),
+        'mb_per_second': round(total_bytes / elapsed / UNITS['MB'], 2),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 1),
+        'cpu_seconds_per_gb': round(cpu / (total_bytes / UNITS['GB']), 2)
+    }
+
+def stored_bytes(workdir):
+    """Bytes of stored files, without metadata and staged uploads"""
+    total = 0
+    for directory, dirs, files in os.walk(os.path.join(workdir, 'uploads')):
+        dirs[:] = [name for name in dirs if not name.startswith('.')]
+        total += sum(os.path.getsize(os.path.join(directory, name)) for name in files if not name.endswith('.meta'))
+    return total
+
+def chosen_levels(port):
+    """Uploads per compression level from the server's /metrics, empty if it has none"""
+    levels = {}
+    try:
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        conn.request('GET', '/metrics')
+        text = conn.getresponse().read().decode()
+        conn.close()
+    except (OSError, UnicodeDecodeError):
+        return levels
+    for line in text.splitlines():
+        if line.startswith('btransfer_compression_level_total{'):
+            labels, value = line.rsplit(' ', 1)
+            levels[labels.split('"')[1]] = int(float(value))
+    return levels
+
+def warm_client(kinds):
+    """Build the data blocks before any timing starts"""
+    for kind in kinds:
+        make_block(kind)
+
+def run_cell(pool, server, level, size, kind, concurrency, rounds):
+    workdir = tempfile.mkdtemp(prefix='btransfer-load-')
+    port = free_port()
+    env = dict(os.environ, PORT=str(port), PYTHONPATH=ROOT, COMPRESSION_LEVEL=level)
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, server)], cwd=workdir, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        if not wait_for_server(port):
+            raise RuntimeError(f"{server} did not start")
+        # Keys and databases are opened on first use, keep that out of the numbers
+        download_client(port, [name for _, name in upload_client(port, kind, 1024, 1, 'warmup')])
+        levels_before = chosen_levels(port)
+
+        cpu_before = cpu_seconds(process.pid)
+        started = time.perf_counter()
+        uploads = [future.result() for future in
+                   [pool.submit(upload_client, port, kind, size, rounds, i) for i in range(concurrency)]]
+        upload_elapsed = time.perf_counter() - started
+        upload_cpu = cpu_seconds(process.pid) - cpu_before
+        stored = stored_bytes(workdir)
+        levels = {label: count - levels_before.get(label, 0) for label, count in chosen_levels(port).items()}
+
+        cpu_before = cpu_seconds(process.pid)
+        started = time.perf_counter()
+        downloads = [future.result() for future in
+                     [pool.submit(download_client, port, [name for _, name in names]) for names in uploads]]
+        download_elapsed = time.perf_counter() - started
+        download_cpu = cpu_seconds(process.pid) - cpu_before
+
+        rss = peak_rss(process.pid)
+    finally:
+        process.terminate()
+        process.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    upload_latencies = [seconds for results in uploads for seconds, _ in results]
+    download_results = [result for results in downloads for result in results]
+    upload = phase_summary(upload_latencies, size * len(upload_latencies), upload_elapsed, upload_cpu)
+    upload['stored_ratio'] = round(stored / (size * len(upload_latencies)), 4)
+    upload['levels'] = {label: count for label, count in levels.items() if count}
+    return {
+        'server': server,
+        'compression': level,
+        'size': size,
+        'compressibility': kind,
+        'concurrency': concurrency,
+        'upload': upload,
+        'download': phase_summary([seconds for seconds, _ in download_results],
+                                  sum(received for _, received in download_results), download_elapsed, download_cpu),
+        'peak_rss_mb': round(rss / UNITS['MB'], 1)
+    }
+
+def cell_key(result):
+    return (result['server'], result.get('compression', DEFAULT_LEVEL), result['size'], result['compressibility'],
+            result['concurrency'])
+
+def compare(results, baseline, tolerance):
+    """Lines describing changes against a baseline report and the number of regressions"""
+    previous = {cell_key(result): result for result in baseline['results']}
+    lines = []
+    regressions = 0
+    for result in results:
+        old = previous.get(cell_key(result))
+        if old is None:
+            continue
+        fields = [(phase, name, higher_better) for phase in ('upload', 'download')
+                  for name, higher_better in COMPARED.items()]
+        fields.append(('upload', 'stored_ratio', False))
+        fields.append((None, 'peak_rss_mb', False))
+        for phase, name, higher_better in fields:
+            new_value = result[phase][name] if phase else result[name]
+            old_value = old[phase].get(name) if phase else old[name]
+            if not old_value:
+                continue
+            change = (new_value - old_value) / old_value
+            worse = -change if higher_better else change
+            if abs(change) <= tolerance:
+                continue
+            if worse > 0:
+                regressions += 1
+            label = (f"{result['server']} {result.get('compression', DEFAULT_LEVEL)} {format_size(result['size'])} "
+                     f"{result['compressibility']} x{result['concurrency']}")
+            lines.append(f"  {'❌' if worse > 0 else '✅'} {label:45} {phase + ' ' if phase else ''}{name}: "
+                         f"{old_value} -> {new_value} ({change:+.0%})")
+    return lines, regressions
+
+def compare_levels(results, reference):
+    """Lines comparing each compression level's cells with the same cells at the reference level"""
+    cells = {cell_key(result): result for result in results}
+    lines = []
+    for result in results:
+        level = result['compression']
+        if level == reference:
+            continue
+        base = cells.get((result['server'], reference) + cell_key(result)[2:])
+        if base is None:
+            continue
+        new, old = result['upload'], base['upload']
+        label = f"{result['server']} {format_size(result['size'])} {result['compressibility']} x{result['concurrency']}"
+        changes = ', '.join(f"{name} {old[name]} -> {new[name]}"
+                            for name in ('mb_per_second', 'p99_ms', 'cpu_seconds_per_gb', 'stored_ratio'))
+        lines.append(f"  {label:40} {level} vs {reference}: {changes}")
+    return lines
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the servers over a matrix of sizes, data and concurrency')
+    parser.add_argument('--servers', nargs='+', default=SERVERS, choices=SERVERS)
+    parser.add_argument('--compression-levels', nargs='+', default=['auto'],
+                        help='COMPRESSION_LEVEL values to run, auto or 0-9 (default: auto)')
+    parser.add_argument('--sizes', nargs='+', default=['1KB', '1MB', '16MB'], help='file sizes, 1KB up to 2GB')
+    parser.add_argument('--compressibility', nargs='+', default=['text', 'random'], choices=KINDS)
+    parser.add_argument('--concurrency', nargs='+', type=int, default=[1, 8])
+    parser.add_argument('--rounds', type=int, default=4, help='files per client, at least')
+    parser.add_argument('--min-cell-bytes', default='64MB',
+                        help=f'more rounds for small files, up to {MAX_ROUNDS}, so CPU time is measurable')
+    parser.add_argument('--max-cell-bytes', default='4GB',
+                        help='fewer rounds for big files, so a cell uploads at most this much')
+    parser.add_argument('--json', help='write the report to this file')
+    parser.add_argument('--baseline', help='compare against an earlier report')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='relative change that counts as a regression (default: 0.2)')
+    args = parser.parse_args()
+
+    sizes = [parse_size(size) for size in args.sizes]
+    minimum = parse_size(args.min_cell_bytes)
+    budget = parse_size(args.max_cell_bytes)
+    results = []
+    print(f"📈 Load test: {len(args.servers)} servers x {len(args.compression_levels)} compression levels x {len(sizes)} sizes x "
+          f"{len(args.compressibility)} data kinds x {len(args.concurrency)} concurrency levels")
+    clients = max(args.concurrency)
+    with ProcessPoolExecutor(max_workers=clients, initializer=warm_client, initargs=(args.compressibility,)) as pool:
+        # Start every client process up front
+        list(pool.map(time.sleep, [0.1] * clients))
+        for server, level, size, kind, concurrency in itertools.product(
+                args.servers, args.compression_levels, sizes, args.compressibility, args.concurrency):
+            cell = size * concurrency
+            rounds = max(args.rounds, min(MAX_ROUNDS, minimum // cell))
+            rounds = max(1, min(rounds, budget // cell))
+            result = run_cell(pool, server, level, size, kind, concurrency, rounds)
+            results.append(result)
+            up, down = result['upload'], result['download']
+            print(f"  {server:22} {level:>4} {format_size(size):>6} {kind:7} x{concurrency:<3} "
+                  f"up {up['mb_per_second']:8.2f} MB/s p50 {up['p50_ms']:8.1f} p99 {up['p99_ms']:8.1f} ms  "
+                  f"down {down['mb_per_second']:8.2f} MB/s p50 {down['p50_ms']:8.1f} p99 {down['p99_ms']:8.1f} ms  "
+                  f"CPU {up['cpu_seconds_per_gb']:6.2f}/{down['cpu_seconds_per_gb']:6.2f} s/GB  "
+                  f"stored {up['stored_ratio']:6.1%}  RSS {result['peak_rss_mb']:7.1f} MB")
+
+    if len(args.compression_levels) > 1:
+        reference = DEFAULT_LEVEL if DEFAULT_LEVEL in args.compression_levels else args.compression_levels[0]
+        print(f"🎚️ Uploads against COMPRESSION_LEVEL={reference}:")
+        print('\n'.join(compare_levels(results, reference)))
+
+    report = {
+        'meta': {
+            'date': datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'compression_levels': args.compression_levels,
+            'rounds': args.rounds
+        },
+        'results': results
+    }
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        lines, regressions = compare(results, baseline, args.tolerance)
+        print(f"🔍 Against {args.baseline} (tolerance {args.tolerance:.0%}):")
+        print('\n'.join(lines) if lines else "  no changes beyond the tolerance")
+        if regressions:
+            print(f"⚠️ {regressions} regressions")
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Import time and cold start time of the servers
+
+Each run uses a fresh empty directory, so the server has to create its key,
+database and upload folder like on a first start. Importing a server module
+should create nothing at all.
+
+Usage:
+    python3 benchmarks/startup.py --runs 10
+    python3 benchmarks/startup.py --servers server.py --suite
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+import subprocess
+import http.client
+from upload_scaling import ROOT, free_port
+
+SERVERS = ['server.py', 'simple_server.py', 'ultra_fast_server.py']
+
+IMPORT_SNIPPET = '''
+import time
+started = time.perf_counter()
+import {module}
+print(time.perf_counter() - started)
+'''
+
+def measure_import(server):
+    """Seconds to import a server module and the files the import created"""
+    workdir = tempfile.mkdtemp(prefix='btransfer-startup-')
+    try:
+        env = dict(os.environ, PYTHONPATH=ROOT)
+        output = subprocess.run([sys.executable, '-c', IMPORT_SNIPPET.format(module=server[:-3])],
+                                cwd=workdir, env=env, capture_output=True, text=True, check=True).stdout
+        return float(output.strip().splitlines()[-1]), sorted(os.listdir(workdir))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def measure_cold_start(server, timeout=30):
+    """Seconds from spawning a server until its first /health answer"""
+    workdir = tempfile.mkdtemp(prefix='btransfer-startup-')
+    port = free_port()
+    env = dict(os.environ, PORT=str(port), PYTHONPATH=ROOT)
+    started = time.perf_counter()
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, server)], cwd=workdir, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - started < timeout:
+            try:
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+                conn.request('GET', '/health')
+                conn.getresponse().read()
+                conn.close()
+                return time.perf_counter() - started
+            except OSError:
+                time.sleep(0.005)
+        raise RuntimeError(f"{server} did not start")
+    finally:
+        process.terminate()
+        process.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def measure_suite():
+    """Seconds to run test_server.py"""
+    started = time.perf_counter()
+    subprocess.run([sys.executable, os.path.join(ROOT, 'test_server.py')], cwd=ROOT,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - started
+
+def summary(samples):
+    return {
+        'median_ms': round(statistics.median(samples) * 1000, 1),
+        'min_ms': round(min(samples) * 1000, 1),
+        'max_ms': round(max(samples) * 1000, 1)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure import and cold start time of the servers')
+    parser.add_argument('--servers', nargs='+', default=SERVERS, choices=SERVERS)
+    parser.add_argument('--runs', type=int, default=10, help='runs per measurement')
+    parser.add_argument('--suite', action='store_true', help='also time a run of test_server.py')
+    parser.add_argument('--json', help='write results to this file')
+    args = parser.parse_args()
+
+    results = []
+    print(f"⏱️ Startup time: median of {args.runs} runs")
+    for server in args.servers:
+        imports = []
+        created = set()
+        for _ in range(args.runs):
+            seconds, files = measure_import(server)
+            imports.append(seconds)
+            created.update(files)
+        starts = [measure_cold_start(server) for _ in range(args.runs)]
+        result = {
+            'server': server,
+            'import': summary(imports),
+            'cold_start': summary(starts),
+            'import_created': sorted(created)
+        }
+        results.append(result)
+        print(f"  {server:22} import {result['import']['median_ms']:7.1f} ms  "
+              f"cold start {result['cold_start']['median_ms']:7.1f} ms  "
+              f"import created: {', '.join(result['import_created']) or 'nothing'}")
+
+    if args.suite:
+        suite = summary([measure_suite() for _ in range(args.runs)])
+        results.append({'test_suite': suite})
+        print(f"  {'test_server.py':22} {suite['median_ms']:7.1f} ms")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
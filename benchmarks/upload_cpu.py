@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Server CPU time per GB uploaded: multipart POST against raw PUT
+
+Reads the server's CPU time from /proc, so it needs Linux.
+
+Usage:
+    python3 benchmarks/upload_cpu.py --size 16777216 --count 8
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+import http.client
+from upload_scaling import ROOT, free_port, wait_for_server, make_payload, multipart_body
+
+SERVERS = ['server.py', 'simple_server.py', 'ultra_fast_server.py']
+MODES = ['multipart', 'put', 'put-chunked']
+
+def cpu_seconds(pid):
+    """User plus system CPU time of a process"""
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+def upload(port, mode, payload, index):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=300)
+    name = f'bench_{index}.bin'
+    if mode == 'multipart':
+        boundary = f'bench{index}'
+        conn.request('POST', '/upload', body=multipart_body(name, payload, boundary),
+                     headers={'Content-Type': f'multipart/form-data; boundary={boundary}'})
+    elif mode == 'put':
+        conn.request('PUT', f'/upload/{name}', body=payload)
+    else:
+        chunks = (payload[i:i + 1024 * 1024] for i in range(0, len(payload), 1024 * 1024))
+        conn.request('PUT', f'/upload/{name}', body=chunks, encode_chunked=True)
+    response = conn.getresponse()
+    response.read()
+    conn.close()
+    if response.status != 200:
+        raise RuntimeError(f"{mode} upload failed with {response.status}")
+
+def run(server, modes, payload, count):
+    workdir = tempfile.mkdtemp(prefix='btransfer-bench-')
+    port = free_port()
+    env = dict(os.environ, PORT=str(port), PYTHONPATH=ROOT)
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, server)], cwd=workdir, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    results = []
+    try:
+        if not wait_for_server(port):
+            raise RuntimeError(f"{server} did not start")
+        for mode in modes:
+            upload(port, mode, payload, 0)  # warm up
+            cpu_before = cpu_seconds(process.pid)
+            started = time.time()
+            for i in range(count):
+                upload(port, mode, payload, i + 1)
+            elapsed = time.time() - started
+            cpu = cpu_seconds(process.pid) - cpu_before
+            gigabytes = len(payload) * count / (1024 ** 3)
+            results.append({
+                'server': server,
+                'mode': mode,
+                'cpu_seconds_per_gb': round(cpu / gigabytes, 2),
+                'mb_per_second': round(len(payload) * count / elapsed / (1024 * 1024), 2)
+            })
+    finally:
+        process.terminate()
+        process.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare server CPU per GB for multipart and raw PUT uploads')
+    parser.add_argument('--servers', nargs='+', default=SERVERS, choices=SERVERS)
+    parser.add_argument('--modes', nargs='+', default=MODES, choices=MODES)
+    parser.add_argument('--size', type=int, default=16 * 1024 * 1024, help='upload size in bytes (default: 16MB)')
+    parser.add_argument('--count', type=int, default=8, help='uploads per mode')
+    parser.add_argument('--json', help='write results to this file')
+    args = parser.parse_args()
+
+    payload = make_payload(args.size)
+    results = []
+    print(f"📈 Upload CPU cost: {args.count} x {args.size // 1024} KB per mode")
+    for server in args.servers:
+        for result in run(server, args.modes, payload, args.count):
+            results.append(result)
+            print(f"  {server:22} {result['mode']:12} {result['cpu_seconds_per_gb']:8.2f} CPU s/GB  "
+                  f"{result['mb_per_second']:8.2f} MB/s")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
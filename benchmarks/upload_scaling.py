@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+Upload throughput of server.py as the number of worker processes grows
+
+Usage:
+    python3 benchmarks/upload_scaling.py --max-workers 4 --duration 10
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import socket
+import shutil
+import argparse
+import tempfile
+import subprocess
+import http.client
+from concurrent.futures import ProcessPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def free_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def wait_for_server(port, timeout=15):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=2)
+            conn.request('GET', '/health')
+            conn.getresponse().read()
+            conn.close()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+def start_server(workdir, port, workers):
+    env = dict(os.environ, PORT=str(port), PYTHONPATH=ROOT)
+    return subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, 'server.py'), '--workers', str(workers)],
+        cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+
+def make_payload(size):
+    """Text-like data so that compression does real work"""
+    rng = random.Random(size)
+    words = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(3, 10))) for _ in range(5000)]
+    out = []
+    total = 0
+    while total < size:
+        word = rng.choice(words)
+        out.append(word)
+        total += len(word) + 1
+    return ' '.join(out).encode()[:size]
+
+def multipart_body(filename, payload, boundary):
+    head = (
+        f'--{boundary}\r\n'
+        f'Content-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+        'Content-Type: application/octet-stream\r\n\r\n'
+    ).encode()
+    return head + payload + f'\r\n--{boundary}--\r\n'.encode()
+
+def client_loop(port, size, duration, client_id):
+    """Upload files back to back until the deadline, return (uploads, bytes)"""
+    payload = make_payload(size)
+    boundary = f'bench{client_id}'
+    body = multipart_body(f'bench_{client_id}.txt', payload, boundary)
+    headers = {'Content-Type': f'multipart/form-data; boundary={boundary}'}
+    uploads = 0
+    deadline = time.time() + duration
+    while time.time() < deadline:
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+        conn.request('POST', '/upload', body=body, headers=headers)
+        response = conn.getresponse()
+        response.read()
+        conn.close()
+        if response.status == 200:
+            uploads += 1
+    return uploads, uploads * size
+
+def run(workers, clients, size, duration):
+    workdir = tempfile.mkdtemp(prefix='btransfer-bench-')
+    port = free_port()
+    server = start_server(workdir, port, workers)
+    try:
+        if not wait_for_server(port):
+            raise RuntimeError(f"server with {workers} workers did not start")
+        # Clients run in separate processes so they are not GIL bound themselves
+        with ProcessPoolExecutor(max_workers=clients) as pool:
+            started = time.time()
+            futures = [pool.submit(client_loop, port, size, duration, i) for i in range(clients)]
+            results = [f.result() for f in futures]
+            elapsed = time.time() - started
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    uploads = sum(r[0] for r in results)
+    total_bytes = sum(r[1] for r in results)
+    return {
+        'workers': workers,
+        'clients': clients,
+        'uploads': uploads,
+        'seconds': round(elapsed, 2),
+        'mb_per_second': round(total_bytes / elapsed / (1024 * 1024), 2),
+        'uploads_per_second': round(uploads / elapsed, 2)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark upload throughput from 1 to N worker processes')
+    parser.add_argument('--max-workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--clients', type=int, default=0, help='concurrent upload clients (default: 2 x max workers)')
+    parser.add_argument('--size', type=int, default=4 * 1024 * 1024, help='upload size in bytes (default: 4MB)')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per measurement')
+    parser.add_argument('--json', help='write results to this file')
+    args = parser.parse_args()
+
+    clients = args.clients or 2 * args.max_workers
+    results = []
+    print(f"📈 Upload scaling: {args.size // 1024} KB files, {clients} clients, {args.duration}s per run")
+    for workers in range(1, args.max_workers + 1):
+        result = run(workers, clients, args.size, args.duration)
+        results.append(result)
+        speedup = result['mb_per_second'] / results[0]['mb_per_second'] if results[0]['mb_per_second'] else 0
+        print(f"  {workers} worker(s): {result['mb_per_second']:8.2f} MB/s  "
+              f"{result['uploads_per_second']:7.2f} uploads/s  x{speedup:.2f}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Change feed of the file list
+
+Uploads, deletes and expiries are appended to an events table with
+increasing sequence numbers. Clients load /files once, remember the sequence
+it was taken at and then only receive the events after it, over server-sent
+events or long polling. The table lives in SQLite so every worker process
+sees every event; waiters in the publishing process wake up at once, others
+within POLL_SECONDS.
+"""
+
+import json
+import time
+import sqlite3
+import threading
+from metrics import DB_SECONDS, timed
+
+RETENTION_SECONDS = 24 * 3600
+MAX_EVENTS = 10000
+POLL_SECONDS = 1.0
+BATCH_LIMIT = 500
+
+class ChangeFeed:
+    def __init__(self, db_path='analytics.db'):
+        self.db_path = db_path
+        self._cond = threading.Condition()
+        self.init_db()
+
+    def connect(self):
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def init_db(self):
+        conn = self.connect()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS file_events (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                type TEXT,
+                name TEXT,
+                file TEXT,
+                time REAL
+            )
+        ''')
+        conn.commit()
+        conn.close()
+
+    def publish(self, kind, name, file=None):
+        return self.publish_many([(kind, name, file)])
+
+    @timed(DB_SECONDS, 'events_publish')
+    def publish_many(self, events):
+        """Append (type, name, file entry or None) events in one transaction, returns the last sequence"""
+        if not events:
+            return self.latest()
+        now = time.time()
+        conn = self.connect()
+        cursor = conn.cursor()
+        for kind, name, file in events:
+            cursor.execute('INSERT INTO file_events (type, name, file, time) VALUES (?, ?, ?, ?)',
+                           (kind, name, json.dumps(file) if file is not None else None, now))
+        seq = cursor.lastrowid
+        conn.commit()
+        conn.close()
+        with self._cond:
+            self._cond.notify_all()
+        return seq
+
+    def latest(self, cursor=None):
+        """Sequence number of the newest event, 0 before the first one"""
+        if cursor is None:
+            conn = self.connect()
+            try:
+                return self.latest(conn.cursor())
+            finally:
+                conn.close()
+        # sqlite_sequence remembers the last number even after trimming
+        cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'file_events'")
+        row = cursor.fetchone()
+        return row[0] if row else 0
+
+    @timed(DB_SECONDS, 'events_read')
+    def since(self, seq, limit=BATCH_LIMIT):
+        """Events after seq as (events, reset).
+
+        reset is True when the events right after seq have been trimmed, or
+        seq is from another database, and the client has to reload /files.
+        """
+        conn = self.connect()
+        cursor = conn.cursor()
+        try:
+            latest = self.latest(cursor)
+            if seq > latest:
+                return [], True
+            if seq == latest:
+                return [], False
+            cursor.execute('SELECT MIN(seq) FROM file_events')
+            oldest = cursor.fetchone()[0]
+            if oldest is None or seq < oldest - 1:
+                return [], True
+            cursor.execute('SELECT seq, type, name, file, time FROM file_events WHERE seq > ? ORDER BY seq LIMIT ?',
+                           (seq, limit))
+            rows = cursor.fetchall()
+        finally:
+            conn.close()
+        return [{'seq': row_seq, 'type': kind, 'name': name,
+                 'file': json.loads(file) if file else None, 'time': when}
+                for row_seq, kind, name, file, when in rows], False
+
+    def wait(self, seq, timeout):
+        """Like since(), but block up to timeout seconds for the first event"""
+        deadline = time.monotonic() + timeout
+        while True:
+            events, reset = self.since(seq)
+            remaining = deadline - time.monotonic()
+            if events or reset or remaining <= 0:
+                return events, reset
+            with self._cond:
+                self._cond.wait(min(remaining, POLL_SECONDS))
+
+    @timed(DB_SECONDS, 'events_trim')
+    def trim(self, now=None):
+        """Drop events past their retention or beyond MAX_EVENTS, returns the number removed"""
+        now = now or time.time()
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM file_events WHERE time < ? OR seq <= ?',
+                       (now - RETENTION_SECONDS, self.latest(cursor) - MAX_EVENTS))
+        removed = cursor.rowcount
+        conn.commit()
+        conn.close()
+        return removed
+
+def sse_message(event):
+    """Server-sent event frame of one change"""
+    return f"id: {event['seq']}\nevent: {event['type']}\ndata: {json.dumps(event)}\n\n".encode()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Upload checksums and download validators
+
+SHA-256 and CRC32 are updated chunk by chunk while an upload is read, so the
+digest is ready as soon as the last byte has arrived.
+"""
+
+import re
+import zlib
+import base64
+import binascii
+import hashlib
+
+_DIGEST_RE = re.compile(r'([\w-]+)\s*=\s*(:[^:]*:|[^,\s]*)')
+
+class StreamDigest:
+    """SHA-256 plus a fast CRC32 of a byte stream"""
+
+    def __init__(self):
+        self.sha256 = hashlib.sha256()
+        self.crc32 = 0
+        self.size = 0
+
+    def update(self, chunk):
+        self.sha256.update(chunk)
+        self.crc32 = zlib.crc32(chunk, self.crc32)
+        self.size += len(chunk)
+
+    def read(self, chunks):
+        """Collect chunks into one payload, hashing them on the way"""
+        parts = []
+        for chunk in chunks:
+            self.update(chunk)
+            parts.append(chunk)
+        return b''.join(parts)
+
+    def checksums(self):
+        return {'sha256': self.sha256.hexdigest(), 'crc32': f'{self.crc32:08x}'}
+
+def expected_sha256(headers):
+    """SHA-256 a client announced for its upload, as lowercase hex, or None.
+
+    Understands Content-Digest (sha-256=:base64:), the older Digest
+    (SHA-256=base64) and a plain hex X-Content-SHA256.
+    """
+    value = headers.get('x-content-sha256')
+    if value:
+        return value.strip().lower()
+
+    for name in ('content-digest', 'digest'):
+        value = headers.get(name)
+        if not value:
+            continue
+        for algorithm, encoded in _DIGEST_RE.findall(value):
+            if algorithm.lower() != 'sha-256':
+                continue
+            try:
+                return base64.b64decode(encoded.strip(':'), validate=True).hex()
+            except (binascii.Error, ValueError):
+                # Unreadable digests never match
+                return encoded
+    return None
+
+def content_digest(sha256_hex):
+    """Content-Digest header value for a hex SHA-256"""
+    return f"sha-256=:{base64.b64encode(bytes.fromhex(sha256_hex)).decode()}:"
+
+def etag_for(metadata):
+    """Strong ETag of a stored file, None for files uploaded without a checksum"""
+    sha256 = metadata.get('sha256')
+    return f'"{sha256}"' if sha256 else None
+
+def etag_matches(if_none_match, etag):
+    """Weak comparison of an If-None-Match header against an ETag"""
+    if not if_none_match or not etag:
+        return False
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag == '*' or tag.removeprefix('W/') == etag:
+            return True
+    return False
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""
+Adaptive gzip level for uploads
+
+With COMPRESSION_LEVEL=auto (the default) every upload gets a level picked
+from how busy the server is and what earlier uploads of the same file type
+cost and gained:
+
+- pressure is the higher of CPU utilization (this process, or the load
+  average per core) and queue depth (transfers in flight plus processing
+  jobs, per QUEUE_PER_CORE per core), from 0 to 1
+- a level is fast enough when its measured speed for the file type is at
+  least COMPRESS_MIN_SPEED_MB / (1 - pressure) MB/s, so an idle server can
+  afford slow levels and a busy one only fast ones
+- of the fast enough levels the strongest is used, unless it shrinks files
+  of that type by less than MIN_GAIN over the next faster one
+- file types that barely compress, and every type once pressure reaches
+  STORE_PRESSURE, are stored as is; every EXPLORE_EVERY-th upload of a type
+  uses a faster level instead so its numbers stay current
+
+Each decision is printed and counted in btransfer_compression_level_total.
+A number 0-9 in COMPRESSION_LEVEL fixes the level, 0 stores everything.
+"""
+
+import os
+import time
+import threading
+from collections import OrderedDict
+from metrics import COMPRESSION_LEVELS, transfers_in_flight
+
+def _fixed_level(value):
+    try:
+        return max(0, min(9, int(value)))
+    except ValueError:
+        return None  # auto
+
+# None lets the controller choose
+COMPRESSION_LEVEL = _fixed_level(os.environ.get('COMPRESSION_LEVEL', 'auto'))
+COMPRESS_MIN_SPEED_MB = float(os.environ.get('COMPRESS_MIN_SPEED_MB', 20))
+
+LEVELS = (9, 6, 3, 1)
+# MB/s assumed for a level before it has been measured on a file type
+PRIOR_SPEEDS = {9: 25, 6: 35, 3: 55, 1: 65}
+MIN_GAIN = 0.02
+POOR_RATIO = 0.9
+STORE_PRESSURE = 0.9
+# Text still worth compressing when saturated
+SATURATED_RATIO = 0.7
+QUEUE_PER_CORE = 2
+EXPLORE_EVERY = 16
+# Speeds of smaller files are mostly call overhead
+MIN_SPEED_SAMPLE = 64 * 1024
+SMOOTHING = 0.2
+MAX_TYPES = 256
+CPU_SAMPLE_SECONDS = 0.5
+
+def file_type(filename):
+    return os.path.splitext(filename)[1].lower() or '(none)'
+
+def level_label(level):
+    return str(level) if level else 'store'
+
+class LevelController:
+    """Measured gzip speed and ratio per file type and the level choice built on them"""
+
+    def __init__(self, min_speed=COMPRESS_MIN_SPEED_MB * 1024 * 1024, cpus=None):
+        self.min_speed = min_speed
+        self.cpus = cpus or os.cpu_count() or 1
+        self._lock = threading.Lock()
+        # file type -> {'uploads': n, level: [speed, ratio]}, least recently used first
+        self._types = OrderedDict()
+        self._cpu_sample = (time.monotonic(), time.process_time())
+        self._cpu = 0.0
+
+    def cpu_utilization(self):
+        """Busiest of this process's CPU share and the load average per core, 0 to 1"""
+        with self._lock:
+            now, cpu_time = time.monotonic(), time.process_time()
+            elapsed = now - self._cpu_sample[0]
+            if elapsed >= CPU_SAMPLE_SECONDS:
+                self._cpu = (cpu_time - self._cpu_sample[1]) / elapsed / self.cpus
+                self._cpu_sample = (now, cpu_time)
+            utilization = self._cpu
+        try:
+            utilization = max(utilization, os.getloadavg()[0] / self.cpus)
+        except (AttributeError, OSError):
+            pass
+        return min(1.0, utilization)
+
+    def pressure(self, queued=0):
+        """(pressure, cpu, queue depth) for the next upload, queued counts processing jobs"""
+        cpu = self.cpu_utilization()
+        # Everything but the upload asking, which is in flight or a processing job itself
+        depth = max(0, transfers_in_flight() + queued - 1)
+        return max(cpu, min(1.0, depth / (QUEUE_PER_CORE * self.cpus))), cpu, depth
+
+    def _measured(self, kind):
+        with self._lock:
+            stats = self._types.get(kind)
+            if stats is None:
+                stats = self._types[kind] = {'uploads': 0}
+                while len(self._types) > MAX_TYPES:
+                    self._types.popitem(last=False)
+            else:
+                self._types.move_to_end(kind)
+            stats['uploads'] += 1
+            return stats['uploads'], {level: tuple(stats[level]) for level in LEVELS if level in stats}
+
+    def decide(self, filename, queued=0):
+        """(level, reason, pressure, cpu, depth) for an upload, level 0 stores it"""
+        pressure, cpu, depth = self.pressure(queued)
+        uploads, measured = self._measured(file_type(filename))
+        ratios = [ratio for _, ratio in measured.values() if ratio is not None]
+        explore = uploads % EXPLORE_EVERY == 0
+
+        if ratios and min(ratios) >= POOR_RATIO:
+            if explore:
+                return 1, 'remeasuring a type that barely compresses', pressure, cpu, depth
+            return 0, f'type compresses to {min(ratios):.0%}', pressure, cpu, depth
+        if pressure >= STORE_PRESSURE:
+            if ratios and min(ratios) <= SATURATED_RATIO:
+                return 1, 'saturated, type compresses well', pressure, cpu, depth
+            return 0, 'saturated', pressure, cpu, depth
+
+        required = self.min_speed / (1 - pressure)
+        fast_enough = [level for level in LEVELS
+                       if (measured.get(level, (None,))[0] or PRIOR_SPEEDS[level] * 1024 * 1024) >= required]
+        if not fast_enough:
+            return 1, f'needs {required / 1024 / 1024:.0f} MB/s', pressure, cpu, depth
+        chosen = fast_enough[0]
+        for faster in fast_enough[1:]:
+            ratio = measured.get(chosen, (None, None))[1]
+            faster_ratio = measured.get(faster, (None, None))[1]
+            if ratio is None or faster_ratio is None or faster_ratio - ratio >= MIN_GAIN:
+                break
+            chosen = faster
+        reason = f'needs {required / 1024 / 1024:.0f} MB/s'
+        if explore and chosen != fast_enough[-1]:
+            chosen = fast_enough[fast_enough.index(chosen) + 1]
+            reason += ', exploring a faster level'
+        return chosen, reason, pressure, cpu, depth
+
+    def choose(self, filename, queued=0):
+        """Level for an upload, logged and counted"""
+        level, reason, pressure, cpu, depth = self.decide(filename, queued)
+        COMPRESSION_LEVELS.labels(level_label(level)).inc()
+        print(f"🗜️ Compression level {level_label(level)} for {filename}: "
+              f"pressure {pressure:.0%} (CPU {cpu:.0%}, queue {depth}), {reason}")
+        return level
+
+    def record(self, filename, level, size, compressed_size, seconds):
+        """Fold one compression into the numbers of its file type"""
+        if not level or not size:
+            return
+        speed = size / seconds if size >= MIN_SPEED_SAMPLE and seconds > 0 else None
+        ratio = compressed_size / size
+        with self._lock:
+            stats = self._types.get(file_type(filename))
+            if stats is None:
+                return
+            old_speed, old_ratio = stats.get(level, (None, None))
+            if speed is not None and old_speed is not None:
+                speed = old_speed + SMOOTHING * (speed - old_speed)
+            if old_ratio is not None:
+                ratio = old_ratio + SMOOTHING * (ratio - old_ratio)
+            stats[level] = [speed if speed is not None else old_speed, ratio]
+
+    def stats(self):
+        with self._lock:
+            return {'file_types': len(self._types), 'cpu_utilization': round(self._cpu, 3)}
+
+CONTROLLER = LevelController()
+
+def choose_level(filename, queued=0):
+    return CONTROLLER.choose(filename, queued)
+
+def record_compression(filename, level, size, compressed_size, seconds):
+    CONTROLLER.record(filename, level, size, compressed_size, seconds)
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+In-process cache of decrypted and decompressed file payloads
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+# Defaults can be overridden through the environment
+DEFAULT_CACHE_BYTES = int(os.environ.get('CACHE_MAX_BYTES', 256 * 1024 * 1024))  # 256MB
+DEFAULT_CACHE_ITEM_BYTES = int(os.environ.get('CACHE_MAX_ITEM_BYTES', 16 * 1024 * 1024))  # 16MB
+
+class ContentCache:
+    """Size-aware LRU cache of decoded payloads keyed by (file id, version).
+
+    The version comes from the storage backend's stat() and changes whenever
+    the stored file is rewritten.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES, max_item_bytes=DEFAULT_CACHE_ITEM_BYTES):
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_item_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bypasses = 0
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, file_id, version):
+        """Return cached payload or None"""
+        key = (file_id, version)
+        with self._lock:
+            data = self._entries.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, file_id, version, data):
+        """Store payload unless it is larger than the per-item threshold"""
+        size = len(data)
+        if size > self.max_item_bytes or size > self.max_bytes:
+            with self._lock:
+                self.bypasses += 1
+            return False
+
+        key = (file_id, version)
+        with self._lock:
+            # Drop any other version of the same file first
+            self._remove_file(file_id)
+            self._entries[key] = data
+            self.current_bytes += size
+            self._versions[file_id] = version
+
+            # Evict least recently used entries until we fit the budget
+            while self.current_bytes > self.max_bytes and self._entries:
+                (evicted_id, _), evicted = self._entries.popitem(last=False)
+                del self._versions[evicted_id]
+                self.current_bytes -= len(evicted)
+                self.evictions += 1
+        return True
+
+    def invalidate(self, file_id):
+        """Remove every cached version of a file (delete / expiry)"""
+        with self._lock:
+            return self._remove_file(file_id)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._versions.clear()
+            self.current_bytes = 0
+
+    def _remove_file(self, file_id):
+        if file_id not in self._versions:
+            return False
+        version = self._versions.pop(file_id)
+        self.current_bytes -= len(self._entries.pop((file_id, version)))
+        return True
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'current_bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'max_item_bytes': self.max_item_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'bypasses': self.bypasses,
+                'hit_ratio': round(self.hits / lookups * 100, 1) if lookups else 0
+            }
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+class SingleFlight:
+    """Coalesce concurrent calls for the same key into a single execution"""
+
+    def __init__(self):
+        self.executions = 0
+        self.coalesced = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        """Run fn() once per key, callers arriving meanwhile share its result"""
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self._flights[key] = flight
+                self.executions += 1
+            else:
+                flight.waiters += 1
+                self.coalesced += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = fn()
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            # Later callers go through the content cache instead
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'decode_executions': self.executions,
+                'decode_coalesced': self.coalesced,
+                'decodes_in_flight': len(self._flights)
+            }
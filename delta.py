@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+"""
+rsync-style delta uploads of new versions of stored files
+
+The server describes a stored file with a signature: its block size, size
+and SHA-256, then for every block a rolling Adler-32 checksum and a 16 byte
+BLAKE2b hash. A client slides the rolling checksum over its new version,
+refers to the blocks the server already has and sends only the bytes in
+between. The server rebuilds the new version from the old one and stores it
+like any other upload.
+
+    signature:  BTSG, version, block size (u32), size (u64), SHA-256,
+                then weak checksum (u32) + strong hash per block
+    delta:      BTDL, version, block size (u32), new size (u64), base SHA-256,
+                then C start (u32) count (u32) | L length (u32) bytes, ..., E
+
+Upload a new version of a stored file:
+    python3 delta.py http://localhost:8081 report_v2.pdf --base report.pdf
+"""
+
+import os
+import sys
+import zlib
+import json
+import struct
+import hashlib
+import argparse
+import http.client
+from math import isqrt
+from urllib.parse import urlsplit, quote
+
+SIGNATURE_MAGIC = b'BTSG'
+DELTA_MAGIC = b'BTDL'
+FORMAT_VERSION = 1
+MIN_BLOCK_SIZE = 2 * 1024
+MAX_BLOCK_SIZE = 64 * 1024
+STRONG_SIZE = 16
+LITERAL_CHUNK = 1024 * 1024
+
+_ADLER_MOD = 65521
+_HEADER = struct.Struct('>4sBIQ32s')
+_BLOCK = struct.Struct(f'>I{STRONG_SIZE}s')
+_COPY = struct.Struct('>II')
+_LENGTH = struct.Struct('>I')
+
+class DeltaError(ValueError):
+    """Malformed signature or delta"""
+
+def block_size_for(size):
+    """About the square root of the file size like rsync, in whole KB"""
+    return max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, isqrt(size) // 1024 * 1024))
+
+def strong_hash(block):
+    return hashlib.blake2b(block, digest_size=STRONG_SIZE).digest()
+
+def iter_blocks(chunks, block_size):
+    """Regroup chunks into blocks of block_size, the last one may be shorter"""
+    pending = b''
+    for chunk in chunks:
+        data = pending + chunk
+        full = len(data) // block_size * block_size
+        for offset in range(0, full, block_size):
+            yield data[offset:offset + block_size]
+        pending = data[full:]
+    if pending:
+        yield pending
+
+def make_signature(chunks, size):
+    """Signature of a file of size bytes, read as chunks"""
+    block_size = block_size_for(size)
+    digest = hashlib.sha256()
+    entries = []
+    for block in iter_blocks(chunks, block_size):
+        digest.update(block)
+        entries.append(_BLOCK.pack(zlib.adler32(block), strong_hash(block)))
+    header = _HEADER.pack(SIGNATURE_MAGIC, FORMAT_VERSION, block_size, size, digest.digest())
+    return header + b''.join(entries)
+
+def parse_signature(signature):
+    """(block size, size, SHA-256, [(weak, strong)]) of a signature"""
+    if len(signature) < _HEADER.size:
+        raise DeltaError("Truncated signature")
+    magic, version, block_size, size, sha256 = _HEADER.unpack_from(signature)
+    if magic != SIGNATURE_MAGIC or version != FORMAT_VERSION or not block_size:
+        raise DeltaError("Not a signature")
+    body = memoryview(signature)[_HEADER.size:]
+    if len(body) != -(-size // block_size) * _BLOCK.size:
+        raise DeltaError("Truncated signature")
+    return block_size, size, sha256, list(_BLOCK.iter_unpack(body))
+
+class _DeltaWriter:
+    def __init__(self, block_size, size, base_sha256):
+        self.parts = [_HEADER.pack(DELTA_MAGIC, FORMAT_VERSION, block_size, size, base_sha256)]
+        self.run = None
+
+    def literal(self, data):
+        if not len(data):
+            return
+        self._end_run()
+        for offset in range(0, len(data), LITERAL_CHUNK):
+            piece = data[offset:offset + LITERAL_CHUNK]
+            self.parts += [b'L', _LENGTH.pack(len(piece)), bytes(piece)]
+
+    def copy(self, index):
+        # Consecutive blocks become one reference
+        if self.run and self.run[0] + self.run[1] == index:
+            self.run[1] += 1
+        else:
+            self._end_run()
+            self.run = [index, 1]
+
+    def _end_run(self):
+        if self.run:
+            self.parts += [b'C', _COPY.pack(*self.run)]
+            self.run = None
+
+    def finish(self):
+        self._end_run()
+        self.parts.append(b'E')
+        return b''.join(self.parts)
+
+def make_delta(signature, data):
+    """Delta that turns the file behind signature into data"""
+    block_size, base_size, base_sha256, blocks = parse_signature(signature)
+    # Only whole blocks can match while rolling, a short last block is tried at the end
+    full_blocks = base_size // block_size
+    table = {}
+    for index, (weak, strong) in enumerate(blocks[:full_blocks]):
+        table.setdefault(weak, {}).setdefault(strong, index)
+
+    writer = _DeltaWriter(block_size, len(data), base_sha256)
+    view = memoryview(data)
+    size = len(data)
+    position = literal = 0
+    weak = None
+    while position + block_size <= size:
+        if weak is None:
+            weak = zlib.adler32(view[position:position + block_size])
+        candidates = table.get(weak)
+        if candidates is not None:
+            index = candidates.get(strong_hash(view[position:position + block_size]))
+            if index is not None:
+                writer.literal(view[literal:position])
+                writer.copy(index)
+                position += block_size
+                literal = position
+                weak = None
+                continue
+        if position + block_size == size:
+            break
+        # Slide the window one byte: drop data[position], take in data[position + block_size]
+        leaving, entering = data[position], data[position + block_size]
+        a = ((weak & 0xffff) - leaving + entering) % _ADLER_MOD
+        b = ((weak >> 16) - block_size * leaving + a - 1) % _ADLER_MOD
+        weak = (b << 16) | a
+        position += 1
+
+    tail = base_size - full_blocks * block_size
+    if tail and size - tail >= literal and blocks[-1] == (zlib.adler32(view[size - tail:]), strong_hash(view[size - tail:])):
+        writer.literal(view[literal:size - tail])
+        writer.copy(len(blocks) - 1)
+        literal = size
+    writer.literal(view[literal:])
+    return writer.finish()
+
+def _base_reader(base):
+    """read(offset, length) over the old version, bytes or a file"""
+    if isinstance(base, (bytes, bytearray, memoryview)):
+        view = memoryview(base)
+        return lambda offset, length: view[offset:offset + length]
+
+    def read(offset, length):
+        base.seek(offset)
+        return base.read(length)
+    return read
+
+class DeltaReader:
+    """Reads a delta from a stream of chunks and rebuilds the new version.
+
+    The header is parsed on construction. Raises DeltaError for anything
+    malformed, also from apply() halfway through.
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = b''
+        self._offset = 0
+        self.received = 0
+        magic, version, self.block_size, self.size, self.base_sha256 = _HEADER.unpack(self._read(_HEADER.size))
+        if magic != DELTA_MAGIC or version != FORMAT_VERSION or not self.block_size:
+            raise DeltaError("Not a delta")
+
+    def _read(self, length):
+        if len(self._buffer) - self._offset < length:
+            parts = [self._buffer[self._offset:]]
+            available = len(parts[0])
+            while available < length:
+                chunk = next(self._chunks, None)
+                if chunk is None:
+                    raise DeltaError("Truncated delta")
+                parts.append(chunk)
+                available += len(chunk)
+                self.received += len(chunk)
+            self._buffer = b''.join(parts)
+            self._offset = 0
+        data = self._buffer[self._offset:self._offset + length]
+        self._offset += length
+        return data
+
+    def apply(self, base, base_size):
+        """Yield the new version, base is the old one as bytes or a file"""
+        read_base = _base_reader(base)
+        blocks = -(-base_size // self.block_size)
+        written = 0
+        while True:
+            op = self._read(1)
+            if op == b'E':
+                break
+            if op == b'C':
+                start, count = _COPY.unpack(self._read(_COPY.size))
+                if not count or start + count > blocks:
+                    raise DeltaError("Block reference out of range")
+                end = min((start + count) * self.block_size, base_size)
+                for offset in range(start * self.block_size, end, LITERAL_CHUNK):
+                    piece = read_base(offset, min(LITERAL_CHUNK, end - offset))
+                    written += len(piece)
+                    yield piece
+            elif op == b'L':
+                (length,) = _LENGTH.unpack(self._read(_LENGTH.size))
+                if length > LITERAL_CHUNK:
+                    raise DeltaError("Literal too long")
+                written += length
+                yield self._read(length)
+            else:
+                raise DeltaError("Unknown delta operation")
+            if written > self.size:
+                raise DeltaError("Delta is longer than announced")
+        if written != self.size:
+            raise DeltaError("Delta is shorter than announced")
+        if self._offset < len(self._buffer) or any(self._chunks):
+            raise DeltaError("Data after the end of the delta")
+
+def upload_version(server, path, base, name=None):
+    """Upload path as a new version of the stored file base, returns (result, bytes sent)"""
+    parts = urlsplit(server)
+    connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+    conn = connection_class(parts.netloc, timeout=600)
+    try:
+        conn.request('GET', f'/signature/{quote(base)}')
+        response = conn.getresponse()
+        signature = response.read()
+        if response.status != 200:
+            raise RuntimeError(f"signature of {base} failed with {response.status}")
+
+        with open(path, 'rb') as f:
+            data = f.read()
+        delta = make_delta(signature, data)
+        name = name or os.path.basename(path)
+        conn.request('PUT', f'/delta/{quote(name)}?base={quote(base)}', body=delta,
+                     headers={'Content-Type': 'application/octet-stream',
+                              'X-Content-SHA256': hashlib.sha256(data).hexdigest()})
+        response = conn.getresponse()
+        body = response.read()
+        if response.status != 200:
+            raise RuntimeError(f"delta upload failed with {response.status}: {body[:200].decode(errors='replace')}")
+        return json.loads(body), len(signature) + len(delta)
+    finally:
+        conn.close()
+
+def main():
+    parser = argparse.ArgumentParser(description='Upload a new version of a stored file as a delta')
+    parser.add_argument('server', help='server URL, e.g. http://localhost:8081')
+    parser.add_argument('path', help='the new version')
+    parser.add_argument('--base', required=True, help='stored name of the previous version')
+    parser.add_argument('--name', help='name to store the new version under (default: file name)')
+    args = parser.parse_args()
+
+    try:
+        result, sent = upload_version(args.server, args.path, args.base, args.name)
+    except (OSError, RuntimeError, DeltaError) as e:
+        print(f"❌ {e}")
+        sys.exit(1)
+    size = os.path.getsize(args.path)
+    print(f"✅ Stored {result['filename']}: {sent} bytes transferred for {size} bytes "
+          f"({sent / max(size, 1):.1%})")
+
+if __name__ == '__main__':
+    main()
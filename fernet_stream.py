@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Fernet tokens encrypted and decrypted in chunks
+
+Produces and reads the same tokens as cryptography's Fernet, with memory
+bounded by the chunk size instead of a few times the file size. Used for
+transfers that spill to disk when the memory budget is spent.
+"""
+
+import os
+import time
+import base64
+from cryptography.fernet import InvalidToken
+from cryptography.hazmat.primitives import hashes, hmac, padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+_HEADER = 25
+_HMAC = 32
+_BLOCK = 16
+
+def _keys(key):
+    raw = base64.urlsafe_b64decode(key)
+    return raw[:16], raw[16:]
+
+class _Base64Encoder:
+    def __init__(self):
+        self.pending = b''
+
+    def update(self, data):
+        data = self.pending + data
+        cut = len(data) // 3 * 3
+        self.pending = data[cut:]
+        return base64.urlsafe_b64encode(data[:cut])
+
+    def finalize(self):
+        return base64.urlsafe_b64encode(self.pending)
+
+def token_size(size):
+    """Length of the Fernet token of size bytes of plaintext"""
+    raw = _HEADER + (size // _BLOCK + 1) * _BLOCK + _HMAC
+    return (raw + 2) // 3 * 4
+
+def encrypt_stream(key, chunks):
+    """Yield a Fernet token of the concatenated chunks, piece by piece"""
+    signing_key, encryption_key = _keys(key)
+    iv = os.urandom(16)
+    header = b'\x80' + int(time.time()).to_bytes(8, 'big') + iv
+    signer = hmac.HMAC(signing_key, hashes.SHA256())
+    encryptor = Cipher(algorithms.AES(encryption_key), modes.CBC(iv)).encryptor()
+    padder = padding.PKCS7(algorithms.AES.block_size).padder()
+    encoder = _Base64Encoder()
+
+    signer.update(header)
+    yield encoder.update(header)
+    for chunk in chunks:
+        ciphertext = encryptor.update(padder.update(chunk))
+        if ciphertext:
+            signer.update(ciphertext)
+            yield encoder.update(ciphertext)
+    ciphertext = encryptor.update(padder.finalize()) + encryptor.finalize()
+    signer.update(ciphertext)
+    yield encoder.update(ciphertext + signer.finalize()) + encoder.finalize()
+
+def decrypt_stream(key, chunks):
+    """Yield the plaintext of a Fernet token read in chunks.
+
+    The HMAC is only checked at the end, InvalidToken is raised after the
+    plaintext has been yielded. Spool the output and only use it once the
+    generator has finished.
+    """
+    signing_key, encryption_key = _keys(key)
+    verifier = hmac.HMAC(signing_key, hashes.SHA256())
+    pending_text = b''
+    raw = bytearray()
+    decryptor = unpadder = None
+
+    for chunk in chunks:
+        text = pending_text + chunk
+        cut = len(text) // 4 * 4
+        pending_text = text[cut:]
+        try:
+            raw += base64.urlsafe_b64decode(text[:cut])
+        except ValueError:
+            raise InvalidToken
+        if decryptor is None:
+            if len(raw) < _HEADER:
+                continue
+            if raw[0] != 0x80:
+                raise InvalidToken
+            verifier.update(bytes(raw[:_HEADER]))
+            decryptor = Cipher(algorithms.AES(encryption_key), modes.CBC(bytes(raw[9:_HEADER]))).decryptor()
+            unpadder = padding.PKCS7(algorithms.AES.block_size).unpadder()
+            del raw[:_HEADER]
+        # The last 32 bytes might be the HMAC, keep them back
+        usable = max(0, len(raw) - _HMAC) // _BLOCK * _BLOCK
+        if usable:
+            ciphertext = bytes(raw[:usable])
+            del raw[:usable]
+            verifier.update(ciphertext)
+            plaintext = unpadder.update(decryptor.update(ciphertext))
+            if plaintext:
+                yield plaintext
+
+    if pending_text or decryptor is None or len(raw) < _HMAC or (len(raw) - _HMAC) % _BLOCK:
+        raise InvalidToken
+    ciphertext = bytes(raw[:-_HMAC])
+    verifier.update(ciphertext)
+    try:
+        verifier.verify(bytes(raw[-_HMAC:]))
+        plaintext = unpadder.update(decryptor.update(ciphertext) + decryptor.finalize()) + unpadder.finalize()
+    except Exception:
+        raise InvalidToken
+    if plaintext:
+        yield plaintext
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+"""
+Process-wide budget for memory held by transfers
+
+Uploads and downloads that decode whole files in memory first reserve an
+estimate of what they will allocate. Once the budget is spent, a transfer
+waits up to MEMORY_WAIT_SECONDS for others to finish and then spills: it
+goes through temporary files and the streaming Fernet code instead, which
+needs memory for a chunk at a time only. A burst of large transfers so costs
+disk and time rather than an out-of-memory kill.
+
+The estimates are multiples of the file size measured with
+benchmarks/hot_paths.py: Fernet allocates about 6.7 times its input when
+encrypting and 5 times when decrypting.
+"""
+
+import os
+import gzip
+import time
+import zlib
+import tempfile
+import threading
+from metrics import COMPRESSION_SECONDS, COMPRESSION_RATIO
+from storage import iter_chunks
+from compression_control import choose_level, record_compression
+
+SPILL_CHUNK_SIZE = 1024 * 1024
+UPLOAD_FACTOR = 8
+
+def _env_number(name, default):
+    try:
+        return max(0, float(os.environ.get(name, default)))
+    except ValueError:
+        return default
+
+def upload_cost(size):
+    """Bytes an in-memory upload of size bytes allocates at its peak: body, gzip copy, Fernet token"""
+    return size * UPLOAD_FACTOR
+
+def decode_cost(stored_size, original_size):
+    """Bytes decoding a stored file in memory allocates at its peak: token, Fernet, decompressed copy"""
+    return stored_size * 4 + original_size * 2
+
+def iter_file(f, chunk_size=SPILL_CHUNK_SIZE):
+    """Chunks of a file object from its current position"""
+    return iter(lambda: f.read(chunk_size), b'')
+
+def gzip_file(source, level=6, spill_dir=None):
+    """Gzip a file object into a new temporary file, returns (file, size)"""
+    target = tempfile.TemporaryFile(dir=spill_dir)
+    with gzip.GzipFile(fileobj=target, mode='wb', compresslevel=level) as compressor:
+        for chunk in iter_file(source):
+            compressor.write(chunk)
+    size = target.tell()
+    target.seek(0)
+    return target, size
+
+def should_compress_file(filename, data_size):
+    """Determine if file should be compressed based on type and size"""
+    # Don't compress already compressed formats
+    compressed_formats = {'.jpg', '.jpeg', '.png', '.gif', '.mp4', '.mp3', '.zip', '.rar', '.7z', '.gz', '.bz2'}
+    ext = os.path.splitext(filename)[1].lower()
+    if ext in compressed_formats:
+        return False
+    # Don't compress very small files (less than 1KB)
+    if data_size < 1024:
+        return False
+    # Don't compress very large files (more than 100MB) to avoid memory issues
+    if data_size > 100 * 1024 * 1024:
+        return False
+    return True
+
+def compress_file_data(data, filename, level=6, queued=0):
+    """Compress file data if beneficial.
+    
+    level None lets compression_control choose, queued is the processing
+    backlog it weighs, 0 stores the data as is.
+    """
+    if not should_compress_file(filename, len(data)):
+        return data, len(data), False
+    if level is None:
+        level = choose_level(filename, queued)
+    if not level:
+        return data, len(data), False
+    
+    try:
+        started = time.perf_counter()
+        compressed = gzip.compress(data, compresslevel=level)
+        seconds = time.perf_counter() - started
+        COMPRESSION_SECONDS.labels('compress').observe(seconds)
+        COMPRESSION_RATIO.observe(len(compressed) / len(data))
+        record_compression(filename, level, len(data), len(compressed), seconds)
+        # Only use compression if it saves at least 10% of space
+        if len(compressed) < len(data) * 0.9:
+            return compressed, len(compressed), True
+        else:
+            return data, len(data), False
+    except Exception as e:
+        print(f"⚠️ Compression failed for {filename}: {e}")
+        return data, len(data), False
+
+def compress_spooled_file(source, size, filename, spill_dir=None, level=6, queued=0):
+    """compress_file_data for an upload spilled to disk, returns (file, size, was_compressed)"""
+    if not should_compress_file(filename, size):
+        return source, size, False
+    if level is None:
+        level = choose_level(filename, queued)
+    if not level:
+        return source, size, False
+    try:
+        started = time.perf_counter()
+        compressed, compressed_size = gzip_file(source, level, spill_dir)
+        seconds = time.perf_counter() - started
+        COMPRESSION_SECONDS.labels('compress').observe(seconds)
+        COMPRESSION_RATIO.observe(compressed_size / size)
+        record_compression(filename, level, size, compressed_size, seconds)
+        if compressed_size < size * 0.9:
+            return compressed, compressed_size, True
+        compressed.close()
+    except Exception as e:
+        print(f"⚠️ Compression failed for {filename}: {e}")
+    source.seek(0)
+    return source, size, False
+
+def close_spill(data):
+    """Close a payload spilled to a temporary file, in-memory payloads need nothing"""
+    if data is not None and not isinstance(data, bytes):
+        data.close()
+
+def plaintext_chunks(data):
+    """Chunks of an in-memory or spilled payload"""
+    return iter_chunks(data) if isinstance(data, bytes) else iter_file(data)
+
+def gunzip_chunks(chunks):
+    """Decompress a gzip stream chunk by chunk"""
+    decompressor = zlib.decompressobj(wbits=31)
+    for chunk in chunks:
+        while chunk:
+            data = decompressor.decompress(chunk, SPILL_CHUNK_SIZE)
+            if data:
+                yield data
+            chunk = decompressor.unconsumed_tail
+    data = decompressor.flush()
+    if data:
+        yield data
+    if not decompressor.eof:
+        raise zlib.error("Truncated gzip stream")
+
+class Reservation:
+    """Bytes held against the budget until released"""
+
+    def __init__(self, governor, nbytes):
+        self.governor = governor
+        self.nbytes = nbytes
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.governor._release(self.nbytes)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+class MemoryGovernor:
+    """Hands out reservations while the reserved total stays within the budget"""
+
+    def __init__(self, budget=None, wait_seconds=None, spill_dir=None):
+        self.budget = int(_env_number('MEMORY_BUDGET_MB', 1024) * 1024 * 1024) if budget is None else budget
+        self.wait_seconds = _env_number('MEMORY_WAIT_SECONDS', 2) if wait_seconds is None else wait_seconds
+        self.spill_dir = spill_dir or os.environ.get('SPILL_DIR') or None
+        self._cond = threading.Condition()
+        self.reserved = 0
+        self.peak_reserved = 0
+        self.active = 0
+        self.granted = 0
+        self.waited = 0
+        self.wait_seconds_total = 0.0
+        self.over_budget = 0
+        self.spills = 0
+        self.spilled_bytes = 0
+
+    def reserve(self, nbytes, wait=None):
+        """Reservation of nbytes, or None when the transfer has to spill.
+
+        Waits up to wait seconds (MEMORY_WAIT_SECONDS by default) for other
+        transfers to release memory. Requests larger than the whole budget
+        spill at once.
+        """
+        wait = self.wait_seconds if wait is None else wait
+        with self._cond:
+            if nbytes > self.budget:
+                self.over_budget += 1
+                return None
+            if self.reserved + nbytes > self.budget:
+                self.waited += 1
+                started = time.monotonic()
+                deadline = started + wait
+                while self.reserved + nbytes > self.budget:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                self.wait_seconds_total += time.monotonic() - started
+                if self.reserved + nbytes > self.budget:
+                    self.over_budget += 1
+                    return None
+            self.reserved += nbytes
+            self.peak_reserved = max(self.peak_reserved, self.reserved)
+            self.active += 1
+            self.granted += 1
+        return Reservation(self, nbytes)
+
+    def _release(self, nbytes):
+        with self._cond:
+            self.reserved -= nbytes
+            self.active -= 1
+            self._cond.notify_all()
+
+    def spool(self, chunks, digest=None):
+        """Write chunks to a temporary file instead of memory, returns (file, size) rewound"""
+        spill = tempfile.TemporaryFile(dir=self.spill_dir)
+        size = 0
+        try:
+            for chunk in chunks:
+                if digest is not None:
+                    digest.update(chunk)
+                spill.write(chunk)
+                size += len(chunk)
+        except BaseException:
+            spill.close()
+            raise
+        spill.seek(0)
+        with self._cond:
+            self.spills += 1
+            self.spilled_bytes += size
+        return spill, size
+
+    def stats(self):
+        with self._cond:
+            return {
+                'budget_bytes': self.budget,
+                'reserved_bytes': self.reserved,
+                'peak_reserved_bytes': self.peak_reserved,
+                'active_reservations': self.active,
+                'granted': self.granted,
+                'waited': self.waited,
+                'wait_seconds': round(self.wait_seconds_total, 3),
+                'over_budget': self.over_budget,
+                'spills': self.spills,
+                'spilled_bytes': self.spilled_bytes
+            }
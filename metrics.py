@@ -0,0 +1,394 @@
+#!/usr/bin/env python3
+"""
+Request and processing metrics in the Prometheus text format
+
+Metrics are plain counters, gauges and histograms in memory. Each labelled
+child has its own lock that is only held for an addition, so threads never
+wait on each other for long and recording costs well under a microsecond.
+Handlers add up byte counts per request and record them once at the end.
+
+Values are per process. With several workers every scrape sees the worker
+that answered it; give each worker its own port or sum over instances.
+"""
+
+import time
+import bisect
+import functools
+import threading
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+RATIO_BUCKETS = (0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0)
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        escaped = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{escaped}"')
+    return '{' + ','.join(pairs) + '}'
+
+class _Value:
+    """Counter or gauge value of one label combination"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+class _Timer:
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started)
+
+def timed(histogram, *labels):
+    """Decorator observing how long each call of a function takes"""
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with histogram.labels(*labels).time():
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+class _Buckets:
+    """Histogram of one label combination"""
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self._lock = threading.Lock()
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def time(self):
+        """Context manager observing the seconds its block took"""
+        return _Timer(self)
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._children = {}
+
+    def _new_child(self):
+        return _Value()
+
+    def labels(self, *values):
+        """Child for one combination of label values"""
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} takes labels {self.labelnames}")
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def children(self):
+        with self._lock:
+            return sorted(self._children.items())
+
+    def samples(self):
+        """(suffix, label names, label values, value) of every child"""
+        for values, child in self.children():
+            yield '', self.labelnames, values, child.value
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def dec(self, amount=1):
+        self.labels().dec(amount)
+
+    def set(self, value):
+        self.labels().set(value)
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _Buckets(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+    def samples(self):
+        names = self.labelnames + ('le',)
+        for values, child in self.children():
+            with child._lock:
+                counts = list(child.counts)
+                total = child.sum
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield '_bucket', names, values + (_format_value(bound),), cumulative
+            yield '_sum', self.labelnames, values, total
+            yield '_count', self.labelnames, values, cumulative
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._add(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._add(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self, extra=()):
+        """Text exposition of every metric, plus extra (name, type, help, [(labels, value)]) families"""
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for suffix, names, values, value in metric.samples():
+                lines.append(f'{metric.name}{suffix}{_format_labels(names, values)} {_format_value(value)}')
+        for name, kind, documentation, samples in extra:
+            lines.append(f'# HELP {name} {documentation}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in samples:
+                lines.append(f'{name}{_format_labels(list(labels), list(labels.values()))} {_format_value(value)}')
+        return ('\n'.join(lines) + '\n').encode()
+
+def stats_families(prefix, stats, counters=(), labels=None):
+    """Metric families for the numbers of a stats() dict.
+
+    Keys listed in counters become counters, other numbers gauges.
+    """
+    families = []
+    for key, value in sorted(stats.items()):
+        if isinstance(value, bool):
+            value = int(value)
+        if not isinstance(value, (int, float)):
+            continue
+        documentation = key.replace('_', ' ').capitalize()
+        if key in counters:
+            families.append((f'{prefix}_{key}_total', 'counter', documentation, [(labels or {}, value)]))
+        else:
+            families.append((f'{prefix}_{key}', 'gauge', documentation, [(labels or {}, value)]))
+    return families
+
+REGISTRY = Registry()
+
+REQUESTS = REGISTRY.counter('btransfer_http_requests_total', 'HTTP requests by route and status',
+                            ['method', 'route', 'status'])
+REQUEST_SECONDS = REGISTRY.histogram('btransfer_http_request_duration_seconds', 'HTTP request latency by route',
+                                     ['method', 'route'])
+BYTES_RECEIVED = REGISTRY.counter('btransfer_http_received_bytes_total', 'Bytes read from clients')
+BYTES_SENT = REGISTRY.counter('btransfer_http_sent_bytes_total', 'Bytes written to clients')
+TRANSFERS_IN_FLIGHT = REGISTRY.gauge('btransfer_transfers_in_flight', 'Uploads and downloads in progress',
+                                     ['direction'])
+COMPRESSION_SECONDS = REGISTRY.histogram('btransfer_compression_seconds', 'Time spent compressing and decompressing',
+                                         ['operation'])
+COMPRESSION_RATIO = REGISTRY.histogram('btransfer_compression_ratio', 'Compressed size over original size',
+                                       buckets=RATIO_BUCKETS)
+COMPRESSION_LEVELS = REGISTRY.counter('btransfer_compression_level_total', 'Compression levels chosen for uploads',
+                                      ['level'])
+ENCRYPTION_SECONDS = REGISTRY.histogram('btransfer_encryption_seconds', 'Time spent encrypting and decrypting',
+                                        ['operation'])
+DB_SECONDS = REGISTRY.histogram('btransfer_db_seconds', 'Time spent in SQLite by operation', ['operation'])
+
+KNOWN_PATHS = {
+    '/', '/index.html', '/manifest.json', '/sw.js', '/files', '/upload', '/analytics', '/health',
+    '/cache-stats', '/bandwidth', '/download-archive', '/events', '/changes', '/metrics', '/profile',
+    '/memory'
+}
+
+ROUTES = ['/download/', '/preview/', '/delete/', '/upload/', '/signature/', '/delta/', '/status/']
+
+def route_of(path):
+    """Low-cardinality route label of a request path"""
+    path = path.split('?', 1)[0]
+    for prefix in ROUTES:
+        if path.startswith(prefix):
+            return prefix + '<name>'
+    return path if path in KNOWN_PATHS else 'other'
+
+# Routes whose requests count as transfers in flight
+TRANSFER_ROUTES = {
+    '/upload': 'upload', '/upload/<name>': 'upload', '/delta/<name>': 'upload',
+    '/download/<name>': 'download', '/download-archive': 'download'
+}
+
+def request_started(route):
+    direction = TRANSFER_ROUTES.get(route)
+    if direction:
+        TRANSFERS_IN_FLIGHT.labels(direction).inc()
+
+def transfers_in_flight():
+    """Uploads and downloads in progress in this process"""
+    return sum(child.value for _, child in TRANSFERS_IN_FLIGHT.children())
+
+def request_finished(method, route, status, seconds, received, sent):
+    direction = TRANSFER_ROUTES.get(route)
+    if direction:
+        TRANSFERS_IN_FLIGHT.labels(direction).dec()
+    REQUESTS.labels(method, route, str(status)).inc()
+    REQUEST_SECONDS.labels(method, route).observe(seconds)
+    if received:
+        BYTES_RECEIVED.inc(received)
+    if sent:
+        BYTES_SENT.inc(sent)
+
+class CountingReader:
+    """Counts the bytes read through a file object, for one request at a time"""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.count = 0
+
+    def read(self, *args):
+        data = self.raw.read(*args)
+        self.count += len(data)
+        return data
+
+    def readline(self, *args):
+        line = self.raw.readline(*args)
+        self.count += len(line)
+        return line
+
+    def readinto(self, buffer):
+        size = self.raw.readinto(buffer)
+        self.count += size or 0
+        return size
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+    def take(self):
+        """Bytes counted since the last call"""
+        count, self.count = self.count, 0
+        return count
+
+class CountingWriter:
+    """Counts the bytes written through a file object"""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.count = 0
+
+    def write(self, data):
+        written = self.raw.write(data)
+        self.count += len(data)
+        return written
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+    def take(self):
+        count, self.count = self.count, 0
+        return count
+
+class _CountingBody:
+    """WSGI response iterable that records the request once it is closed"""
+
+    def __init__(self, body, finish):
+        self.body = body
+        self.finish = finish
+        self.sent = 0
+
+    def __iter__(self):
+        for chunk in self.body:
+            self.sent += len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            self.finish(self.sent)
+
+class WSGIMetrics:
+    """WSGI middleware recording request count, latency and bytes per route"""
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        started = time.perf_counter()
+        method = environ.get('REQUEST_METHOD', 'GET')
+        route = route_of(environ.get('PATH_INFO', ''))
+        reader = CountingReader(environ['wsgi.input'])
+        environ['wsgi.input'] = reader
+        response = {'status': 500, 'length': None}
+
+        def recording_start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            for name, value in headers:
+                if name.lower() == 'content-length':
+                    response['length'] = int(value)
+            return start_response(status, headers, exc_info)
+
+        def finish(sent):
+            request_finished(method, route, response['status'], time.perf_counter() - started, reader.take(), sent)
+
+        request_started(route)
+        try:
+            body = self.app(environ, recording_start_response)
+        except Exception:
+            finish(0)
+            raise
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if isinstance(file_wrapper, type) and isinstance(body, file_wrapper):
+            # Leave sendfile responses alone, their size is in the headers
+            finish(response['length'] or 0)
+            return body
+        return _CountingBody(body, finish)
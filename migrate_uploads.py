@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+"""
+Reshard an existing flat uploads/ folder into hashed subdirectories
+
+Safe to run while the servers are up: they look in both layouts and every
+file stays reachable while it is being moved.
+
+Usage:
+    python3 migrate_uploads.py [uploads]
+"""
+
+import os
+import sys
+import time
+from storage import migrate_flat_layout
+
+def main():
+    upload_dir = sys.argv[1] if len(sys.argv) > 1 else 'uploads'
+    if not os.path.isdir(upload_dir):
+        print(f"❌ Upload folder not found: {upload_dir}")
+        return 1
+
+    print(f"📦 Resharding {upload_dir}...")
+    started = time.time()
+    moved = migrate_flat_layout(upload_dir)
+    print(f"✅ Moved {moved} files in {time.time() - started:.1f}s")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+Streaming multipart/form-data parser
+
+Reads a request body part by part straight from the socket, so a batch of
+files is never held in memory as a whole and each file can be processed as
+soon as it has arrived.
+"""
+
+import re
+
+BLOCK_SIZE = 64 * 1024
+_PARAM_RE = re.compile(r';\s*([\w*-]+)\s*=\s*(?:"((?:[^"\\]|\\.)*)"|([^;\s]*))')
+
+def get_boundary(content_type):
+    """Return the boundary of a multipart Content-Type header, or None"""
+    if not content_type or not content_type.startswith('multipart/form-data'):
+        return None
+    for key, quoted, token in _PARAM_RE.findall(content_type):
+        if key.lower() == 'boundary':
+            return quoted if quoted else token
+    return None
+
+class MultipartPart:
+    """One part of a multipart body; its data must be read before the next part"""
+
+    def __init__(self, headers, chunks):
+        self.headers = headers
+        self.chunks = chunks
+        self.name = None
+        self.filename = None
+        disposition = headers.get('content-disposition', '')
+        for key, quoted, token in _PARAM_RE.findall(disposition):
+            value = quoted.replace('\\"', '"') if quoted else token
+            if key.lower() == 'name':
+                self.name = value
+            elif key.lower() == 'filename':
+                self.filename = value
+        self.content_type = headers.get('content-type', 'application/octet-stream')
+
+    def read(self):
+        """Return the whole part body"""
+        return b''.join(self.chunks)
+
+    def drain(self):
+        for _ in self.chunks:
+            pass
+
+class MultipartReader:
+    """Iterate over the parts of a multipart body read from a file-like stream"""
+
+    def __init__(self, stream, boundary, content_length, block_size=BLOCK_SIZE):
+        self.stream = stream
+        # Parts are separated by CRLF--boundary, the leading CRLF of the first one is implied
+        self.delimiter = b'\r\n--' + boundary.encode('latin-1')
+        self.remaining = content_length
+        self.block_size = block_size
+        self.buffer = bytearray(b'\r\n')
+
+    def _fill(self):
+        """Read the next block of the body into the buffer, False at the end"""
+        if self.remaining <= 0:
+            return False
+        data = self.stream.read(min(self.block_size, self.remaining))
+        if not data:
+            self.remaining = 0
+            return False
+        self.remaining -= len(data)
+        self.buffer += data
+        return True
+
+    def _find(self, marker):
+        """Position of marker in the buffer, reading more of the body as needed"""
+        start = 0
+        while True:
+            index = self.buffer.find(marker, start)
+            if index >= 0:
+                return index
+            start = max(0, len(self.buffer) - len(marker) + 1)
+            if not self._fill():
+                raise ValueError("Truncated multipart body")
+
+    def _body(self):
+        """Yield the data of the current part up to the next delimiter"""
+        keep = len(self.delimiter) - 1
+        while True:
+            index = self.buffer.find(self.delimiter)
+            if index >= 0:
+                if index:
+                    yield bytes(self.buffer[:index])
+                del self.buffer[:index + len(self.delimiter)]
+                return
+            # Everything but a possible partial delimiter at the end is data
+            safe = len(self.buffer) - keep
+            if safe > 0:
+                yield bytes(self.buffer[:safe])
+                del self.buffer[:safe]
+            if not self._fill():
+                raise ValueError("Truncated multipart body")
+
+    def __iter__(self):
+        # Skip the preamble
+        index = self._find(self.delimiter)
+        del self.buffer[:index + len(self.delimiter)]
+
+        while True:
+            while len(self.buffer) < 2:
+                if not self._fill():
+                    raise ValueError("Truncated multipart body")
+            if self.buffer[:2] == b'--':
+                # Closing delimiter, ignore the epilogue
+                while self._fill():
+                    del self.buffer[:]
+                return
+
+            end = self._find(b'\r\n\r\n')
+            headers = {}
+            for line in bytes(self.buffer[:end]).decode('utf-8', 'replace').split('\r\n'):
+                key, sep, value = line.partition(':')
+                if sep:
+                    headers[key.strip().lower()] = value.strip()
+            del self.buffer[:end + 4]
+
+            part = MultipartPart(headers, self._body())
+            yield part
+            # Skip whatever the caller did not read
+            part.drain()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""
+File previews without decoding whole files
+
+Text snippets come from the first few AES blocks of the Fernet token and a
+bounded gzip decompression. The prefix is decrypted without checking the
+token's HMAC, which needs the whole file; snippets are only ever shown as
+previews, never served as the file. Image thumbnails need the whole image,
+so they are rendered once in a background pool and cached.
+"""
+
+import io
+import os
+import lzma
+import zlib
+import base64
+import threading
+import functools
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from content_cache import ContentCache
+from recompression import XZ_MAGIC
+
+SNIPPET_BYTES = 4096
+THUMBNAIL_SIZE = (256, 256)
+THUMBNAIL_MAX_SOURCE_BYTES = 50 * 1024 * 1024
+PREVIEW_CACHE_BYTES = int(os.environ.get('PREVIEW_CACHE_BYTES', 32 * 1024 * 1024))
+PREVIEW_WORKERS = int(os.environ.get('PREVIEW_WORKERS', 2))
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp', '.tiff'}
+TEXT_EXTENSIONS = {
+    '.txt', '.md', '.csv', '.tsv', '.log', '.json', '.xml', '.yaml', '.yml', '.ini', '.cfg', '.toml',
+    '.html', '.htm', '.css', '.js', '.ts', '.py', '.java', '.c', '.h', '.cpp', '.go', '.rs', '.rb',
+    '.php', '.sh', '.sql', '.swift', '.kt'
+}
+
+# Fernet token layout: version (1) | timestamp (8) | IV (16) | ciphertext | HMAC (32)
+_HEADER = 25
+_HMAC = 32
+_BLOCK = 16
+
+def preview_kind(filename):
+    ext = os.path.splitext(filename)[1].lower()
+    if ext in IMAGE_EXTENSIONS:
+        return 'image'
+    if ext in TEXT_EXTENSIONS:
+        return 'text'
+    return 'binary'
+
+def token_prefix_length(plaintext_bytes):
+    """Characters of a Fernet token needed to decrypt the first plaintext_bytes.
+
+    The extra 48 bytes guarantee the blocks we use never reach into the HMAC
+    when the token is longer than what was read.
+    """
+    blocks = (plaintext_bytes + _BLOCK - 1) // _BLOCK
+    raw = _HEADER + blocks * _BLOCK + 48
+    return (raw + 2) // 3 * 4
+
+def decrypt_token_prefix(key, prefix, plaintext_bytes):
+    """Decrypt the start of a Fernet token that is longer than prefix.
+
+    Returns up to plaintext_bytes of plaintext, unauthenticated.
+    """
+    raw = base64.urlsafe_b64decode(prefix[:len(prefix) // 4 * 4])
+    blocks = min((plaintext_bytes + _BLOCK - 1) // _BLOCK, (len(raw) - _HEADER - _HMAC) // _BLOCK)
+    if raw[:1] != b'\x80' or blocks <= 0:
+        raise ValueError("Not a Fernet token")
+    encryption_key = base64.urlsafe_b64decode(key)[16:]
+    iv = raw[9:_HEADER]
+    decryptor = Cipher(algorithms.AES(encryption_key), modes.CBC(iv)).decryptor()
+    return decryptor.update(raw[_HEADER:_HEADER + blocks * _BLOCK])
+
+def decode_prefix(plaintext, was_compressed, limit):
+    """First limit bytes of the original file from a plaintext prefix"""
+    if not was_compressed:
+        return plaintext[:limit]
+    # Partial input is fine, decompression stops once limit bytes are out
+    if plaintext[:6] == XZ_MAGIC:
+        return lzma.LZMADecompressor().decompress(plaintext, limit)
+    return zlib.decompressobj(wbits=31).decompress(plaintext, limit)
+
+def text_snippet(data, complete):
+    """Decode a file prefix as text, None if it looks binary"""
+    if b'\x00' in data:
+        return None
+    text = data.decode('utf-8', errors='replace')
+    if not complete and text.endswith('\ufffd'):
+        # A multibyte character cut in half by the prefix
+        text = text[:-1]
+    printable = sum(1 for c in text if c.isprintable() or c in '\r\n\t')
+    if text and printable / len(text) < 0.9:
+        return None
+    return text
+
+@functools.lru_cache(maxsize=None)
+def pillow_available():
+    """Pillow is optional, images get no thumbnail without it"""
+    return importlib.util.find_spec('PIL') is not None
+
+def render_thumbnail(image_data, size=THUMBNAIL_SIZE):
+    """JPEG thumbnail of an image"""
+    # Imported on first use, it is slow to import and most runs never need it
+    from PIL import Image
+    with Image.open(io.BytesIO(image_data)) as image:
+        image.thumbnail(size)
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        out = io.BytesIO()
+        image.save(out, 'JPEG', quality=80)
+        return out.getvalue()
+
+class ThumbnailWorker:
+    """Renders thumbnails in a small thread pool and keeps them in an LRU cache"""
+
+    def __init__(self, workers=PREVIEW_WORKERS, max_bytes=PREVIEW_CACHE_BYTES):
+        self.cache = ContentCache(max_bytes=max_bytes, max_item_bytes=max_bytes)
+        self._pool = None
+        self._workers = workers
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._failed = set()
+        self.rendered = 0
+        self.failures = 0
+
+    @property
+    def available(self):
+        return pillow_available()
+
+    def get(self, file_id, version, load):
+        """Return the cached thumbnail, or None after scheduling it.
+
+        load() must return the decoded image. Raises ValueError if the
+        image cannot be thumbnailed.
+        """
+        thumbnail = self.cache.get(file_id, version)
+        if thumbnail is not None:
+            return thumbnail
+        key = (file_id, version)
+        with self._lock:
+            if key in self._failed:
+                raise ValueError("Thumbnail failed")
+            if key not in self._pending:
+                self._pending.add(key)
+                if self._pool is None:
+                    self._pool = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix='thumbnail')
+                self._pool.submit(self._render, file_id, version, load)
+        return None
+
+    def _render(self, file_id, version, load):
+        key = (file_id, version)
+        try:
+            thumbnail = render_thumbnail(load())
+            self.cache.put(file_id, version, thumbnail)
+            with self._lock:
+                self.rendered += 1
+        except Exception as e:
+            print(f"⚠️ Thumbnail failed for {file_id}: {e}")
+            with self._lock:
+                self.failures += 1
+                # Forget old failures now and then so the set stays small
+                if len(self._failed) > 1000:
+                    self._failed.clear()
+                self._failed.add(key)
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+
+    def invalidate(self, file_id):
+        self.cache.invalidate(file_id)
+
+    def stats(self):
+        with self._lock:
+            pending = len(self._pending)
+        stats = self.cache.stats()
+        stats.update(available=self.available, pending=pending, rendered=self.rendered, failures=self.failures)
+        return stats
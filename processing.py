@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+Background processing of uploads
+
+With ASYNC_PROCESSING on, an upload is acknowledged as soon as its content
+is staged: written and fsynced as is to <upload_dir>/.staging. Compression,
+encryption and the analytics row follow in a small pool of worker threads.
+Until a file's job is done its metadata says 'state': 'staged' and reads are
+served from the staged copy.
+
+A job writes the stored file and its metadata first and removes the staged
+copy last, so a reader that finds the staged copy gone finds the processed
+file instead. Staged copies left behind by a restart are processed again on
+start.
+"""
+
+import os
+import time
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+ASYNC_PROCESSING = os.environ.get('ASYNC_PROCESSING', '').lower() in ('1', 'true', 'yes', 'on')
+PROCESSING_WORKERS = int(os.environ.get('PROCESSING_WORKERS', 2))
+STAGING_DIR = '.staging'
+STAGE_CHUNK_SIZE = 1024 * 1024
+MAX_JOBS = 1000
+
+def is_staged(metadata):
+    return metadata.get('state') == 'staged'
+
+class ProcessingQueue:
+    """Staged uploads and the worker threads that process them"""
+
+    def __init__(self, upload_dir, handler, workers=PROCESSING_WORKERS, enabled=ASYNC_PROCESSING):
+        self.directory = os.path.join(upload_dir, STAGING_DIR)
+        self.handler = handler
+        self.enabled = enabled
+        self._workers = workers
+        self._pool = None
+        self._lock = threading.Lock()
+        # Recent jobs for /status, oldest first
+        self._jobs = OrderedDict()
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+
+    def staged_path(self, name):
+        return os.path.join(self.directory, name)
+
+    def stage(self, name, chunks):
+        """Write a staged copy and make it durable, returns its size"""
+        os.makedirs(self.directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        size = 0
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    size += len(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.staged_path(name))
+        except BaseException:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+        # The new name must survive a crash too
+        if hasattr(os, 'O_DIRECTORY'):
+            dir_fd = os.open(self.directory, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+        return size
+
+    def open_staged(self, name):
+        """The staged copy opened for reading, None once it has been processed"""
+        try:
+            return open(self.staged_path(name), 'rb')
+        except FileNotFoundError:
+            return None
+
+    def claim(self, name):
+        """open_staged() for a job, None if another job, maybe in another process, holds it"""
+        staged = self.open_staged(name)
+        if staged is not None and fcntl is not None:
+            try:
+                fcntl.flock(staged.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                staged.close()
+                return None
+        return staged
+
+    def discard(self, name):
+        """Remove a staged copy, returns whether there was one"""
+        try:
+            os.remove(self.staged_path(name))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def staged_names(self):
+        try:
+            return sorted(n for n in os.listdir(self.directory) if not n.startswith('.'))
+        except FileNotFoundError:
+            return []
+
+    def submit(self, name):
+        """Queue the job of a staged file"""
+        with self._lock:
+            self._jobs.pop(name, None)
+            self._jobs[name] = {'name': name, 'state': 'queued', 'queued_at': time.time()}
+            while len(self._jobs) > MAX_JOBS:
+                self._jobs.popitem(last=False)
+            self.submitted += 1
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix='processing')
+            self._pool.submit(self._run, name)
+
+    def _run(self, name):
+        self._update(name, state='processing', started_at=time.time())
+        try:
+            self.handler(name)
+        except Exception as e:
+            print(f"❌ Processing failed for {name}: {e}")
+            with self._lock:
+                self.failed += 1
+            self._update(name, state='failed', error=str(e), finished_at=time.time())
+        else:
+            with self._lock:
+                self.completed += 1
+            self._update(name, state='done', finished_at=time.time())
+
+    def _update(self, name, **fields):
+        with self._lock:
+            job = self._jobs.get(name)
+            if job is not None:
+                job.update(fields)
+
+    def status(self, name):
+        """The job of a file in this process, None if there was none recently"""
+        with self._lock:
+            job = self._jobs.get(name)
+            return dict(job) if job is not None else None
+
+    def backlog(self):
+        """Jobs queued or running in this process"""
+        with self._lock:
+            return sum(job['state'] in ('queued', 'processing') for job in self._jobs.values())
+
+    def stats(self):
+        with self._lock:
+            states = [job['state'] for job in self._jobs.values()]
+            return {
+                'enabled': self.enabled,
+                'workers': self._workers,
+                'queued': states.count('queued'),
+                'processing': states.count('processing'),
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'failed': self.failed
+            }
+
+    def stop(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Per-request stage timing and an on-demand sampling profiler
+
+A StageTimer lives for one request. Handlers wrap the expensive steps in
+timer.stage(name); the totals go out as a Server-Timing header and one log
+line per request, so a single slow upload shows where its time went.
+
+The profiler samples the stacks of all threads for a few seconds and
+returns them in the folded format that flamegraph.pl and speedscope read.
+"""
+
+import os
+import sys
+import time
+import threading
+
+MAX_PROFILE_SECONDS = 60
+DEFAULT_INTERVAL = 0.005
+
+class StageTimer:
+    """Time spent per named stage of one request"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+
+    def stage(self, name):
+        """Context manager adding the time of its block to a stage"""
+        return _Stage(self, name)
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def header(self):
+        """Server-Timing header value, stages in the order they first ran"""
+        parts = [f'{name};dur={seconds * 1000:.1f}' for name, seconds in self.stages.items()]
+        parts.append(f'total;dur={(time.perf_counter() - self.started) * 1000:.1f}')
+        return ', '.join(parts)
+
+    def log_line(self, method, path, status):
+        fields = ' '.join(f'{name}={seconds * 1000:.1f}ms' for name, seconds in self.stages.items())
+        total = (time.perf_counter() - self.started) * 1000
+        return f"⏱️ {method} {path} status={status} total={total:.1f}ms {fields}".rstrip()
+
+class _Stage:
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.timer.add(self.name, time.perf_counter() - self.started)
+
+_profile_lock = threading.Lock()
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{getattr(code, 'co_qualname', code.co_name)}"
+
+def sample_stacks(seconds, interval=DEFAULT_INTERVAL):
+    """Sample every other thread for seconds and return folded stacks.
+
+    Each line is "thread;outermost;...;innermost count". Raises
+    RuntimeError when another profile is already running.
+    """
+    if not _profile_lock.acquire(blocking=False):
+        raise RuntimeError("A profile is already running")
+    try:
+        me = threading.get_ident()
+        counts = {}
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame))
+                    frame = frame.f_back
+                stack.append(names.get(ident, f'thread-{ident}').replace(';', ':').replace(' ', '_'))
+                key = ';'.join(reversed(stack))
+                counts[key] = counts.get(key, 0) + 1
+            time.sleep(interval)
+    finally:
+        _profile_lock.release()
+    lines = [f'{stack} {count}' for stack, count in sorted(counts.items(), key=lambda item: -item[1])]
+    return '\n'.join(lines) + '\n' if lines else ''
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""
+Tiered recompression of cold files
+
+Uploads are gzipped at a fast level on the request path, see
+compression_control.py. Files nobody has downloaded for COLD_AFTER_HOURS
+are re-encoded in the background with xz (LZMA) and swapped in when that
+makes them at least RECOMPRESS_MIN_SAVING smaller. Their metadata then says 'codec': 'xz' and
+'tier': 'cold', files xz does not help are only marked cold. Readers tell
+the codecs apart by the magic bytes of the payload, so a download racing
+the swap decodes either version.
+
+One file is recompressed at a time. The worker sleeps after every chunk so
+it uses at most RECOMPRESS_CPU_SHARE of a core, and pauses while transfers
+are in flight or the load average is above RECOMPRESS_MAX_LOAD per core.
+COLD_AFTER_HOURS=0 turns it off.
+"""
+
+import os
+import json
+import lzma
+import gzip
+import time
+import tempfile
+import threading
+from datetime import datetime
+from memory_governor import iter_file, gunzip_chunks, SPILL_CHUNK_SIZE
+from fernet_stream import encrypt_stream, decrypt_stream, token_size
+from metrics import transfers_in_flight
+
+def _env_number(name, default):
+    try:
+        return max(0, float(os.environ.get(name, default)))
+    except ValueError:
+        return default
+
+COLD_AFTER_HOURS = _env_number('COLD_AFTER_HOURS', 2)
+RECOMPRESS_CPU_SHARE = min(1, _env_number('RECOMPRESS_CPU_SHARE', 0.25)) or 0.25
+RECOMPRESS_PRESET = int(_env_number('RECOMPRESS_PRESET', 6))
+RECOMPRESS_MIN_SAVING = _env_number('RECOMPRESS_MIN_SAVING', 0.05)
+RECOMPRESS_MAX_LOAD = _env_number('RECOMPRESS_MAX_LOAD', 0.75)
+RECOMPRESS_INTERVAL = _env_number('RECOMPRESS_INTERVAL', 600)
+# Larger files go out as stored, see the download paths
+MAX_ORIGINAL_SIZE = 100 * 1024 * 1024
+IDLE_POLL_SECONDS = 0.5
+
+XZ_MAGIC = b'\xfd7zXZ\x00'
+
+def decompress(payload):
+    """Original content of a gzip or xz payload"""
+    if payload[:6] == XZ_MAGIC:
+        return lzma.decompress(payload)
+    return gzip.decompress(payload)
+
+def unxz_chunks(chunks):
+    """Decompress an xz stream chunk by chunk"""
+    decompressor = lzma.LZMADecompressor()
+    for chunk in chunks:
+        data = decompressor.decompress(chunk, SPILL_CHUNK_SIZE)
+        while data:
+            yield data
+            data = b'' if decompressor.needs_input or decompressor.eof else decompressor.decompress(b'', SPILL_CHUNK_SIZE)
+    if not decompressor.eof:
+        raise lzma.LZMAError("Truncated xz stream")
+
+def decompress_chunks(chunks):
+    """Decompress a gzip or xz stream chunk by chunk"""
+    chunks = iter(chunks)
+    head = b''
+    for chunk in chunks:
+        head += chunk
+        if len(head) >= len(XZ_MAGIC):
+            break
+
+    def rest():
+        yield head
+        yield from chunks
+    return unxz_chunks(rest()) if head[:6] == XZ_MAGIC else gunzip_chunks(rest())
+
+def system_busy(max_load=RECOMPRESS_MAX_LOAD):
+    """Whether this process has transfers in flight or the machine is loaded"""
+    if transfers_in_flight():
+        return True
+    try:
+        return os.getloadavg()[0] > max_load * (os.cpu_count() or 1)
+    except (AttributeError, OSError):
+        return False
+
+class Stopped(Exception):
+    """The worker was stopped halfway through a file"""
+
+class Recompressor(threading.Thread):
+    """Re-encodes cold gzip files with xz while the server is idle.
+
+    last_downloads(file IDs) returns their last download times, busy()
+    whether to hold off.
+    """
+
+    def __init__(self, file_store, key, last_downloads, busy=system_busy, cold_after=COLD_AFTER_HOURS * 3600,
+                 cpu_share=RECOMPRESS_CPU_SHARE, preset=RECOMPRESS_PRESET, min_saving=RECOMPRESS_MIN_SAVING,
+                 interval=RECOMPRESS_INTERVAL, spill_dir=None):
+        super().__init__(daemon=True, name='recompressor')
+        self.file_store = file_store
+        self.key = key
+        self.last_downloads = last_downloads
+        self.busy = busy
+        self.cold_after = cold_after
+        self.cpu_share = cpu_share
+        self.preset = preset
+        self.min_saving = min_saving
+        self.interval = interval
+        self.spill_dir = spill_dir
+        self.stopped = threading.Event()
+        self._lock = threading.Lock()
+        self.current = None
+        self.recompressed = 0
+        self.kept = 0
+        self.failed = 0
+        self.bytes_saved = 0
+        self.paused_seconds = 0.0
+        self.throttled_seconds = 0.0
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.run_once()
+            except Stopped:
+                break
+            except Exception as e:
+                print(f"⚠️ Recompression error: {e}")
+
+    def stop(self):
+        self.stopped.set()
+
+    def read_metadata(self, filename):
+        try:
+            return json.loads(self.file_store.get_bytes(f"{filename}.meta"))
+        except Exception:
+            return {}
+
+    def cold_files(self, now=None):
+        """(name, stat, metadata) of gzip files not downloaded for cold_after seconds, coldest first"""
+        now = now or datetime.now()
+        candidates = []
+        for filename, info in list(self.file_store.list()):
+            metadata = self.read_metadata(filename)
+            if (not metadata.get('was_compressed') or metadata.get('tier') == 'cold' or 'state' in metadata
+                    or metadata.get('original_size', 0) > MAX_ORIGINAL_SIZE):
+                continue
+            candidates.append((filename, info, metadata))
+        downloads = self.last_downloads(m['file_id'] for _, _, m in candidates if m.get('file_id'))
+        cold = []
+        for filename, info, metadata in candidates:
+            try:
+                last_used = datetime.fromisoformat(metadata['upload_time'])
+            except (KeyError, ValueError):
+                last_used = datetime.fromtimestamp(info['mtime'])
+            last_used = max(last_used, downloads.get(metadata.get('file_id'), last_used))
+            idle = (now - last_used).total_seconds()
+            if idle >= self.cold_after:
+                cold.append((idle, filename, info, metadata))
+        cold.sort(key=lambda item: item[0], reverse=True)
+        return [(filename, info, metadata) for _, filename, info, metadata in cold]
+
+    def run_once(self):
+        """Recompress every file that is cold now, returns how many were swapped"""
+        swapped = 0
+        for filename, info, metadata in self.cold_files():
+            self.wait_idle()
+            try:
+                swapped += self.recompress(filename, info, metadata)
+            except Stopped:
+                raise
+            except Exception as e:
+                print(f"⚠️ Recompression failed for {filename}: {e}")
+                with self._lock:
+                    self.failed += 1
+        return swapped
+
+    def wait_idle(self):
+        """Block while the server is busy"""
+        started = None
+        while not self.stopped.is_set() and self.busy():
+            started = started or time.monotonic()
+            self.stopped.wait(IDLE_POLL_SECONDS)
+        if started is not None:
+            with self._lock:
+                self.paused_seconds += time.monotonic() - started
+        if self.stopped.is_set():
+            raise Stopped()
+
+    def throttled(self, chunks):
+        """Pass chunks through, sleeping after each to stay within the CPU share and pausing under load"""
+        used_before = time.thread_time()
+        for chunk in chunks:
+            yield chunk
+            # Reading, decrypting, decompressing and compressing all run on this thread
+            used = time.thread_time() - used_before
+            pause = used * (1 / self.cpu_share - 1)
+            if pause > 0:
+                self.stopped.wait(pause)
+                with self._lock:
+                    self.throttled_seconds += pause
+            self.wait_idle()
+            used_before = time.thread_time()
+
+    def recompress(self, filename, info, metadata):
+        """Re-encode one file with xz, returns whether it was swapped in"""
+        with self._lock:
+            self.current = filename
+        try:
+            target = tempfile.TemporaryFile(dir=self.spill_dir)
+            try:
+                compressor = lzma.LZMACompressor(preset=self.preset)
+                chunks = decompress_chunks(decrypt_stream(self.key, self.file_store.get_stream(filename)))
+                for chunk in self.throttled(chunks):
+                    target.write(compressor.compress(chunk))
+                target.write(compressor.flush())
+                size = target.tell()
+                old_size = metadata.get('compressed_size', info['size'])
+                if size > old_size * (1 - self.min_saving):
+                    self.update_metadata(filename, tier='cold')
+                    with self._lock:
+                        self.kept += 1
+                    return False
+                target.seek(0)
+                # Same mtime, the swap must not postpone the 24h expiry
+                stored_size = self.file_store.put_stream(filename, encrypt_stream(self.key, iter_file(target)),
+                                                         token_size(size), mtime=info['mtime'])
+            finally:
+                target.close()
+            if not self.update_metadata(filename, codec='xz', tier='cold', compressed_size=size, stored_size=stored_size):
+                # Deleted while it was recompressed
+                self.file_store.delete(filename)
+                return False
+            with self._lock:
+                self.recompressed += 1
+                self.bytes_saved += old_size - size
+            print(f"🧊 Recompressed cold file {filename}: {old_size} -> {size} bytes")
+            return True
+        finally:
+            with self._lock:
+                self.current = None
+
+    def update_metadata(self, filename, **fields):
+        """Change fields of a file's metadata, False if the file is gone"""
+        metadata = self.read_metadata(filename)
+        if not metadata:
+            return False
+        metadata.update(fields)
+        self.file_store.put_bytes(f"{filename}.meta", json.dumps(metadata).encode())
+        if self.file_store.stat(filename) is None:
+            # Deleted in between, drop the sidecar written back
+            self.file_store.delete(f"{filename}.meta")
+            return False
+        return True
+
+    def stats(self):
+        with self._lock:
+            return {
+                'cold_after_seconds': self.cold_after,
+                'cpu_share': self.cpu_share,
+                'recompressing': self.current is not None,
+                'recompressed': self.recompressed,
+                'kept': self.kept,
+                'failed': self.failed,
+                'bytes_saved': self.bytes_saved,
+                'paused_seconds': round(self.paused_seconds, 3),
+                'throttled_seconds': round(self.throttled_seconds, 3)
+            }
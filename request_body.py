@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+Raw request body reading for the http.server based server
+
+Handles both Content-Length and Transfer-Encoding: chunked bodies, yielding
+the payload in chunks as it comes off the socket.
+"""
+
+CHUNK_SIZE = 1024 * 1024  # 1MB
+
+class RequestBodyError(Exception):
+    """Malformed or oversized request body, carries the HTTP status to answer with"""
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+def _iter_length(stream, length, chunk_size):
+    remaining = length
+    while remaining > 0:
+        data = stream.read(min(chunk_size, remaining))
+        if not data:
+            raise RequestBodyError("Request body ended early")
+        remaining -= len(data)
+        yield data
+
+def _iter_chunked(stream, max_size, chunk_size):
+    total = 0
+    while True:
+        line = stream.readline(1024)
+        if not line.endswith(b'\r\n'):
+            raise RequestBodyError("Malformed chunk header")
+        try:
+            size = int(line.split(b';', 1)[0].strip(), 16)
+        except ValueError:
+            raise RequestBodyError("Malformed chunk size")
+        if size == 0:
+            # Skip the trailer section
+            while True:
+                line = stream.readline(1024)
+                if line in (b'\r\n', b'\n', b''):
+                    return
+        total += size
+        if total > max_size:
+            raise RequestBodyError("Request body too large", 413)
+        yield from _iter_length(stream, size, chunk_size)
+        if stream.read(2) != b'\r\n':
+            raise RequestBodyError("Malformed chunk terminator")
+
+def iter_request_body(stream, headers, max_size, chunk_size=CHUNK_SIZE):
+    """Yield the body of a request from its Content-Length or chunked encoding"""
+    if 'chunked' in headers.get('Transfer-Encoding', '').lower():
+        return _iter_chunked(stream, max_size, chunk_size)
+
+    try:
+        length = int(headers.get('Content-Length', ''))
+    except ValueError:
+        raise RequestBodyError("Content-Length or chunked encoding required", 411)
+    if length < 0:
+        raise RequestBodyError("Invalid Content-Length")
+    if length > max_size:
+        raise RequestBodyError("Request body too large", 413)
+    return _iter_length(stream, length, chunk_size)
@@ -5,31 +5,56 @@ import socket
 import time
 import threading
 import uuid
-import hashlib
-import base64
 import secrets
-import gzip
-import io
-import sqlite3
+import hashlib
 from datetime import datetime, timedelta
 from urllib.parse import unquote, parse_qs
 from http.server import HTTPServer, BaseHTTPRequestHandler
 from socketserver import ThreadingMixIn
-import cgi
-import shutil
-import mimetypes
+import signal
+import argparse
 from cryptography.fernet import Fernet
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from content_cache import ContentCache, SingleFlight
+from analytics_db import AnalyticsDB
+from change_feed import ChangeFeed, sse_message
+from storage import create_storage, iter_chunks, StorageError
+from multipart_stream import MultipartReader, get_boundary
+from request_body import RequestBodyError, iter_request_body
+from checksums import StreamDigest, expected_sha256, content_digest, etag_for, etag_matches
+from bandwidth import BandwidthManager
+from metrics import (REGISTRY, ENCRYPTION_SECONDS, CountingReader,
+                     CountingWriter, route_of, request_started, request_finished, stats_families)
+from memory_governor import (MemoryGovernor, upload_cost, decode_cost, iter_file, should_compress_file,
+                             compress_file_data, compress_spooled_file, close_spill, plaintext_chunks)
+from fernet_stream import encrypt_stream, token_size
+from profiling import StageTimer, sample_stacks, MAX_PROFILE_SECONDS, DEFAULT_INTERVAL
+from delta import DeltaReader, DeltaError, block_size_for
+from processing import ProcessingQueue, is_staged
+from stored_files import (StoredFiles, file_entry, upload_error_status, list_stored_files, in_flight,
+                          decompress_file_data)
+from compression_control import COMPRESSION_LEVEL
+from recompression import Recompressor, system_busy, COLD_AFTER_HOURS
+from preview import ThumbnailWorker, preview_kind, THUMBNAIL_MAX_SOURCE_BYTES
 
 class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
     """Handle requests in a separate thread."""
-    pass
+    # Event streams never finish on their own, they must not keep the process alive
+    daemon_threads = True
+    
+    def __init__(self, server_address, handler_class, app=None):
+        # Handlers reach the shared state through self.server.app
+        self.app = app if app is not None else create_app()
+        super().__init__(server_address, handler_class)
+
+class ReusePortHTTPServer(ThreadedHTTPServer):
+    """Threaded server that shares its port with sibling worker processes."""
+    def server_bind(self):
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
 
 # Persistent key generation for encryption purposes
-def get_or_create_key():
+def get_or_create_key(key_file='encryption.key'):
     """Get existing key or create new one and save it"""
-    key_file = 'encryption.key'
     if os.path.exists(key_file):
         with open(key_file, 'rb') as f:
             return f.read()
@@ -39,176 +64,223 @@ def get_or_create_key():
             f.write(key)
         return key
 
-KEY = get_or_create_key()
-fernet = Fernet(KEY)
-
-# Advanced Analytics Database
-class AnalyticsDB:
-    def __init__(self):
-        self.db_path = 'analytics.db'
-        self.init_db()
-    
-    def init_db(self):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS uploads (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                filename TEXT,
-                file_size INTEGER,
-                file_type TEXT,
-                upload_time TIMESTAMP,
-                ip_address TEXT,
-                compressed_size INTEGER,
-                download_count INTEGER DEFAULT 0,
-                is_compressed BOOLEAN DEFAULT 0
-            )
-        ''')
-        conn.commit()
-        conn.close()
-    
-    def log_upload(self, filename, file_size, file_type, ip_address, compressed_size, is_compressed):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO uploads (filename, file_size, file_type, upload_time, ip_address, compressed_size, is_compressed)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (filename, file_size, file_type, datetime.now(), ip_address, compressed_size, is_compressed))
-        conn.commit()
-        conn.close()
-    
-    def increment_download(self, filename):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('UPDATE uploads SET download_count = download_count + 1 WHERE filename = ?', (filename,))
-        conn.commit()
-        conn.close()
-    
-    def get_stats(self):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # Total files and size
-        cursor.execute('SELECT COUNT(*), SUM(file_size), SUM(compressed_size) FROM uploads')
-        total_files, total_size, total_compressed = cursor.fetchone()
-        
-        # Today's uploads
-        today = datetime.now().date()
-        cursor.execute('SELECT COUNT(*) FROM uploads WHERE DATE(upload_time) = ?', (today,))
-        today_uploads = cursor.fetchone()[0]
-        
-        # Popular file types
-        cursor.execute('SELECT file_type, COUNT(*) FROM uploads GROUP BY file_type ORDER BY COUNT(*) DESC LIMIT 5')
-        popular_types = cursor.fetchall()
-        
-        conn.close()
-        
-        return {
-            'total_files': total_files or 0,
-            'total_size': total_size or 0,
-            'total_compressed': total_compressed or 0,
-            'today_uploads': today_uploads or 0,
-            'popular_types': popular_types,
-            'compression_ratio': round((1 - (total_compressed or 1) / (total_size or 1)) * 100, 1) if total_size else 0
-        }
-
-analytics = AnalyticsDB()
-
 # A simple token generator for user session management
 def generate_token():
     return secrets.token_urlsafe(16)
 
-# Improved file compression with better error handling
-def should_compress_file(filename, data_size):
-    """Determine if file should be compressed based on type and size"""
-    # Don't compress already compressed formats
-    compressed_formats = {'.jpg', '.jpeg', '.png', '.gif', '.mp4', '.mp3', '.zip', '.rar', '.7z', '.gz', '.bz2'}
-    ext = os.path.splitext(filename)[1].lower()
-    
-    # Don't compress if already compressed format
-    if ext in compressed_formats:
-        return False
-    
-    # Don't compress very small files (less than 1KB)
-    if data_size < 1024:
-        return False
-    
-    # Don't compress very large files (more than 100MB) to avoid memory issues
-    if data_size > 100 * 1024 * 1024:
-        return False
-    
-    return True
-
-def compress_file_data(data, filename):
-    """Compress file data if beneficial"""
-    if not should_compress_file(filename, len(data)):
-        return data, len(data), False
-    
-    try:
-        compressed = gzip.compress(data, compresslevel=6)
-        # Only use compression if it saves at least 10% of space
-        if len(compressed) < len(data) * 0.9:
-            return compressed, len(compressed), True
-        else:
-            return data, len(data), False
-    except Exception as e:
-        print(f"⚠️ Compression failed for {filename}: {e}")
-        return data, len(data), False
-
-def decompress_file_data(data, filename, was_compressed):
-    """Decompress file data if it was compressed"""
-    if not was_compressed:
-        return data
-    
-    try:
-        return gzip.decompress(data)
-    except Exception as e:
-        print(f"⚠️ Decompression failed for {filename}: {e}")
-        return data  # Fallback to original if decompression fails
-
 def add_file_expiry(filepath, hours=24):
     expiry_time = datetime.now() + timedelta(hours=hours)
     os.utime(filepath, (expiry_time.timestamp(), expiry_time.timestamp()))
 
 class FileCleaner(threading.Thread):
+    def __init__(self, app):
+        super().__init__(daemon=True)
+        self.app = app
+        self.stopped = threading.Event()
+    
     def run(self):
-        while True:
+        app = self.app
+        while not self.stopped.is_set():
             try:
                 now = time.time()
-                if os.path.exists('uploads'):
-                    for filename in os.listdir('uploads'):
-                        filepath = os.path.join('uploads', filename)
-                        if os.path.isfile(filepath) and not filename.endswith('.token') and not filename.endswith('.meta'):
-                            # Check if file is older than 24 hours
-                            file_age = now - os.path.getctime(filepath)
-                            if file_age > 86400:  # 24 hours in seconds
-                                os.remove(filepath)
-                                # Also remove associated files
-                                for ext in ['.token', '.meta']:
-                                    associated_file = f"{filepath}{ext}"
-                                    if os.path.exists(associated_file):
-                                        os.remove(associated_file)
-                                print(f"🗑️ Auto-deleted (24h): {filename}")
+                expired = []
+                for filename, info in list(app.file_store.list()):
+                    # Check if file is older than 24 hours
+                    file_age = now - info['mtime']
+                    if file_age > 86400:  # 24 hours in seconds
+                        if in_flight(app.file_store, filename):
+                            # Reserved by an upload that never finished, it was never listed
+                            app.file_store.delete(filename)
+                            print(f"🗑️ Removed abandoned upload: {filename}")
+                            continue
+                        # Remove the file and its associated files
+                        app.processing.discard(filename)
+                        for key in [filename, f"{filename}.token", f"{filename}.meta"]:
+                            app.file_store.delete(key)
+                        app.content_cache.invalidate(filename)
+                        app.signatures.invalidate(filename)
+                        app.thumbnails.invalidate(filename)
+                        expired.append(('expire', filename, None))
+                        print(f"🗑️ Auto-deleted (24h): {filename}")
+                app.changes.publish_many(expired)
+                app.changes.trim()
+                
+                # Fold old raw analytics rows away, the rollups keep their totals
+                removed = app.analytics.compact()
+                if removed:
+                    print(f"📊 Compacted {removed} old analytics rows")
             except Exception as e:
                 print(f"⚠️ Cleaner error: {e}")
-            time.sleep(3600)  # Check every hour
+            self.stopped.wait(3600)  # Check every hour
 
-# Start cleaner thread
-cleaner = FileCleaner()
-cleaner.daemon = True
-cleaner.start()
+class TransferApp:
+    """Configuration and shared state of the server.
+    
+    Creating an app does no I/O. The key, the analytics database and the
+    storage backend are opened on first use, or all at once by init().
+    start() launches the background services.
+    """
+    
+    def __init__(self, key_file='encryption.key', db_path='analytics.db', upload_dir='uploads', admin_token=None):
+        self.key_file = key_file
+        self.db_path = db_path
+        self.upload_dir = upload_dir
+        self.admin_token = admin_token
+        # Reentrant, the Fernet is built from the key inside the lock
+        self._lock = threading.RLock()
+        self._resources = {}
+        self.cleaner = None
+        self.recompressor = None
+        
+        # Decoded payloads of popular small files
+        self.content_cache = ContentCache()
+        self.decode_flights = SingleFlight()
+        
+        # Block signatures for delta uploads, a few bytes per 2-64KB block
+        self.signatures = ContentCache(32 * 1024 * 1024, 32 * 1024 * 1024)
+        
+        # Image thumbnails, rendered in the background and cached
+        self.thumbnails = ThumbnailWorker()
+        
+        # Download rate limits, adjustable at runtime through /bandwidth
+        self.bandwidth = BandwidthManager()
+        
+        # Memory budget of transfers decoding whole files, the rest spills to disk
+        self.memory = MemoryGovernor()
+        
+        # Compression and encryption of uploads after they are acknowledged, see processing.py
+        self.processing = ProcessingQueue(upload_dir, lambda filename: self.files.process_staged(filename))
+    
+    def _resource(self, name, create):
+        """Create a shared resource once, on first use"""
+        resource = self._resources.get(name)
+        if resource is None:
+            with self._lock:
+                resource = self._resources.get(name)
+                if resource is None:
+                    resource = self._resources[name] = create()
+        return resource
+    
+    @property
+    def key(self):
+        return self._resource('key', lambda: get_or_create_key(self.key_file))
+    
+    @property
+    def fernet(self):
+        return self._resource('fernet', lambda: Fernet(self.key))
+    
+    @property
+    def analytics(self):
+        return self._resource('analytics', lambda: AnalyticsDB(self.db_path))
+    
+    @property
+    def changes(self):
+        # File list change events, kept next to the analytics tables
+        return self._resource('changes', lambda: ChangeFeed(self.db_path))
+    
+    @property
+    def file_store(self):
+        # Local disk unless STORAGE_BACKEND says otherwise
+        return self._resource('file_store', lambda: create_storage(self.upload_dir))
+    
+    @property
+    def files(self):
+        # Decoding and processing of stored files, shared with simple_server.py
+        return self._resource('files', lambda: StoredFiles(
+            self.file_store, self.key, self.fernet, self.content_cache, self.decode_flights, self.signatures,
+            self.memory, self.processing, self.analytics, self.changes))
+    
+    def init(self):
+        """Open the key, database and storage now instead of on the first request"""
+        self.fernet
+        self.analytics
+        self.changes
+        self.file_store
+        self.files
+        return self
+    
+    def start(self):
+        """Start the expiry cleaner and cold file recompression, resume processing staged uploads"""
+        if self.cleaner is None:
+            self.cleaner = FileCleaner(self)
+            self.cleaner.start()
+            if COLD_AFTER_HOURS > 0:
+                self.recompressor = Recompressor(self.file_store, self.key, self.analytics.last_downloads,
+                                                 busy=self.busy, spill_dir=self.memory.spill_dir)
+                self.recompressor.start()
+            staged = self.processing.staged_names()
+            if staged:
+                print(f"⚙️ Resuming processing of {len(staged)} staged uploads")
+            for filename in staged:
+                self.processing.submit(filename)
+        return self
+    
+    def stop(self):
+        if self.cleaner is not None:
+            self.cleaner.stopped.set()
+            self.cleaner = None
+        if self.recompressor is not None:
+            self.recompressor.stop()
+            self.recompressor = None
+        self.processing.stop()
+    
+    def busy(self):
+        """Whether background work should hold off: transfers in flight, uploads being processed or high load"""
+        return system_busy() or self.processing.backlog() > 0
+    
+def create_app(key_file='encryption.key', db_path=None, upload_dir='uploads'):
+    """Build the application from its configuration, nothing is opened yet"""
+    db_path = db_path or os.environ.get('ANALYTICS_DB', 'analytics.db')
+    return TransferApp(key_file=key_file, db_path=db_path, upload_dir=upload_dir,
+                       admin_token=os.environ.get('ADMIN_TOKEN'))
 
 class FileTransferHandler(BaseHTTPRequestHandler):
-    def __init__(self, *args, **kwargs):
-        self.upload_dir = "uploads"
-        if not os.path.exists(self.upload_dir):
-            os.makedirs(self.upload_dir)
-        super().__init__(*args, **kwargs)
+    @property
+    def app(self):
+        """The TransferApp of the server this request came in on"""
+        return self.server.app
     
     def setup(self):
         """Set up connection with timeout"""
         super().setup()
         self.request.settimeout(300)  # 5 minute timeout for large uploads
+        # Byte counts for /metrics, taken once per request
+        self.rfile = CountingReader(self.rfile)
+        self.wfile = CountingWriter(self.wfile)
+    
+    def handle_one_request(self):
+        self.route = None
+        self.status_code = 0
+        self.timer = None
+        try:
+            super().handle_one_request()
+        finally:
+            if self.route is not None:
+                request_finished(self.command, self.route, self.status_code, time.perf_counter() - self.started,
+                                 self.rfile.take(), self.wfile.take())
+            if self.timer is not None and self.timer.stages:
+                print(self.timer.log_line(self.command, self.path, self.status_code))
+    
+    def parse_request(self):
+        if not super().parse_request():
+            return False
+        self.started = time.perf_counter()
+        self.route = route_of(self.path)
+        self.timer = StageTimer()
+        request_started(self.route)
+        return True
+    
+    def send_response_only(self, code, message=None):
+        # 100 Continue is not the answer to the request
+        if code >= 200:
+            self.status_code = code
+        super().send_response_only(code, message)
+    
+    def end_headers(self):
+        # Stages so far, whatever runs after the headers only reaches the log line
+        if self.status_code and self.timer is not None:
+            self.send_header('Server-Timing', self.timer.header())
+        super().end_headers()
     
     def log_message(self, format, *args):
         """Override to reduce console spam"""
@@ -223,22 +295,81 @@ class FileTransferHandler(BaseHTTPRequestHandler):
             self.serve_file('sw.js', 'application/javascript')
         elif self.path == '/files':
             self.list_files()
-        elif self.path == '/analytics':
-            self.get_analytics()
+        elif self.path == '/analytics' or self.path.startswith('/analytics?'):
+            self.get_analytics(parse_qs(self.path.partition('?')[2]))
         elif self.path == '/health':
             self.health_check()
+        elif self.path == '/events' or self.path.startswith('/events?'):
+            self.stream_events(parse_qs(self.path.partition('?')[2]))
+        elif self.path == '/changes' or self.path.startswith('/changes?'):
+            self.poll_changes(parse_qs(self.path.partition('?')[2]))
+        elif self.path == '/cache-stats':
+            self.get_cache_stats()
+        elif self.path == '/metrics':
+            self.get_metrics()
+        elif self.path == '/bandwidth':
+            self.get_bandwidth()
+        elif self.path == '/memory':
+            self.get_memory()
         elif self.path.startswith('/download/'):
             filename = unquote(self.path[10:])  # Remove '/download/'
             self.download_file(filename)
+        elif self.path == '/download-archive' or self.path.startswith('/download-archive?'):
+            query = parse_qs(self.path.partition('?')[2])
+            self.download_archive(query.get('name', []))
         elif self.path.startswith('/preview/'):
             filename = unquote(self.path[9:])  # Remove '/preview/'
             self.preview_file(filename)
+        elif self.path.startswith('/signature/'):
+            filename = unquote(self.path[11:])  # Remove '/signature/'
+            self.get_signature(filename)
+        elif self.path.startswith('/status/'):
+            filename = unquote(self.path[8:])  # Remove '/status/'
+            self.get_status(filename)
+        else:
+            self.send_error(404)
+    
+    def do_HEAD(self):
+        if self.path.startswith('/download/'):
+            filename = unquote(self.path[10:])  # Remove '/download/'
+            self.head_download(filename)
         else:
             self.send_error(404)
     
     def do_POST(self):
         if self.path == '/upload':
             self.upload_file()
+        elif self.path == '/bandwidth':
+            self.set_bandwidth()
+        elif self.path == '/profile' or self.path.startswith('/profile?'):
+            self.run_profile(parse_qs(self.path.partition('?')[2]))
+        elif self.path == '/download-archive':
+            try:
+                content_length = int(self.headers.get('Content-Length', 0))
+                names = json.loads(self.rfile.read(content_length) or b'{}').get('names', [])
+            except (ValueError, AttributeError):
+                self.send_error(400, "Bad Request: Expected JSON {\"names\": [...]}")
+                return
+            self.download_archive(names)
+        else:
+            self.send_error(404)
+    
+    def do_PUT(self):
+        if self.path.startswith('/upload/'):
+            filename = unquote(self.path[8:])  # Remove '/upload/'
+            self.upload_raw(filename)
+        elif self.path.startswith('/delta/'):
+            filename, _, query = self.path[7:].partition('?')  # Remove '/delta/'
+            self.upload_delta(unquote(filename), parse_qs(query))
+        else:
+            self.send_error(404)
+    
+    def do_OPTIONS(self):
+        # Lets the frontend detect raw PUT uploads
+        if self.path.startswith('/upload/'):
+            self.send_response(204)
+            self.send_header('Allow', 'OPTIONS, PUT')
+            self.end_headers()
         else:
             self.send_error(404)
     
@@ -281,185 +412,428 @@ class FileTransferHandler(BaseHTTPRequestHandler):
                 self.send_error(413, "File too large. Maximum size is 5GB")
                 return
             
-            # Parse form data using a simpler approach
+            # Refuse before receiving anything the disk cannot hold
             try:
-                # Read the entire request body first
-                request_body = self.rfile.read(content_length)
-                
-                # Find the boundary
-                boundary = None
-                for line in content_type.split(';'):
-                    if 'boundary=' in line:
-                        boundary = line.split('=')[1].strip()
-                        break
-                
-                if not boundary:
-                    self.send_error(400, "No boundary found in content type")
+                self.app.file_store.ensure_space(token_size(content_length))
+            except StorageError as e:
+                self.send_error(e.status, str(e))
+                return
+            
+            boundary = get_boundary(content_type)
+            if not boundary:
+                self.send_error(400, "No boundary found in content type")
+                return
+            
+            # Files are stored one by one as their parts arrive, analytics
+            # rows are written together once the whole batch is in
+            results = []
+            uploads = []
+            added = []
+            reservation = self.app.memory.reserve(upload_cost(content_length))
+            try:
+                for part in MultipartReader(self.rfile, boundary, content_length):
+                    if not part.filename:
+                        continue
+                    digest = StreamDigest()
+                    with self.timer.stage('parse'):
+                        file_data = self.buffer_upload(part.chunks, digest, reservation)
+                    try:
+                        if not digest.size:
+                            continue
+                        result, upload, entry = self.store_upload(part.filename, file_data, digest,
+                                                                  expected_sha256(part.headers))
+                    finally:
+                        close_spill(file_data)
+                    results.append(result)
+                    if upload:
+                        uploads.append(upload)
+                    if entry:
+                        added.append(('add', entry['name'], entry))
+            except ValueError as e:
+                print(f"❌ Multipart parsing error: {e}")
+                if not results:
+                    self.send_error(400, f"Request parsing failed: {str(e)}")
+                    return
+                results.append({"status": "error", "error": f"Request parsing failed: {str(e)}"})
+            finally:
+                if reservation is not None:
+                    reservation.release()
+            
+            if uploads:
+                with self.timer.stage('analytics'):
+                    self.app.analytics.log_uploads(uploads)
+            if added:
+                with self.timer.stage('events'):
+                    self.app.changes.publish_many(added)
+            
+            if not results:
+                self.send_error(400, "No file found in request")
+                return
+            stored = [r for r in results if r['status'] == 'success']
+            if not stored:
+                self.send_error(upload_error_status(results[0]), results[0]['error'])
+                return
+            
+            # The first file's fields stay at the top level for single-file clients
+            first = stored[0]
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('X-Owner-Token', first['owner_token'])
+            self.end_headers()
+            response = json.dumps(dict(
+                first,
+                status="success" if len(stored) == len(results) else "partial",
+                files=results
+            ))
+            self.wfile.write(response.encode())
+            
+        except Exception as e:
+            print(f"❌ Upload error: {str(e)}")
+            self.send_error(500, f"Internal Server Error: {str(e)}")
+    
+    def upload_raw(self, filename):
+        """Store a file sent as the raw request body, no multipart framing"""
+        try:
+            if not filename:
+                self.send_error(400, "Bad Request: No filename")
+                return
+            
+            # Chunked bodies have no size up front, they always go to disk
+            declared = self.headers.get('Content-Length', '')
+            reservation = None
+            if declared.isdigit() and 'chunked' not in self.headers.get('Transfer-Encoding', '').lower():
+                try:
+                    self.app.file_store.ensure_space(token_size(int(declared)))
+                except StorageError as e:
+                    self.send_error(e.status, str(e))
+                    return
+                reservation = self.app.memory.reserve(upload_cost(int(declared)))
+            
+            # Answer curl's Expect header instead of letting it wait for a timeout
+            if self.headers.get('Expect', '').lower() == '100-continue':
+                self.send_response_only(100)
+                self.end_headers()
+            
+            digest = StreamDigest()
+            file_data = None
+            try:
+                try:
+                    chunks = iter_request_body(self.rfile, self.headers, 5 * 1024 * 1024 * 1024)
+                    with self.timer.stage('receive'):
+                        file_data = self.buffer_upload(chunks, digest, reservation)
+                except RequestBodyError as e:
+                    print(f"❌ Raw upload error: {e}")
+                    self.send_error(e.status, str(e))
                     return
                 
-                # Parse the multipart data manually
-                parts = request_body.split(b'--' + boundary.encode())
-                
-                # Find the file part
-                file_data = None
-                filename = None
-                
-                for part in parts:
-                    if b'Content-Disposition: form-data; name="file"' in part:
-                        # Extract filename
-                        lines = part.split(b'\r\n')
-                        for line in lines:
-                            if b'filename=' in line:
-                                filename = line.split(b'filename=')[1].strip(b'"').decode('utf-8')
-                                break
-                        
-                        # Extract file data (everything after the double CRLF)
-                        file_data = part.split(b'\r\n\r\n', 1)[1]
-                        # Remove trailing CRLF
-                        if file_data.endswith(b'\r\n'):
-                            file_data = file_data[:-2]
-                        break
-                
-                if not file_data or not filename:
-                    self.send_error(400, "No file found in request")
+                result, upload, entry = self.store_upload(filename, file_data, digest, expected_sha256(self.headers))
+            finally:
+                close_spill(file_data)
+                if reservation is not None:
+                    reservation.release()
+            if not entry:
+                self.send_error(upload_error_status(result), result['error'])
+                return
+            if upload:
+                with self.timer.stage('analytics'):
+                    self.app.analytics.log_uploads([upload])
+            with self.timer.stage('events'):
+                self.app.changes.publish('add', entry['name'], entry)
+            
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('X-Owner-Token', result['owner_token'])
+            self.end_headers()
+            self.wfile.write(json.dumps(result).encode())
+            
+        except Exception as e:
+            print(f"❌ Upload error: {str(e)}")
+            self.send_error(500, f"Internal Server Error: {str(e)}")
+    
+    def get_signature(self, filename):
+        """Block signature of a stored file, the first step of a delta upload"""
+        try:
+            info = self.app.file_store.stat(filename)
+            if info is None:
+                self.send_error(404, "File not found")
+                return
+            with self.timer.stage('signature'):
+                signature = self.app.files.file_signature(filename, info)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(len(signature)))
+            self.end_headers()
+            self.wfile.write(signature)
+        except Exception as e:
+            print(f"❌ Signature error: {str(e)}")
+            self.send_error(500)
+    
+    def get_status(self, filename):
+        """Processing state of an uploaded file: queued, processing, done or failed"""
+        try:
+            status = self.app.processing.status(filename)
+            if status is None:
+                # Not processed by this process since it started
+                metadata = self.app.files.read_metadata(filename)
+                if not metadata and self.app.file_store.stat(filename) is None:
+                    self.send_error(404, "File not found")
                     return
-                    
-            except Exception as e:
-                print(f"❌ Manual parsing error: {e}")
-                self.send_error(400, f"Request parsing failed: {str(e)}")
+                status = {'name': filename, 'state': 'queued' if is_staged(metadata) else 'done'}
+            
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.end_headers()
+            self.wfile.write(json.dumps(status).encode())
+            
+        except Exception as e:
+            print(f"❌ Status error: {str(e)}")
+            self.send_error(500)
+    
+    def upload_delta(self, filename, query):
+        """Store a new version of a file, rebuilt from a delta against a stored one (see delta.py)"""
+        try:
+            base = query.get('base', [''])[0]
+            if not filename:
+                self.send_error(400, "Bad Request: No filename")
+                return
+            info = self.app.file_store.stat(base) if base else None
+            if info is None:
+                self.send_error(404, "Base file not found")
                 return
+            metadata = self.app.files.read_metadata(base)
             
-            # Sanitize filename
-            filename = "".join(c for c in filename if c.isalnum() or c in (' ', '.', '_', '-')).rstrip()
+            if self.headers.get('Expect', '').lower() == '100-continue':
+                self.send_response_only(100)
+                self.end_headers()
             
-            filepath = os.path.join(self.upload_dir, filename)
+            try:
+                reader = DeltaReader(iter_request_body(self.rfile, self.headers, 5 * 1024 * 1024 * 1024))
+            except RequestBodyError as e:
+                self.send_error(e.status, str(e))
+                return
+            except DeltaError as e:
+                self.send_error(400, f"Bad Request: {str(e)}")
+                return
             
-            # Handle duplicate filenames
-            counter = 1
-            original_filepath = filepath
-            while os.path.exists(filepath):
-                name, ext = os.path.splitext(original_filepath)
-                filepath = f"{name}_{counter}{ext}"
-                counter += 1
-            
-            # Generate unique owner token
-            owner_token = generate_token()
+            # A delta is cheap to send, the version it rebuilds must still fit
+            try:
+                self.app.file_store.ensure_space(token_size(reader.size))
+            except StorageError as e:
+                self.send_error(e.status, str(e))
+                return
             
-            # Write file data directly
-            original_size = len(file_data)
+            base_sha256 = metadata.get('sha256')
+            if base_sha256 and reader.base_sha256.hex() != base_sha256:
+                self.send_error(409, "Conflict: The base file has changed, fetch its signature again")
+                return
+            
+            reservation = self.app.memory.reserve(upload_cost(reader.size))
+            base_data = base_reservation = file_data = None
             try:
-                with open(filepath, 'wb') as f:
-                    f.write(file_data)
-            except Exception as e:
-                print(f"❌ File write error: {e}")
-                self.send_error(500, f"File write failed: {str(e)}")
+                with self.timer.stage('decode'):
+                    base_data, base_size, base_reservation = self.app.files.open_plaintext(base, metadata, info)
+                if not base_sha256:
+                    # Uploaded before checksums were recorded, hash it now
+                    digest = hashlib.sha256()
+                    for chunk in plaintext_chunks(base_data):
+                        digest.update(chunk)
+                    if reader.base_sha256 != digest.digest():
+                        self.send_error(409, "Conflict: The base file has changed, fetch its signature again")
+                        return
+                if reader.block_size != block_size_for(base_size):
+                    self.send_error(400, "Bad Request: Delta block size does not match the base file")
+                    return
+                
+                digest = StreamDigest()
+                try:
+                    with self.timer.stage('apply'):
+                        file_data = self.buffer_upload(reader.apply(base_data, base_size), digest, reservation)
+                except (DeltaError, RequestBodyError) as e:
+                    print(f"❌ Delta upload error: {e}")
+                    self.send_error(getattr(e, 'status', 400), f"Bad Request: {str(e)}")
+                    return
+                close_spill(base_data)
+                base_data = None
+                
+                result, upload, entry = self.store_upload(filename, file_data, digest, expected_sha256(self.headers))
+            finally:
+                close_spill(base_data)
+                close_spill(file_data)
+                for held in (base_reservation, reservation):
+                    if held is not None:
+                        held.release()
+            if not entry:
+                self.send_error(upload_error_status(result), result['error'])
                 return
+            if upload:
+                with self.timer.stage('analytics'):
+                    self.app.analytics.log_uploads([upload])
+            with self.timer.stage('events'):
+                self.app.changes.publish('add', entry['name'], entry)
+            
+            print(f"🔁 Delta upload: {entry['name']} rebuilt from {base}, "
+                  f"received {self.get_file_size(reader.received)} for {self.get_file_size(reader.size)}")
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('X-Owner-Token', result['owner_token'])
+            self.end_headers()
+            self.wfile.write(json.dumps(dict(result, base=base, delta_bytes=reader.received)).encode())
             
+        except Exception as e:
+            print(f"❌ Delta upload error: {str(e)}")
+            self.send_error(500, f"Internal Server Error: {str(e)}")
+    
+    def buffer_upload(self, chunks, digest, reservation):
+        """Upload body in memory if its reservation was granted, else spilled to a temporary file"""
+        if reservation is not None:
+            return digest.read(chunks)
+        spill, size = self.app.memory.spool(chunks, digest)
+        print(f"💾 Memory budget spent, spilled upload to disk ({self.get_file_size(size)})")
+        return spill
+    
+    def store_upload(self, filename, file_data, digest, expected=None):
+        """Verify, compress, encrypt and store one uploaded file.
+        
+        file_data is bytes, or a temporary file when the upload spilled to
+        disk. Returns the per-file result, the analytics row and the /files
+        entry, both None on failure. With async processing the file is only
+        staged and queued, its analytics row is then left to the job.
+        """
+        original_name = filename
+        
+        # Sanitize filename, without leading dots like secure_filename() in the Flask servers
+        filename = "".join(c for c in filename if c.isalnum() or c in (' ', '.', '_', '-')).rstrip().lstrip('.')
+        if not filename:
+            return {"status": "error", "original_name": original_name, "error": "Invalid filename"}, None, None
+        
+        # Reject the file before storing anything if it did not arrive intact
+        checksums = digest.checksums()
+        if expected and expected != checksums['sha256']:
+            print(f"❌ Checksum mismatch for {filename}")
+            return {"status": "error", "original_name": original_name, "error": "Checksum mismatch"}, None, None
+        
+        stored_name = None
+        try:
+            # Handle duplicate filenames
+            stored_name = self.app.file_store.reserve(filename)
+            
+            # Generate unique owner token and the ID analytics know the file by
+            owner_token = generate_token()
+            file_id = str(uuid.uuid4())
+            
+            original_size = digest.size
+            spilled = not isinstance(file_data, bytes)
+            staged = self.app.processing.enabled
+            
+            if staged:
+                # Acknowledged once on disk, compressed and encrypted in the background
+                with self.timer.stage('stage'):
+                    self.app.processing.stage(stored_name, plaintext_chunks(file_data))
+                compressed_size = stored_size = original_size
+                was_compressed = False
             # For large files (>100MB), skip compression
-            if original_size > 100 * 1024 * 1024:
+            elif original_size > 100 * 1024 * 1024:
+                payload = file_data
                 compressed_size = original_size
                 was_compressed = False
                 print(f"📁 Large file detected ({self.get_file_size(original_size)}), skipping compression")
             else:
                 # Compress if beneficial
-                compressed_data, compressed_size, was_compressed = compress_file_data(file_data, filename)
-                
-                # If compression was beneficial, write compressed data
-                if was_compressed:
-                    with open(filepath, 'wb') as f:
-                        f.write(compressed_data)
+                with self.timer.stage('compress'):
+                    if spilled:
+                        payload, compressed_size, was_compressed = compress_spooled_file(
+                            file_data, original_size, filename, self.app.memory.spill_dir, COMPRESSION_LEVEL,
+                            self.app.processing.backlog())
+                    else:
+                        payload, compressed_size, was_compressed = compress_file_data(
+                            file_data, filename, COMPRESSION_LEVEL, self.app.processing.backlog())
+            
+            # Encrypt and write the file, for a staged upload its job does
+            if spilled and not staged:
+                # Encrypted chunk by chunk straight into storage
+                try:
+                    with self.timer.stage('encrypt'):
+                        stored_size = self.app.file_store.put_stream(stored_name,
+                                                                     encrypt_stream(self.app.key, iter_file(payload)),
+                                                                     token_size(compressed_size))
+                finally:
+                    close_spill(payload)
+            elif not staged:
+                with self.timer.stage('encrypt'), ENCRYPTION_SECONDS.labels('encrypt').time():
+                    encrypted_data = self.app.fernet.encrypt(payload)
+                with self.timer.stage('write'):
+                    self.app.file_store.put_bytes(stored_name, encrypted_data)
+                stored_size = len(encrypted_data)
             
-            # Encrypt the file
-            try:
-                with open(filepath, 'rb') as f:
-                    file_content = f.read()
-                
-                encrypted_data = fernet.encrypt(file_content)
-                
-                with open(filepath, 'wb') as f:
-                    f.write(encrypted_data)
-                        
-            except Exception as e:
-                print(f"❌ Encryption failed for {filename}: {e}")
-                if os.path.exists(filepath):
-                    os.remove(filepath)
-                self.send_error(500, "Encryption failed")
-                return
-
             # Save metadata
             metadata = {
                 'original_size': original_size,
                 'compressed_size': compressed_size,
                 'was_compressed': was_compressed,
                 'upload_time': datetime.now().isoformat(),
-                'filename': os.path.basename(filepath),
-                'owner_token': owner_token
+                'filename': stored_name,
+                'owner_token': owner_token,
+                'stored_size': stored_size,
+                'sha256': checksums['sha256'],
+                'crc32': checksums['crc32'],
+                'file_id': file_id
             }
+            if staged:
+                # The job logs the analytics row, and drops these once done
+                metadata.update(state='staged', client_ip=self.client_address[0])
+            with self.timer.stage('write'):
+                self.app.file_store.put_bytes(f"{stored_name}.meta", json.dumps(metadata).encode())
+                
+                # Save owner token
+                self.app.file_store.put_bytes(f"{stored_name}.token", owner_token.encode())
             
-            meta_path = f"{filepath}.meta"
-            with open(meta_path, 'w') as f:
-                json.dump(metadata, f)
-
-            # Save owner token
-            token_path = f"{filepath}.token"
-            with open(token_path, 'w') as token_file:
-                token_file.write(owner_token)
-            
-            # Log to analytics
-            file_type = os.path.splitext(filename)[1].lower() or 'unknown'
-            client_ip = self.client_address[0]
-            analytics.log_upload(filename, original_size, file_type, client_ip, compressed_size, was_compressed)
-            
-            print(f"✅ File uploaded: {os.path.basename(filepath)} ({self.get_file_size(filepath)})")
-            
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.send_header('X-Owner-Token', owner_token)
-            self.end_headers()
-            response = json.dumps({
-                "status": "success", 
-                "filename": os.path.basename(filepath), 
+            result = {
+                "status": "success",
+                "file_id": file_id,
+                "filename": stored_name,
+                "original_name": original_name,
                 "owner_token": owner_token,
                 "original_size": original_size,
                 "compressed_size": compressed_size,
-                "was_compressed": was_compressed
-            })
-            self.wfile.write(response.encode())
+                "was_compressed": was_compressed,
+                "sha256": checksums['sha256']
+            }
+            entry = file_entry(stored_name, stored_size, metadata)
+            if staged:
+                self.app.processing.submit(stored_name)
+                print(f"📥 File staged: {stored_name} ({self.get_file_size(stored_size)})")
+                return dict(result, processing='queued'), None, entry
+            
+            print(f"✅ File uploaded: {stored_name} ({self.get_file_size(stored_size)})")
+            
+            file_type = os.path.splitext(filename)[1].lower() or 'unknown'
+            upload = (file_id, stored_name, original_size, file_type, self.client_address[0], compressed_size, was_compressed)
+            return result, upload, entry
             
         except Exception as e:
-            print(f"❌ Upload error: {str(e)}")
-            if 'filepath' in locals() and os.path.exists(filepath):
-                os.remove(filepath)
-            self.send_error(500, f"Internal Server Error: {str(e)}")
+            print(f"❌ Upload error for {filename}: {str(e)}")
+            if stored_name:
+                self.app.processing.discard(stored_name)
+                for key in [stored_name, f"{stored_name}.meta", f"{stored_name}.token"]:
+                    self.app.file_store.delete(key)
+            return {"status": "error", "original_name": original_name, "error": str(e)}, None, None
     
     def list_files(self):
         try:
+            # Taken before listing, so a client following the change feed from
+            # here on sees every change the listing might have missed
+            seq = self.app.changes.latest()
             files = []
-            for filename in os.listdir(self.upload_dir):
-                filepath = os.path.join(self.upload_dir, filename)
-                if os.path.isfile(filepath) and not filename.endswith('.token') and not filename.endswith('.meta'):
-                    # Get metadata if available
-                    meta_path = f"{filepath}.meta"
-                    metadata = {}
-                    if os.path.exists(meta_path):
-                        try:
-                            with open(meta_path, 'r') as f:
-                                metadata = json.load(f)
-                        except:
-                            pass
-                    
-                    files.append({
-                        'name': filename,
-                        'size': os.path.getsize(filepath),
-                        'original_size': metadata.get('original_size', os.path.getsize(filepath)),
-                        'was_compressed': metadata.get('was_compressed', False)
-                    })
+            for filename, info, metadata in list_stored_files(self.app.file_store):
+                files.append(file_entry(filename, info['size'], metadata))
             
             files.sort(key=lambda x: x['name'])
             
             self.send_response(200)
             self.send_header('Content-Type', 'application/json')
             self.send_header('Access-Control-Allow-Origin', '*')
+            self.send_header('X-Change-Seq', str(seq))
             self.end_headers()
             
             response = json.dumps(files)
@@ -471,22 +845,21 @@ class FileTransferHandler(BaseHTTPRequestHandler):
     
     def download_file(self, filename):
         try:
-            filepath = os.path.join(self.upload_dir, filename)
-            if not os.path.exists(filepath) or not os.path.isfile(filepath):
+            info = self.app.file_store.stat(filename)
+            if info is None:
                 self.send_error(404, "File not found")
                 return
             
             # Get metadata
-            meta_path = f"{filepath}.meta"
-            metadata = {}
-            if os.path.exists(meta_path):
-                try:
-                    with open(meta_path, 'r') as f:
-                        metadata = json.load(f)
-                except:
-                    pass
+            metadata = self.app.files.read_metadata(filename)
             
-            file_size = os.path.getsize(filepath)
+            staged, metadata, info = self.app.files.open_staged(filename, metadata, info)
+            if staged is not None:
+                with staged:
+                    self.download_staged(filename, metadata, staged)
+                return
+            
+            file_size = info['size']
             
             # For large files, stream directly without loading into memory
             if file_size > 100 * 1024 * 1024:  # > 100MB
@@ -500,69 +873,268 @@ class FileTransferHandler(BaseHTTPRequestHandler):
                 self.end_headers()
                 
                 # Stream file in chunks
-                with open(filepath, 'rb') as f:
-                    while True:
-                        chunk = f.read(1024 * 1024)  # 1MB chunks
-                        if not chunk:
-                            break
+                with self.timer.stage('send'):
+                    for chunk in self.app.bandwidth.shape(self.client_address[0], self.app.file_store.get_stream(filename)):
                         self.wfile.write(chunk)
                 
                 # Update download counter
-                analytics.increment_download(filename)
+                with self.timer.stage('analytics'):
+                    self.app.analytics.increment_download(metadata.get('file_id'), filename)
                 print(f"📥 Large file downloaded: {filename}")
                 
             else:
-                # For smaller files, process normally
-                with open(filepath, 'rb') as f:
-                    encrypted_data = f.read()
+                # Clients holding the current version get a 304 without any decoding
+                etag = etag_for(metadata)
+                if etag_matches(self.headers.get('If-None-Match'), etag):
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.end_headers()
+                    return
                 
-                try:
-                    # Decrypt first
-                    decrypted_data = fernet.decrypt(encrypted_data)
-                    
-                    # Then decompress if needed
-                    was_compressed = metadata.get('was_compressed', False)
-                    final_data = decompress_file_data(decrypted_data, filename, was_compressed)
-                    
-                    # Update download counter
-                    analytics.increment_download(filename)
-                    
-                    # Send file
+                # Serve popular files straight from the decoded payload cache
+                version = info['version']
+                final_data = self.app.content_cache.get(filename, version)
+                if final_data is not None:
+                    with self.timer.stage('analytics'):
+                        self.app.analytics.increment_download(metadata.get('file_id'), filename)
                     self.send_response(200)
                     self.send_header('Content-Type', 'application/octet-stream')
                     self.send_header('Content-Disposition', f'attachment; filename="{filename}"')
                     self.send_header('Content-Length', str(len(final_data)))
+                    self.send_validators(metadata)
                     self.end_headers()
-                    
-                    # Send data in chunks
-                    offset = 0
-                    chunk_size = 8192
-                    while offset < len(final_data):
-                        chunk = final_data[offset:offset + chunk_size]
-                        self.wfile.write(chunk)
-                        offset += chunk_size
+                    with self.timer.stage('send'):
+                        for chunk in self.app.bandwidth.shape(self.client_address[0], [final_data]):
+                            self.wfile.write(chunk)
+                    print(f"📥 File downloaded (cached): {filename}")
+                    return
+                
+                # For smaller files, process normally. Concurrent downloads of the
+                # same file share a single decode pass.
+                try:
+                    was_compressed = metadata.get('was_compressed', False)
+                    reservation = self.app.memory.reserve(decode_cost(file_size, metadata.get('original_size', file_size)))
+                    spill = None
+                    try:
+                        if reservation is None:
+                            # Over the memory budget, decode through a temporary file instead
+                            with self.timer.stage('decode'):
+                                spill, size = self.app.files.decode_to_spill(filename, was_compressed)
+                            body = iter_file(spill)
+                        else:
+                            # Requests joining another one's decode only see the wait as decode
+                            with self.timer.stage('decode'):
+                                final_data = self.app.decode_flights.do(
+                                    (filename, version),
+                                    lambda: self.app.files.decode_stored_file(filename, was_compressed, version, self.timer)
+                                )
+                            size = len(final_data)
+                            body = iter_chunks(final_data)
+                        
+                        # Update download counter
+                        with self.timer.stage('analytics'):
+                            self.app.analytics.increment_download(metadata.get('file_id'), filename)
+                        
+                        # Send file
+                        self.send_response(200)
+                        self.send_header('Content-Type', 'application/octet-stream')
+                        self.send_header('Content-Disposition', f'attachment; filename="{filename}"')
+                        self.send_header('Content-Length', str(size))
+                        self.send_validators(metadata)
+                        self.end_headers()
+                        
+                        # Send data in chunks
+                        with self.timer.stage('send'):
+                            for chunk in self.app.bandwidth.shape(self.client_address[0], body):
+                                self.wfile.write(chunk)
+                    finally:
+                        close_spill(spill)
+                        if reservation is not None:
+                            reservation.release()
                     
                     print(f"📥 File downloaded: {filename}")
                     
                 except Exception as e:
                     print(f"❌ Decryption/decompression error for {filename}: {e}")
                     # Fallback: send as-is if processing fails
+                    encrypted_data = self.app.file_store.get_bytes(filename)
                     self.send_response(200)
                     self.send_header('Content-Type', 'application/octet-stream')
                     self.send_header('Content-Disposition', f'attachment; filename="{filename}"')
                     self.send_header('Content-Length', str(len(encrypted_data)))
                     self.end_headers()
-                    self.wfile.write(encrypted_data)
+                    for chunk in self.app.bandwidth.shape(self.client_address[0], [encrypted_data]):
+                        self.wfile.write(chunk)
                     print(f"⚠️ Sent encrypted file as fallback: {filename}")
             
         except Exception as e:
             print(f"❌ Download error: {str(e)}")
             self.send_error(500)
     
+    def download_staged(self, filename, metadata, staged):
+        """Send a file that is still being processed from its staged copy"""
+        etag = etag_for(metadata)
+        if etag_matches(self.headers.get('If-None-Match'), etag):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        with self.timer.stage('analytics'):
+            self.app.analytics.increment_download(metadata.get('file_id'), filename)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Disposition', f'attachment; filename="{filename}"')
+        self.send_header('Content-Length', str(metadata['original_size']))
+        self.send_validators(metadata)
+        self.end_headers()
+        with self.timer.stage('send'):
+            for chunk in self.app.bandwidth.shape(self.client_address[0], iter_file(staged)):
+                self.wfile.write(chunk)
+        print(f"📥 File downloaded (staged): {filename}")
+    
+    def download_archive(self, names):
+        """Stream several files as one ZIP64 archive built on the fly"""
+        streaming = False
+        try:
+            if not isinstance(names, list) or not all(isinstance(n, str) for n in names):
+                self.send_error(400, "Bad Request: names must be a list of file names")
+                return
+            
+            # Look every file up first, a missing name is a clean 404 rather than a truncated archive
+            entries = []
+            for filename in dict.fromkeys(names):
+                info = self.app.file_store.stat(filename)
+                if info is None:
+                    self.send_error(404, f"File not found: {filename}")
+                    return
+                entries.append((filename, info))
+            if not entries:
+                self.send_error(400, "Bad Request: No files requested")
+                return
+            
+            archive_name = f"b-transfer-{datetime.now().strftime('%Y%m%d-%H%M%S')}.zip"
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/zip')
+            self.send_header('Content-Disposition', f'attachment; filename="{archive_name}"')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            streaming = True
+            
+            for piece in self.app.bandwidth.shape(self.client_address[0], self.app.files.stream_archive(entries)):
+                self.wfile.write(piece)
+            
+            print(f"📦 Archive downloaded: {len(entries)} files")
+            
+        except Exception as e:
+            print(f"❌ Archive download error: {str(e)}")
+            # Once streaming has begun the client sees a truncated archive
+            if not streaming:
+                self.send_error(500)
+    
+    def preview_file(self, filename):
+        """Text snippet or image thumbnail, without decoding whole files on request"""
+        try:
+            info = self.app.file_store.stat(filename)
+            if info is None:
+                self.send_error(404, "File not found")
+                return
+            
+            metadata = self.app.files.read_metadata(filename)
+            original_size = metadata.get('original_size', info['size'])
+            preview = {'name': filename, 'size': original_size}
+            
+            if preview_kind(filename) != 'image':
+                text = self.app.files.text_preview(filename, metadata, info)
+                if text is None:
+                    preview['type'] = 'binary'
+                else:
+                    preview['type'] = 'text'
+                    preview.update(text)
+                self.send_preview(preview)
+                return
+            
+            preview['type'] = 'image'
+            if not self.app.thumbnails.available or original_size > THUMBNAIL_MAX_SOURCE_BYTES:
+                preview['thumbnail'] = False
+                self.send_preview(preview)
+                return
+            
+            version = info['version']
+            try:
+                thumbnail = self.app.thumbnails.get(filename, version, lambda: self.app.decode_flights.do(
+                    (filename, version),
+                    lambda: self.app.files.read_plaintext(filename, metadata, version)
+                ))
+            except ValueError:
+                preview['thumbnail'] = False
+                self.send_preview(preview)
+                return
+            
+            if thumbnail is None:
+                # Rendering in the background, ask again shortly
+                preview['status'] = 'pending'
+                self.send_preview(preview, 202)
+                return
+            
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/jpeg')
+            self.send_header('Content-Length', str(len(thumbnail)))
+            self.send_header('Cache-Control', 'private, max-age=3600')
+            self.end_headers()
+            self.wfile.write(thumbnail)
+            
+        except Exception as e:
+            print(f"❌ Preview error for {filename}: {str(e)}")
+            self.send_error(500)
+    
+    def send_preview(self, preview, status=200):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        if status == 202:
+            self.send_header('Retry-After', '1')
+        self.end_headers()
+        self.wfile.write(json.dumps(preview).encode())
+    
+    def send_validators(self, metadata):
+        """ETag and Content-Digest of the decoded file, when its checksum is known"""
+        etag = etag_for(metadata)
+        if etag:
+            self.send_header('ETag', etag)
+            self.send_header('Content-Digest', content_digest(metadata['sha256']))
+    
+    def head_download(self, filename):
+        """Answer HEAD /download/ from the metadata sidecar, without reading the file"""
+        try:
+            metadata = self.app.files.read_metadata(filename)
+            stored_size = metadata.get('stored_size')
+            if stored_size is None:
+                # Uploaded before sizes were recorded
+                info = self.app.file_store.stat(filename)
+                if info is None:
+                    self.send_error(404, "File not found")
+                    return
+                stored_size = info['size']
+            
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Disposition', f'attachment; filename="{filename}"')
+            # Same headers as the matching GET: large files go out as stored
+            if stored_size > 100 * 1024 * 1024:
+                self.send_header('Content-Length', str(stored_size))
+            else:
+                self.send_header('Content-Length', str(metadata.get('original_size', stored_size)))
+                self.send_validators(metadata)
+            self.end_headers()
+            
+        except Exception as e:
+            print(f"❌ Head error: {str(e)}")
+            self.send_error(500)
+    
     def delete_file(self, filename):
         try:
-            filepath = os.path.join(self.upload_dir, filename)
-            if not os.path.exists(filepath) or not os.path.isfile(filepath):
+            # Names reserved by uploads still in flight are not files yet
+            if self.app.file_store.stat(filename) is None or in_flight(self.app.file_store, filename):
                 self.send_error(404, "File not found")
                 return
             
@@ -573,22 +1145,23 @@ class FileTransferHandler(BaseHTTPRequestHandler):
                 return
             
             # Check if token matches
-            token_path = f"{filepath}.token"
-            if not os.path.exists(token_path):
+            try:
+                saved_token = self.app.file_store.get_bytes(f"{filename}.token").decode()
+            except FileNotFoundError:
                 self.send_error(404, "Token file not found")
                 return
-                
-            with open(token_path, 'r') as token_file:
-                saved_token = token_file.read()
             if owner_token != saved_token:
                 self.send_error(403, "Forbidden: Invalid owner token")
                 return
 
-            # Remove all associated files
-            for ext in ['', '.token', '.meta']:
-                associated_file = f"{filepath}{ext}"
-                if os.path.exists(associated_file):
-                    os.remove(associated_file)
+            # Remove all associated files, the staged copy first so a running job sees it
+            self.app.processing.discard(filename)
+            for key in [filename, f"{filename}.token", f"{filename}.meta"]:
+                self.app.file_store.delete(key)
+            self.app.content_cache.invalidate(filename)
+            self.app.signatures.invalidate(filename)
+            self.app.thumbnails.invalidate(filename)
+            self.app.changes.publish('delete', filename)
             
             print(f"🗑️ File manually deleted: {filename}")
             
@@ -602,10 +1175,111 @@ class FileTransferHandler(BaseHTTPRequestHandler):
             print(f"❌ Delete error: {str(e)}")
             self.send_error(500, f"Internal Server Error: {str(e)}")
     
-    def get_analytics(self):
-        """Return analytics data as JSON"""
+    def stream_events(self, query):
+        """Server-sent events of file list changes, resuming after since or Last-Event-ID"""
+        try:
+            seq = int(self.headers.get('Last-Event-ID') or query.get('since', [-1])[0])
+        except ValueError:
+            self.send_error(400, "since must be a sequence number")
+            return
+        changes = self.app.changes
+        if seq < 0:
+            # Without a starting point only new changes are sent
+            seq = changes.latest()
+        
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        try:
+            self.wfile.write(b'retry: 3000\n\n')
+            self.wfile.flush()
+            while True:
+                events, reset = changes.wait(seq, 15)
+                if reset:
+                    seq = changes.latest()
+                    self.wfile.write(sse_message({'seq': seq, 'type': 'reset'}))
+                elif not events:
+                    # Keeps proxies from closing an idle stream
+                    self.wfile.write(b': keepalive\n\n')
+                for event in events:
+                    self.wfile.write(sse_message(event))
+                    seq = event['seq']
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError, socket.timeout):
+            pass
+    
+    def poll_changes(self, query):
+        """Long poll for file list changes after since, waiting up to timeout seconds"""
+        try:
+            timeout = min(max(float(query.get('timeout', [25])[0]), 0), 30)
+            seq = int(query.get('since', [-1])[0])
+        except ValueError:
+            self.send_error(400, "since and timeout must be numbers")
+            return
+        changes = self.app.changes
+        if seq < 0:
+            events, reset, seq = [], False, changes.latest()
+        else:
+            events, reset = changes.wait(seq, timeout)
+            if reset:
+                seq = changes.latest()
+            elif events:
+                seq = events[-1]['seq']
+        
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(json.dumps({'seq': seq, 'events': events, 'reset': reset}).encode())
+    
+    def get_metrics(self):
+        """Request, transfer and processing metrics in the Prometheus text format"""
+        try:
+            app = self.app
+            extra = (stats_families('btransfer_cache', app.content_cache.stats(),
+                                    counters={'hits', 'misses', 'evictions', 'bypasses'})
+                     + stats_families('btransfer', app.decode_flights.stats(),
+                                      counters={'decode_executions', 'decode_coalesced'})
+                     + stats_families('btransfer_thumbnail', app.thumbnails.stats(),
+                                      counters={'hits', 'misses', 'evictions', 'bypasses', 'rendered', 'failures'})
+                     + stats_families('btransfer_bandwidth', app.bandwidth.stats(),
+                                      counters={'bytes_sent', 'transfers', 'throttled_seconds'})
+                     + stats_families('btransfer_memory', app.memory.stats(),
+                                      counters={'granted', 'waited', 'wait_seconds', 'over_budget', 'spills',
+                                                'spilled_bytes'})
+                     + stats_families('btransfer_processing', app.processing.stats(),
+                                      counters={'submitted', 'completed', 'failed'}))
+            if app.recompressor is not None:
+                extra += stats_families('btransfer_recompression', app.recompressor.stats(),
+                                        counters={'recompressed', 'kept', 'failed', 'bytes_saved', 'paused_seconds',
+                                                  'throttled_seconds'})
+            body = REGISTRY.render(extra)
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except Exception as e:
+            print(f"❌ Metrics error: {str(e)}")
+            self.send_error(500)
+    
+    def get_analytics(self, query):
+        """Return analytics data as JSON, a time series when from, to or bucket is given"""
         try:
-            stats = analytics.get_stats()
+            if query:
+                try:
+                    stats = self.app.analytics.query(
+                        query.get('from', [None])[0],
+                        query.get('to', [None])[0],
+                        query.get('bucket', ['day'])[0]
+                    )
+                except ValueError as e:
+                    self.send_error(400, f"Bad Request: {str(e)}")
+                    return
+            else:
+                stats = self.app.analytics.get_stats()
             
             self.send_response(200)
             self.send_header('Content-Type', 'application/json')
@@ -619,15 +1293,134 @@ class FileTransferHandler(BaseHTTPRequestHandler):
             print(f"❌ Analytics error: {str(e)}")
             self.send_error(500)
     
+    def get_cache_stats(self):
+        """Return decoded content cache counters as JSON"""
+        try:
+            stats = self.app.content_cache.stats()
+            stats.update(self.app.decode_flights.stats())
+            stats['thumbnails'] = self.app.thumbnails.stats()
+            
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.end_headers()
+            
+            response = json.dumps(stats)
+            self.wfile.write(response.encode())
+            
+        except Exception as e:
+            print(f"❌ Cache stats error: {str(e)}")
+            self.send_error(500)
+    
+    def get_bandwidth(self):
+        """Return download rate limits and shaping counters as JSON"""
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.end_headers()
+            
+            response = json.dumps(self.app.bandwidth.stats())
+            self.wfile.write(response.encode())
+            
+        except Exception as e:
+            print(f"❌ Bandwidth stats error: {str(e)}")
+            self.send_error(500)
+    
+    def is_admin(self):
+        """Whether the request carries the ADMIN_TOKEN"""
+        admin_token = self.headers.get('X-Admin-Token')
+        return bool(self.app.admin_token and admin_token and secrets.compare_digest(admin_token, self.app.admin_token))
+    
+    def get_memory(self):
+        """Return the transfer memory budget, reservations and spill counts as JSON"""
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.end_headers()
+            
+            response = json.dumps(self.app.memory.stats())
+            self.wfile.write(response.encode())
+            
+        except Exception as e:
+            print(f"❌ Memory stats error: {str(e)}")
+            self.send_error(500)
+    
+    def set_bandwidth(self):
+        """Change download rate limits, requires the ADMIN_TOKEN"""
+        try:
+            if not self.is_admin():
+                self.send_error(403, "Forbidden: Invalid admin token")
+                return
+            
+            try:
+                content_length = int(self.headers.get('Content-Length', 0))
+                limits = json.loads(self.rfile.read(content_length) or b'{}')
+                self.app.bandwidth.configure(
+                    global_rate=limits.get('global_rate'),
+                    per_ip_rate=limits.get('per_ip_rate'),
+                    per_transfer_rate=limits.get('per_transfer_rate')
+                )
+            except (ValueError, AttributeError) as e:
+                self.send_error(400, f"Bad Request: {str(e)}")
+                return
+            
+            print(f"🚦 Bandwidth limits changed: {self.app.bandwidth.limits()}")
+            
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(json.dumps(self.app.bandwidth.limits()).encode())
+            
+        except Exception as e:
+            print(f"❌ Bandwidth config error: {str(e)}")
+            self.send_error(500)
+    
+    def run_profile(self, query):
+        """Sample all threads for a few seconds and return folded stacks, requires the ADMIN_TOKEN"""
+        try:
+            if not self.is_admin():
+                self.send_error(403, "Forbidden: Invalid admin token")
+                return
+            
+            try:
+                seconds = float(query.get('seconds', ['10'])[0])
+                interval = float(query.get('interval', [str(DEFAULT_INTERVAL * 1000)])[0]) / 1000
+            except ValueError:
+                self.send_error(400, "Bad Request: seconds and interval must be numbers")
+                return
+            if not 0 < seconds <= MAX_PROFILE_SECONDS or not 0 < interval <= 1:
+                self.send_error(400, f"Bad Request: seconds must be in (0, {MAX_PROFILE_SECONDS}], interval in (0, 1000] ms")
+                return
+            
+            print(f"🔬 Profiling for {seconds:g}s")
+            try:
+                stacks = sample_stacks(seconds, interval)
+            except RuntimeError as e:
+                self.send_error(409, str(e))
+                return
+            
+            body = stacks.encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            
+        except Exception as e:
+            print(f"❌ Profile error: {str(e)}")
+            self.send_error(500)
+    
     def health_check(self):
         """Health check endpoint for monitoring"""
         try:
-            # Check if uploads directory exists
-            uploads_ok = os.path.exists('uploads')
+            # Check if the storage backend is reachable
+            uploads_ok = self.app.file_store.check()
             
             # Check database connection
             try:
-                analytics.get_stats()
+                self.app.analytics.get_stats()
                 db_ok = True
             except:
                 db_ok = False
@@ -635,8 +1428,8 @@ class FileTransferHandler(BaseHTTPRequestHandler):
             # Check encryption
             try:
                 test_data = b"test"
-                encrypted = fernet.encrypt(test_data)
-                decrypted = fernet.decrypt(encrypted)
+                encrypted = self.app.fernet.encrypt(test_data)
+                decrypted = self.app.fernet.decrypt(encrypted)
                 encryption_ok = decrypted == test_data
             except:
                 encryption_ok = False
@@ -646,6 +1439,7 @@ class FileTransferHandler(BaseHTTPRequestHandler):
                 'timestamp': datetime.now().isoformat(),
                 'version': '3.0.0',
                 'service': 'B-Transfer Pro by Balsim Productions',
+                'storage_backend': self.app.file_store.name,
                 'checks': {
                     'uploads_directory': uploads_ok,
                     'database': db_ok,
@@ -665,8 +1459,7 @@ class FileTransferHandler(BaseHTTPRequestHandler):
             print(f"❌ Health check error: {str(e)}")
             self.send_error(500)
     
-    def get_file_size(self, filepath):
-        size_bytes = os.path.getsize(filepath)
+    def get_file_size(self, size_bytes):
         if size_bytes == 0:
             return "0 B"
         size_names = ["B", "KB", "MB", "GB"]
@@ -688,10 +1481,79 @@ def get_local_ip():
     except Exception:
         return "127.0.0.1"
 
+def _raise_interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+def run_worker(index, port, app):
+    """Serve requests in a pre-forked worker process"""
+    # Only the first worker runs the expiry cleaner
+    if index == 0:
+        app.start()
+    server = ReusePortHTTPServer(('0.0.0.0', port), FileTransferHandler, app)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+def spawn_worker(index, port, app):
+    pid = os.fork()
+    if pid == 0:
+        exit_code = 0
+        try:
+            run_worker(index, port, app)
+        except Exception as e:
+            print(f"❌ Worker {index} crashed: {e}")
+            exit_code = 1
+        finally:
+            os._exit(exit_code)
+    return pid
+
+def supervise_workers(count, port, app):
+    """Pre-fork worker processes sharing the port and restart any that die"""
+    workers = {}
+    for index in range(count):
+        workers[spawn_worker(index, port, app)] = (index, time.time())
+    print(f"👷 Started {count} worker processes")
+    
+    try:
+        while True:
+            pid, status = os.wait()
+            if pid not in workers:
+                continue
+            index, started = workers.pop(pid)
+            print(f"⚠️ Worker {index} (pid {pid}) exited with status {status}, restarting")
+            # Back off when a worker keeps dying right after startup
+            if time.time() - started < 1:
+                time.sleep(1)
+            workers[spawn_worker(index, port, app)] = (index, time.time())
+    except KeyboardInterrupt:
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in workers:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+
 def main():
+    parser = argparse.ArgumentParser(description='B-Transfer Pro server')
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('WORKERS', 1)),
+                        help='number of pre-forked worker processes sharing the port (default: 1)')
+    args = parser.parse_args()
+    
     port = int(os.environ.get('PORT', 8081))  # Use Heroku's port or default to 8081
     local_ip = get_local_ip()
     
+    workers = args.workers
+    if workers > 1 and not (hasattr(os, 'fork') and hasattr(socket, 'SO_REUSEPORT')):
+        print("⚠️ Multi-process mode needs fork and SO_REUSEPORT, running a single process")
+        workers = 1
+    
     print("🚀 B-Transfer Pro Server Starting...")
     print("=" * 60)
     print(f"📱 Access from your phone: http://{local_ip}:{port}")
@@ -701,13 +1563,26 @@ def main():
     print("🔄 Server supports up to 5GB file transfers")
     print("🔐 Advanced security with owner authentication")
     print("⚡ Smart compression for optimal performance")
+    if workers > 1:
+        print(f"👷 Running {workers} worker processes")
     print("🏢 Powered by Balsim Productions")
     print("=" * 60)
     print("Press Ctrl+C to stop the server")
     print("")
     
+    signal.signal(signal.SIGTERM, _raise_interrupt)
+    
+    # Open the key, database and storage once, forked workers inherit them
+    app = create_app().init()
+    
+    if workers > 1:
+        supervise_workers(workers, port, app)
+        print("\n\n🛑 B-Transfer Pro server stopped. Thanks for using B-Transfer by Balsim Productions!")
+        return
+    
+    app.start()
     try:
-        server = ThreadedHTTPServer(('0.0.0.0', port), FileTransferHandler)
+        server = ThreadedHTTPServer(('0.0.0.0', port), FileTransferHandler, app)
         server.serve_forever()
     except KeyboardInterrupt:
         print("\n\n🛑 B-Transfer Pro server stopped. Thanks for using B-Transfer by Balsim Productions!")
@@ -8,17 +8,53 @@ import json
 import time
 import threading
 import secrets
-import gzip
-import sqlite3
+import uuid
+import hashlib
 from datetime import datetime, timedelta
-from flask import Flask, request, jsonify, send_file, render_template_string
+from flask import Flask, Response, request, jsonify, send_file, render_template_string, g
+from werkzeug.datastructures import FileStorage
 from werkzeug.utils import secure_filename
 from cryptography.fernet import Fernet
 import tempfile
 import shutil
+import io
+from content_cache import ContentCache, SingleFlight
+from analytics_db import AnalyticsDB
+from change_feed import ChangeFeed, sse_message
+from storage import create_storage, StorageError
+from checksums import StreamDigest, expected_sha256, content_digest, etag_for
+from bandwidth import BandwidthManager
+from metrics import (REGISTRY, ENCRYPTION_SECONDS, WSGIMetrics,
+                     stats_families)
+from preview import ThumbnailWorker, preview_kind, THUMBNAIL_MAX_SOURCE_BYTES
+from memory_governor import (MemoryGovernor, upload_cost, decode_cost, iter_file,
+                             compress_file_data, compress_spooled_file, close_spill, plaintext_chunks)
+from fernet_stream import encrypt_stream, token_size
+from delta import DeltaReader, DeltaError, block_size_for
+from processing import ProcessingQueue, is_staged
+from stored_files import StoredFiles, file_entry, upload_error_status, list_stored_files, in_flight
+from compression_control import COMPRESSION_LEVEL
+from recompression import Recompressor, system_busy, COLD_AFTER_HOURS
+from profiling import StageTimer, sample_stacks, MAX_PROFILE_SECONDS, DEFAULT_INTERVAL
 
 app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 5 * 1024 * 1024 * 1024  # 5GB limit
+# Request counts, latency and bytes per route for /metrics
+app.wsgi_app = WSGIMetrics(app.wsgi_app)
+
+@app.before_request
+def start_stage_timer():
+    g.timer = StageTimer()
+
+@app.after_request
+def add_server_timing(response):
+    """Server-Timing header and a log line of the stages the request went through"""
+    timer = g.get('timer')
+    if timer is not None:
+        response.headers['Server-Timing'] = timer.header()
+        if timer.stages:
+            print(timer.log_line(request.method, request.path, response.status_code))
+    return response
 
 # Persistent key generation
 def get_or_create_key():
@@ -35,121 +71,44 @@ def get_or_create_key():
 KEY = get_or_create_key()
 fernet = Fernet(KEY)
 
-# Setup upload directory
+# Setup file storage, local upload directory unless STORAGE_BACKEND says otherwise
 UPLOAD_FOLDER = 'uploads'
-if not os.path.exists(UPLOAD_FOLDER):
-    os.makedirs(UPLOAD_FOLDER)
-
-# Analytics database
-class AnalyticsDB:
-    def __init__(self):
-        self.db_path = 'analytics.db'
-        self.init_db()
-    
-    def init_db(self):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS uploads (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                filename TEXT,
-                file_size INTEGER,
-                file_type TEXT,
-                upload_time TIMESTAMP,
-                ip_address TEXT,
-                compressed_size INTEGER,
-                download_count INTEGER DEFAULT 0,
-                is_compressed BOOLEAN DEFAULT 0
-            )
-        ''')
-        conn.commit()
-        conn.close()
-    
-    def log_upload(self, filename, file_size, file_type, ip_address, compressed_size, is_compressed):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO uploads (filename, file_size, file_type, upload_time, ip_address, compressed_size, is_compressed)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (filename, file_size, file_type, datetime.now(), ip_address, compressed_size, is_compressed))
-        conn.commit()
-        conn.close()
-    
-    def increment_download(self, filename):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('UPDATE uploads SET download_count = download_count + 1 WHERE filename = ?', (filename,))
-        conn.commit()
-        conn.close()
-    
-    def get_stats(self):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT COUNT(*), SUM(file_size), SUM(compressed_size) FROM uploads')
-        total_files, total_size, total_compressed = cursor.fetchone()
-        
-        today = datetime.now().date()
-        cursor.execute('SELECT COUNT(*) FROM uploads WHERE DATE(upload_time) = ?', (today,))
-        today_uploads = cursor.fetchone()[0]
-        
-        cursor.execute('SELECT file_type, COUNT(*) FROM uploads GROUP BY file_type ORDER BY COUNT(*) DESC LIMIT 5')
-        popular_types = cursor.fetchall()
-        
-        conn.close()
-        
-        return {
-            'total_files': total_files or 0,
-            'total_size': total_size or 0,
-            'total_compressed': total_compressed or 0,
-            'today_uploads': today_uploads or 0,
-            'popular_types': popular_types,
-            'compression_ratio': round((1 - (total_compressed or 1) / (total_size or 1)) * 100, 1) if total_size else 0
-        }
+file_store = create_storage(UPLOAD_FOLDER)
 
-analytics = AnalyticsDB()
+# Analytics and the change feed share one SQLite file
+DB_PATH = os.environ.get('ANALYTICS_DB', 'analytics.db')
+analytics = AnalyticsDB(DB_PATH)
 
-def generate_token():
-    return secrets.token_urlsafe(16)
+# File list change events for /events and /changes
+changes = ChangeFeed(DB_PATH)
 
-def should_compress_file(filename, data_size):
-    compressed_formats = {'.jpg', '.jpeg', '.png', '.gif', '.mp4', '.mp3', '.zip', '.rar', '.7z', '.gz', '.bz2'}
-    ext = os.path.splitext(filename)[1].lower()
-    
-    if ext in compressed_formats:
-        return False
-    
-    if data_size < 1024:
-        return False
-    
-    if data_size > 100 * 1024 * 1024:
-        return False
-    
-    return True
+# Decoded payloads of popular small files
+content_cache = ContentCache()
+decode_flights = SingleFlight()
 
-def compress_file_data(data, filename):
-    if not should_compress_file(filename, len(data)):
-        return data, len(data), False
-    
-    try:
-        compressed = gzip.compress(data, compresslevel=6)
-        if len(compressed) < len(data) * 0.9:
-            return compressed, len(compressed), True
-        else:
-            return data, len(data), False
-    except Exception as e:
-        print(f"⚠️ Compression failed for {filename}: {e}")
-        return data, len(data), False
+# Block signatures for delta uploads, a few bytes per 2-64KB block
+signatures = ContentCache(32 * 1024 * 1024, 32 * 1024 * 1024)
 
-def decompress_file_data(data, filename, was_compressed):
-    if not was_compressed:
-        return data
-    
-    try:
-        return gzip.decompress(data)
-    except Exception as e:
-        print(f"⚠️ Decompression failed for {filename}: {e}")
-        return data
+# Image thumbnails, rendered in the background and cached
+thumbnails = ThumbnailWorker()
+
+# Download rate limits, adjustable at runtime through /bandwidth
+bandwidth = BandwidthManager()
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+
+# Memory budget of transfers decoding whole files, the rest spills to disk
+memory = MemoryGovernor()
+
+def generate_token():
+    return secrets.token_urlsafe(16)
+
+def stored_file_response(filename, size):
+    """Stream a stored file straight from the storage backend"""
+    chunks = bandwidth.shape(request.remote_addr, file_store.get_stream(filename))
+    return Response(chunks, mimetype='application/octet-stream', headers={
+        'Content-Disposition': f'attachment; filename="{filename}"',
+        'Content-Length': str(size)
+    })
 
 def get_file_size(size_bytes):
     if size_bytes == 0:
@@ -166,91 +125,140 @@ def cleanup_old_files():
     while True:
         try:
             now = time.time()
-            for filename in os.listdir(UPLOAD_FOLDER):
-                filepath = os.path.join(UPLOAD_FOLDER, filename)
-                if os.path.isfile(filepath) and not filename.endswith('.token') and not filename.endswith('.meta'):
-                    file_age = now - os.path.getctime(filepath)
-                    if file_age > 86400:  # 24 hours
-                        os.remove(filepath)
-                        for ext in ['.token', '.meta']:
-                            associated_file = f"{filepath}{ext}"
-                            if os.path.exists(associated_file):
-                                os.remove(associated_file)
-                        print(f"🗑️ Auto-deleted (24h): {filename}")
+            expired = []
+            for filename, info in list(file_store.list()):
+                file_age = now - info['mtime']
+                if file_age > 86400:  # 24 hours
+                    if in_flight(file_store, filename):
+                        # Reserved by an upload that never finished, it was never listed
+                        file_store.delete(filename)
+                        print(f"🗑️ Removed abandoned upload: {filename}")
+                        continue
+                    processing.discard(filename)
+                    for key in [filename, f"{filename}.token", f"{filename}.meta"]:
+                        file_store.delete(key)
+                    content_cache.invalidate(filename)
+                    signatures.invalidate(filename)
+                    thumbnails.invalidate(filename)
+                    expired.append(('expire', filename, None))
+                    print(f"🗑️ Auto-deleted (24h): {filename}")
+            changes.publish_many(expired)
+            changes.trim()
+            
+            # Fold old raw analytics rows away, the rollups keep their totals
+            removed = analytics.compact()
+            if removed:
+                print(f"📊 Compacted {removed} old analytics rows")
         except Exception as e:
             print(f"⚠️ Cleaner error: {e}")
         time.sleep(3600)  # Check every hour
 
+# Compression and encryption of uploads after they are acknowledged, see processing.py
+processing = ProcessingQueue(UPLOAD_FOLDER, lambda filename: stored_files.process_staged(filename))
+
+# Decoding and processing of stored files, shared with server.py
+stored_files = StoredFiles(file_store, KEY, fernet, content_cache, decode_flights, signatures, memory, processing,
+                           analytics, changes)
+
 cleanup_thread = threading.Thread(target=cleanup_old_files, daemon=True)
 cleanup_thread.start()
 
+# Uploads staged before a restart
+for staged_name in processing.staged_names():
+    processing.submit(staged_name)
+
+# Cold files re-encoded with xz while the server is idle, see recompression.py
+recompressor = None
+if COLD_AFTER_HOURS > 0:
+    recompressor = Recompressor(file_store, KEY, analytics.last_downloads,
+                                busy=lambda: system_busy() or processing.backlog() > 0, spill_dir=memory.spill_dir)
+    recompressor.start()
+
 @app.route('/')
 def index():
     return render_template_string(open('index.html').read())
 
-@app.route('/upload', methods=['POST'])
-def upload_file():
+def store_upload(file, client_ip, spill=False, chunks=None):
+    """Compress, encrypt and store one uploaded file.
+    
+    The content is read from file.stream unless chunks are given. With
+    spill, the file goes through temporary files and is encrypted chunk by
+    chunk instead of being held in memory. Returns the per-file result, the
+    analytics row and the /files entry, both None on failure. With async
+    processing the file is only staged and queued, its analytics row is then
+    left to the job.
+    """
+    # Secure filename
+    filename = secure_filename(file.filename)
+    if not filename:
+        return {'status': 'error', 'original_name': file.filename, 'error': 'Invalid filename'}, None, None
+    
+    stored_name = None
+    file_data = None
     try:
-        if 'file' not in request.files:
-            return jsonify({'error': 'No file part'}), 400
-        
-        file = request.files['file']
-        if file.filename == '':
-            return jsonify({'error': 'No file selected'}), 400
-        
-        # Secure filename
-        filename = secure_filename(file.filename)
-        if not filename:
-            return jsonify({'error': 'Invalid filename'}), 400
+        # Read file data, werkzeug has already spooled large bodies to disk
+        digest = StreamDigest()
+        if chunks is None:
+            chunks = iter(lambda: file.stream.read(1024 * 1024), b'')
+        with g.timer.stage('receive'):
+            if spill:
+                file_data, original_size = memory.spool(chunks, digest)
+                print(f"💾 Memory budget spent, spilled upload to disk ({get_file_size(original_size)})")
+            else:
+                file_data = digest.read(chunks)
+                original_size = len(file_data)
+        
+        # Reject the file before storing anything if it did not arrive intact
+        checksums = digest.checksums()
+        expected = expected_sha256(file.headers)
+        if expected and expected != checksums['sha256']:
+            print(f"❌ Checksum mismatch for {filename}")
+            return {'status': 'error', 'original_name': file.filename, 'error': 'Checksum mismatch'}, None, None
         
         # Handle duplicate filenames
-        counter = 1
-        original_filename = filename
-        while os.path.exists(os.path.join(UPLOAD_FOLDER, filename)):
-            name, ext = os.path.splitext(original_filename)
-            filename = f"{name}_{counter}{ext}"
-            counter += 1
+        stored_name = file_store.reserve(filename)
         
-        filepath = os.path.join(UPLOAD_FOLDER, filename)
-        
-        # Generate token early
+        # Generate token early, plus the ID analytics know the file by
         owner_token = generate_token()
-        
-        # Save file to temporary location first
-        temp_path = os.path.join(UPLOAD_FOLDER, f"temp_{filename}")
-        file.save(temp_path)
-        
-        # Get original size
-        original_size = os.path.getsize(temp_path)
-        
-        # Read file data
-        with open(temp_path, 'rb') as f:
-            file_data = f.read()
-        
+        file_id = str(uuid.uuid4())
+        
+        staged = processing.enabled
+        if staged:
+            # Acknowledged once on disk, compressed and encrypted in the background
+            with g.timer.stage('stage'):
+                processing.stage(stored_name, plaintext_chunks(file_data))
+            compressed_size = stored_size = original_size
+            was_compressed = False
         # Compress if beneficial (only for smaller files)
-        if original_size > 100 * 1024 * 1024:
+        elif original_size > 100 * 1024 * 1024:
             compressed_size = original_size
             was_compressed = False
             print(f"📁 Large file detected ({get_file_size(original_size)}), skipping compression")
         else:
-            compressed_data, compressed_size, was_compressed = compress_file_data(file_data, filename)
+            with g.timer.stage('compress'):
+                if spill:
+                    compressed_data, compressed_size, was_compressed = compress_spooled_file(
+                        file_data, original_size, stored_name, memory.spill_dir, COMPRESSION_LEVEL,
+                        processing.backlog())
+                else:
+                    compressed_data, compressed_size, was_compressed = compress_file_data(
+                        file_data, stored_name, COMPRESSION_LEVEL, processing.backlog())
             if was_compressed:
+                close_spill(file_data)
                 file_data = compressed_data
         
-        # Encrypt the data
-        try:
-            encrypted_data = fernet.encrypt(file_data)
-        except Exception as e:
-            print(f"❌ Encryption failed for {filename}: {e}")
-            os.remove(temp_path)
-            return jsonify({'error': 'Encryption failed'}), 500
-        
-        # Write encrypted data
-        with open(filepath, 'wb') as f:
-            f.write(encrypted_data)
-        
-        # Clean up temp file
-        os.remove(temp_path)
+        # Encrypt and write the data, for a staged upload its job does
+        if spill and not staged:
+            # Encrypted chunk by chunk straight into storage
+            with g.timer.stage('encrypt'):
+                stored_size = file_store.put_stream(stored_name, encrypt_stream(KEY, iter_file(file_data)),
+                                                    token_size(compressed_size))
+        elif not staged:
+            with g.timer.stage('encrypt'), ENCRYPTION_SECONDS.labels('encrypt').time():
+                encrypted_data = fernet.encrypt(file_data)
+            with g.timer.stage('write'):
+                file_store.put_bytes(stored_name, encrypted_data)
+            stored_size = len(encrypted_data)
         
         # Save metadata
         metadata = {
@@ -258,129 +266,461 @@ def upload_file():
             'compressed_size': compressed_size,
             'was_compressed': was_compressed,
             'upload_time': datetime.now().isoformat(),
-            'filename': filename,
-            'owner_token': owner_token
+            'filename': stored_name,
+            'owner_token': owner_token,
+            'stored_size': stored_size,
+            'sha256': checksums['sha256'],
+            'crc32': checksums['crc32'],
+            'file_id': file_id
         }
+        if staged:
+            # The job logs the analytics row, and drops these once done
+            metadata.update(state='staged', client_ip=client_ip)
+        with g.timer.stage('write'):
+            file_store.put_bytes(f"{stored_name}.meta", json.dumps(metadata).encode())
+            
+            # Save owner token
+            file_store.put_bytes(f"{stored_name}.token", owner_token.encode())
         
-        meta_path = f"{filepath}.meta"
-        with open(meta_path, 'w') as f:
-            json.dump(metadata, f)
-        
-        # Save owner token
-        token_path = f"{filepath}.token"
-        with open(token_path, 'w') as f:
-            f.write(owner_token)
-        
-        # Log to analytics
-        file_type = os.path.splitext(filename)[1].lower() or 'unknown'
-        client_ip = request.remote_addr
-        analytics.log_upload(filename, original_size, file_type, client_ip, compressed_size, was_compressed)
-        
-        print(f"✅ File uploaded: {filename} ({get_file_size(filepath)})")
-        
-        return jsonify({
+        result = {
             'status': 'success',
-            'filename': filename,
+            'file_id': file_id,
+            'filename': stored_name,
+            'original_name': file.filename,
             'owner_token': owner_token,
             'original_size': original_size,
             'compressed_size': compressed_size,
-            'was_compressed': was_compressed
-        }), 200, {'X-Owner-Token': owner_token}
+            'was_compressed': was_compressed,
+            'sha256': checksums['sha256']
+        }
+        entry = file_entry(stored_name, stored_size, metadata)
+        if staged:
+            processing.submit(stored_name)
+            print(f"📥 File staged: {stored_name} ({get_file_size(stored_size)})")
+            return dict(result, processing='queued'), None, entry
+        
+        print(f"✅ File uploaded: {stored_name} ({get_file_size(stored_size)})")
+        
+        file_type = os.path.splitext(stored_name)[1].lower() or 'unknown'
+        upload = (file_id, stored_name, original_size, file_type, client_ip, compressed_size, was_compressed)
+        return result, upload, entry
+        
+    except DeltaError:
+        # Raised while reading, before anything is stored. A bad delta is a 400 for the route
+        raise
+    except Exception as e:
+        print(f"❌ Upload error for {filename}: {str(e)}")
+        if stored_name:
+            processing.discard(stored_name)
+            for key in [stored_name, f"{stored_name}.meta", f"{stored_name}.token"]:
+                file_store.delete(key)
+        return {'status': 'error', 'original_name': file.filename, 'error': str(e)}, None, None
+    finally:
+        close_spill(file_data)
+
+@app.route('/upload', methods=['POST'])
+def upload_file():
+    try:
+        # Refuse before receiving anything the disk cannot hold
+        try:
+            file_store.ensure_space(token_size(request.content_length or 0))
+        except StorageError as e:
+            return jsonify({'error': str(e)}), e.status
+        
+        # Werkzeug parses the whole multipart body on first access
+        with g.timer.stage('parse'):
+            request.files
+        if 'file' not in request.files:
+            return jsonify({'error': 'No file part'}), 400
+        
+        files = [f for f in request.files.getlist('file') if f.filename]
+        if not files:
+            return jsonify({'error': 'No file selected'}), 400
+        
+        # Store every file of the batch, then log them in one transaction
+        results = []
+        uploads = []
+        added = []
+        reservation = memory.reserve(upload_cost(request.content_length or 0))
+        try:
+            for file in files:
+                result, upload, entry = store_upload(file, request.remote_addr, spill=reservation is None)
+                results.append(result)
+                if upload:
+                    uploads.append(upload)
+                if entry:
+                    added.append(('add', entry['name'], entry))
+        finally:
+            if reservation is not None:
+                reservation.release()
+        
+        if uploads:
+            with g.timer.stage('analytics'):
+                analytics.log_uploads(uploads)
+        if added:
+            with g.timer.stage('events'):
+                changes.publish_many(added)
+        
+        stored = [r for r in results if r['status'] == 'success']
+        if not stored:
+            if len(results) == 1 and upload_error_status(results[0]) != 500:
+                return jsonify({'error': results[0]['error']}), upload_error_status(results[0])
+            return jsonify({'error': f"Upload failed: {results[0]['error']}", 'files': results}), 500
+        
+        # The first file's fields stay at the top level for single-file clients
+        first = stored[0]
+        return jsonify(dict(
+            first,
+            status='success' if len(stored) == len(results) else 'partial',
+            files=results
+        )), 200, {'X-Owner-Token': first['owner_token']}
         
     except Exception as e:
         print(f"❌ Upload error: {str(e)}")
         return jsonify({'error': f'Upload failed: {str(e)}'}), 500
 
+@app.route('/upload/<filename>', methods=['PUT'])
+def upload_raw(filename):
+    """Store a file sent as the raw request body, no multipart framing"""
+    try:
+        # Chunked bodies have no size up front, they always go to disk
+        reservation = None
+        if request.content_length is not None:
+            try:
+                file_store.ensure_space(token_size(request.content_length))
+            except StorageError as e:
+                return jsonify({'error': str(e)}), e.status
+            reservation = memory.reserve(upload_cost(request.content_length))
+        try:
+            # Werkzeug undoes chunked transfer encoding in request.stream
+            file = FileStorage(request.stream, filename=filename, headers=request.headers)
+            result, upload, entry = store_upload(file, request.remote_addr, spill=reservation is None)
+        finally:
+            if reservation is not None:
+                reservation.release()
+        if not entry:
+            return jsonify({'error': result['error']}), upload_error_status(result)
+        if upload:
+            with g.timer.stage('analytics'):
+                analytics.log_uploads([upload])
+        with g.timer.stage('events'):
+            changes.publish('add', entry['name'], entry)
+        return jsonify(result), 200, {'X-Owner-Token': result['owner_token']}
+        
+    except Exception as e:
+        print(f"❌ Upload error: {str(e)}")
+        return jsonify({'error': f'Upload failed: {str(e)}'}), 500
+
+@app.route('/signature/<filename>')
+def get_signature(filename):
+    """Block signature of a stored file, the first step of a delta upload"""
+    try:
+        info = file_store.stat(filename)
+        if info is None:
+            return jsonify({'error': 'File not found'}), 404
+        with g.timer.stage('signature'):
+            signature = stored_files.file_signature(filename, info)
+        return Response(signature, mimetype='application/octet-stream')
+    except Exception as e:
+        print(f"❌ Signature error: {str(e)}")
+        return jsonify({'error': 'Signature failed'}), 500
+
+@app.route('/status/<filename>')
+def get_status(filename):
+    """Processing state of an uploaded file: queued, processing, done or failed"""
+    try:
+        status = processing.status(filename)
+        if status is None:
+            # Not processed by this process since it started
+            metadata = stored_files.read_metadata(filename)
+            if not metadata and file_store.stat(filename) is None:
+                return jsonify({'error': 'File not found'}), 404
+            status = {'name': filename, 'state': 'queued' if is_staged(metadata) else 'done'}
+        return jsonify(status)
+    except Exception as e:
+        print(f"❌ Status error: {str(e)}")
+        return jsonify({'error': 'Status failed'}), 500
+
+@app.route('/delta/<filename>', methods=['PUT'])
+def upload_delta(filename):
+    """Store a new version of a file, rebuilt from a delta against a stored one (see delta.py)"""
+    try:
+        base = request.args.get('base', '')
+        info = file_store.stat(base) if base else None
+        if info is None:
+            return jsonify({'error': 'Base file not found'}), 404
+        metadata = stored_files.read_metadata(base)
+        
+        try:
+            reader = DeltaReader(iter(lambda: request.stream.read(1024 * 1024), b''))
+        except DeltaError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        # A delta is cheap to send, the version it rebuilds must still fit
+        try:
+            file_store.ensure_space(token_size(reader.size))
+        except StorageError as e:
+            return jsonify({'error': str(e)}), e.status
+        
+        base_sha256 = metadata.get('sha256')
+        if base_sha256 and reader.base_sha256.hex() != base_sha256:
+            return jsonify({'error': 'The base file has changed, fetch its signature again'}), 409
+        
+        reservation = memory.reserve(upload_cost(reader.size))
+        base_data = base_reservation = None
+        try:
+            with g.timer.stage('decode'):
+                base_data, base_size, base_reservation = stored_files.open_plaintext(base, metadata, info)
+            if not base_sha256:
+                # Uploaded before checksums were recorded, hash it now
+                digest = hashlib.sha256()
+                for chunk in plaintext_chunks(base_data):
+                    digest.update(chunk)
+                if reader.base_sha256 != digest.digest():
+                    return jsonify({'error': 'The base file has changed, fetch its signature again'}), 409
+            if reader.block_size != block_size_for(base_size):
+                return jsonify({'error': 'Delta block size does not match the base file'}), 400
+            
+            file = FileStorage(filename=filename, headers=request.headers)
+            try:
+                result, upload, entry = store_upload(file, request.remote_addr, spill=reservation is None,
+                                                     chunks=reader.apply(base_data, base_size))
+            except DeltaError as e:
+                print(f"❌ Delta upload error: {e}")
+                return jsonify({'error': str(e)}), 400
+        finally:
+            close_spill(base_data)
+            for held in (base_reservation, reservation):
+                if held is not None:
+                    held.release()
+        if not entry:
+            return jsonify({'error': result['error']}), upload_error_status(result)
+        if upload:
+            with g.timer.stage('analytics'):
+                analytics.log_uploads([upload])
+        with g.timer.stage('events'):
+            changes.publish('add', entry['name'], entry)
+        
+        print(f"🔁 Delta upload: {entry['name']} rebuilt from {base}, "
+              f"received {get_file_size(reader.received)} for {get_file_size(reader.size)}")
+        return jsonify(dict(result, base=base, delta_bytes=reader.received)), 200, {'X-Owner-Token': result['owner_token']}
+        
+    except Exception as e:
+        print(f"❌ Delta upload error: {str(e)}")
+        return jsonify({'error': f'Upload failed: {str(e)}'}), 500
+
 @app.route('/files')
 def list_files():
     try:
+        # Taken before listing, so a client following the change feed from
+        # here on sees every change the listing might have missed
+        seq = changes.latest()
         files = []
-        for filename in os.listdir(UPLOAD_FOLDER):
-            filepath = os.path.join(UPLOAD_FOLDER, filename)
-            if os.path.isfile(filepath) and not filename.endswith('.token') and not filename.endswith('.meta'):
-                meta_path = f"{filepath}.meta"
-                metadata = {}
-                if os.path.exists(meta_path):
-                    try:
-                        with open(meta_path, 'r') as f:
-                            metadata = json.load(f)
-                    except:
-                        pass
-                
-                files.append({
-                    'name': filename,
-                    'size': os.path.getsize(filepath),
-                    'original_size': metadata.get('original_size', os.path.getsize(filepath)),
-                    'was_compressed': metadata.get('was_compressed', False)
-                })
+        for filename, info, metadata in list_stored_files(file_store):
+            files.append(file_entry(filename, info['size'], metadata))
         
         files.sort(key=lambda x: x['name'])
-        return jsonify(files)
+        return jsonify(files), 200, {'X-Change-Seq': str(seq)}
         
     except Exception as e:
         print(f"❌ List files error: {str(e)}")
         return jsonify({'error': 'Failed to list files'}), 500
 
+def decoded_file_response(final_data, filename, metadata):
+    """Send a decoded payload, bytes or a spilled file, with its ETag and Content-Digest when known"""
+    sha256 = metadata.get('sha256')
+    body = io.BytesIO(final_data) if isinstance(final_data, bytes) else final_data
+    response = send_file(body, as_attachment=True, download_name=filename, etag=sha256 or False)
+    response.response = bandwidth.shape(request.remote_addr, response.response)
+    if sha256:
+        response.headers['Content-Digest'] = content_digest(sha256)
+    return response
+
+def head_download(filename):
+    """Answer HEAD /download/ from the metadata sidecar, without reading the file"""
+    metadata = stored_files.read_metadata(filename)
+    stored_size = metadata.get('stored_size')
+    if stored_size is None:
+        # Uploaded before sizes were recorded
+        info = file_store.stat(filename)
+        if info is None:
+            return jsonify({'error': 'File not found'}), 404
+        stored_size = info['size']
+    
+    headers = {'Content-Disposition': f'attachment; filename="{filename}"'}
+    # Same headers as the matching GET: large files go out as stored
+    if stored_size > 100 * 1024 * 1024:
+        headers['Content-Length'] = str(stored_size)
+    else:
+        headers['Content-Length'] = str(metadata.get('original_size', stored_size))
+        if metadata.get('sha256'):
+            headers['ETag'] = etag_for(metadata)
+            headers['Content-Digest'] = content_digest(metadata['sha256'])
+    return Response(mimetype='application/octet-stream', headers=headers)
+
 @app.route('/download/<filename>')
 def download_file(filename):
     try:
-        filepath = os.path.join(UPLOAD_FOLDER, filename)
-        if not os.path.exists(filepath) or not os.path.isfile(filepath):
+        if request.method == 'HEAD':
+            return head_download(filename)
+        
+        info = file_store.stat(filename)
+        if info is None:
             return jsonify({'error': 'File not found'}), 404
         
         # Get metadata
-        meta_path = f"{filepath}.meta"
-        metadata = {}
-        if os.path.exists(meta_path):
-            try:
-                with open(meta_path, 'r') as f:
-                    metadata = json.load(f)
-            except:
-                pass
+        metadata = stored_files.read_metadata(filename)
+        
+        staged, metadata, info = stored_files.open_staged(filename, metadata, info)
+        if staged is not None:
+            # Still being processed, the response closes the staged copy
+            analytics.increment_download(metadata.get('file_id'), filename)
+            print(f"📥 File downloaded (staged): {filename}")
+            return decoded_file_response(staged, filename, metadata)
         
-        file_size = os.path.getsize(filepath)
+        file_size = info['size']
         
         # For large files, stream directly
         if file_size > 100 * 1024 * 1024:
             print(f"📥 Streaming large file: {filename} ({get_file_size(file_size)})")
-            analytics.increment_download(filename)
-            return send_file(filepath, as_attachment=True, download_name=filename)
-        
-        # For smaller files, process normally
-        with open(filepath, 'rb') as f:
-            encrypted_data = f.read()
-        
+            analytics.increment_download(metadata.get('file_id'), filename)
+            return stored_file_response(filename, file_size)
+        
+        # Clients holding the current version get a 304 without any decoding
+        sha256 = metadata.get('sha256')
+        if sha256 and request.if_none_match.contains_weak(sha256):
+            return Response(status=304, headers={'ETag': etag_for(metadata)})
+        
+        # Serve popular files straight from the decoded payload cache
+        version = info['version']
+        final_data = content_cache.get(filename, version)
+        if final_data is not None:
+            with g.timer.stage('analytics'):
+                analytics.increment_download(metadata.get('file_id'), filename)
+            print(f"📥 File downloaded (cached): {filename}")
+            return decoded_file_response(final_data, filename, metadata)
+        
+        # For smaller files, process normally. Concurrent downloads of the
+        # same file share a single decode pass.
         try:
-            decrypted_data = fernet.decrypt(encrypted_data)
             was_compressed = metadata.get('was_compressed', False)
-            final_data = decompress_file_data(decrypted_data, filename, was_compressed)
-            
-            analytics.increment_download(filename)
+            timer = g.timer
+            reservation = memory.reserve(decode_cost(file_size, metadata.get('original_size', file_size)))
+            if reservation is None:
+                # Over the memory budget, decode through a temporary file instead
+                with timer.stage('decode'):
+                    final_data, _ = stored_files.decode_to_spill(filename, was_compressed)
+            else:
+                # Requests joining another one's decode only see the wait as decode
+                with reservation, timer.stage('decode'):
+                    final_data = decode_flights.do(
+                        (filename, version),
+                        lambda: stored_files.decode_stored_file(filename, was_compressed, version, timer)
+                    )
             
-            # Create temporary file for download
-            temp_path = os.path.join(UPLOAD_FOLDER, f"download_{filename}")
-            with open(temp_path, 'wb') as f:
-                f.write(final_data)
+            with timer.stage('analytics'):
+                analytics.increment_download(metadata.get('file_id'), filename)
             
             print(f"📥 File downloaded: {filename}")
             
-            return send_file(temp_path, as_attachment=True, download_name=filename)
+            # Send the decoded payload, the response closes a spilled file
+            return decoded_file_response(final_data, filename, metadata)
             
         except Exception as e:
             print(f"❌ Decryption/decompression error for {filename}: {e}")
             # Fallback: send encrypted file
-            analytics.increment_download(filename)
-            return send_file(filepath, as_attachment=True, download_name=filename)
+            analytics.increment_download(metadata.get('file_id'), filename)
+            return stored_file_response(filename, file_size)
         
     except Exception as e:
         print(f"❌ Download error: {str(e)}")
         return jsonify({'error': 'Download failed'}), 500
 
+@app.route('/download-archive', methods=['GET', 'POST'])
+def download_archive():
+    try:
+        if request.method == 'POST':
+            body = request.get_json(silent=True)
+            names = body.get('names', []) if isinstance(body, dict) else None
+        else:
+            names = request.args.getlist('name')
+        if not isinstance(names, list) or not all(isinstance(n, str) for n in names):
+            return jsonify({'error': 'names must be a list of file names'}), 400
+        
+        # Look every file up first, a missing name is a clean 404 rather than a truncated archive
+        entries = []
+        for filename in dict.fromkeys(names):
+            info = file_store.stat(filename)
+            if info is None:
+                return jsonify({'error': f'File not found: {filename}'}), 404
+            entries.append((filename, info))
+        if not entries:
+            return jsonify({'error': 'No files requested'}), 400
+        
+        print(f"📦 Streaming archive of {len(entries)} files")
+        archive_name = f"b-transfer-{datetime.now().strftime('%Y%m%d-%H%M%S')}.zip"
+        # WSGI servers only accept bytes, not memoryview slices
+        pieces = (bytes(piece) for piece in stored_files.stream_archive(entries))
+        chunks = bandwidth.shape(request.remote_addr, pieces)
+        return Response(chunks, mimetype='application/zip', headers={
+            'Content-Disposition': f'attachment; filename="{archive_name}"'
+        })
+        
+    except Exception as e:
+        print(f"❌ Archive download error: {str(e)}")
+        return jsonify({'error': 'Archive download failed'}), 500
+
+@app.route('/preview/<filename>')
+def preview_file(filename):
+    """Text snippet or image thumbnail, without decoding whole files on request"""
+    try:
+        info = file_store.stat(filename)
+        if info is None:
+            return jsonify({'error': 'File not found'}), 404
+        
+        metadata = stored_files.read_metadata(filename)
+        original_size = metadata.get('original_size', info['size'])
+        preview = {'name': filename, 'size': original_size}
+        
+        if preview_kind(filename) != 'image':
+            text = stored_files.text_preview(filename, metadata, info)
+            if text is None:
+                preview['type'] = 'binary'
+            else:
+                preview['type'] = 'text'
+                preview.update(text)
+            return jsonify(preview)
+        
+        preview['type'] = 'image'
+        if not thumbnails.available or original_size > THUMBNAIL_MAX_SOURCE_BYTES:
+            preview['thumbnail'] = False
+            return jsonify(preview)
+        
+        version = info['version']
+        try:
+            thumbnail = thumbnails.get(filename, version, lambda: decode_flights.do(
+                (filename, version),
+                lambda: stored_files.read_plaintext(filename, metadata, version)
+            ))
+        except ValueError:
+            preview['thumbnail'] = False
+            return jsonify(preview)
+        
+        if thumbnail is None:
+            # Rendering in the background, ask again shortly
+            preview['status'] = 'pending'
+            return jsonify(preview), 202, {'Retry-After': '1'}
+        return Response(thumbnail, mimetype='image/jpeg', headers={'Cache-Control': 'private, max-age=3600'})
+        
+    except Exception as e:
+        print(f"❌ Preview error for {filename}: {str(e)}")
+        return jsonify({'error': 'Preview failed'}), 500
+
 @app.route('/delete/<filename>', methods=['DELETE'])
 def delete_file(filename):
     try:
-        filepath = os.path.join(UPLOAD_FOLDER, filename)
-        if not os.path.exists(filepath) or not os.path.isfile(filepath):
+        # Names reserved by uploads still in flight are not files yet
+        if file_store.stat(filename) is None or in_flight(file_store, filename):
             return jsonify({'error': 'File not found'}), 404
         
         # Check owner token
@@ -388,21 +728,22 @@ def delete_file(filename):
         if not owner_token:
             return jsonify({'error': 'No owner token provided'}), 403
         
-        token_path = f"{filepath}.token"
-        if not os.path.exists(token_path):
+        try:
+            saved_token = file_store.get_bytes(f"{filename}.token").decode()
+        except FileNotFoundError:
             return jsonify({'error': 'Token file not found'}), 404
         
-        with open(token_path, 'r') as f:
-            saved_token = f.read()
-        
         if owner_token != saved_token:
             return jsonify({'error': 'Invalid owner token'}), 403
         
-        # Remove all associated files
-        for ext in ['', '.token', '.meta']:
-            associated_file = f"{filepath}{ext}"
-            if os.path.exists(associated_file):
-                os.remove(associated_file)
+        # Remove all associated files, the staged copy first so a running job sees it
+        processing.discard(filename)
+        for key in [filename, f"{filename}.token", f"{filename}.meta"]:
+            file_store.delete(key)
+        content_cache.invalidate(filename)
+        signatures.invalidate(filename)
+        thumbnails.invalidate(filename)
+        changes.publish('delete', filename)
         
         print(f"🗑️ File manually deleted: {filename}")
         return jsonify({'status': 'success', 'message': 'File deleted successfully'})
@@ -411,19 +752,174 @@ def delete_file(filename):
         print(f"❌ Delete error: {str(e)}")
         return jsonify({'error': 'Delete failed'}), 500
 
+@app.route('/events')
+def stream_events():
+    """Server-sent events of file list changes, resuming after since or Last-Event-ID"""
+    try:
+        seq = int(request.headers.get('Last-Event-ID') or request.args.get('since', -1))
+    except ValueError:
+        return jsonify({'error': 'since must be a sequence number'}), 400
+    if seq < 0:
+        # Without a starting point only new changes are sent
+        seq = changes.latest()
+    
+    def generate(seq):
+        yield b'retry: 3000\n\n'
+        while True:
+            events, reset = changes.wait(seq, 15)
+            if reset:
+                seq = changes.latest()
+                yield sse_message({'seq': seq, 'type': 'reset'})
+            elif not events:
+                # Keeps proxies from closing an idle stream
+                yield b': keepalive\n\n'
+            for event in events:
+                yield sse_message(event)
+                seq = event['seq']
+    
+    return Response(generate(seq), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+@app.route('/changes')
+def poll_changes():
+    """Long poll for file list changes after since, waiting up to timeout seconds"""
+    try:
+        timeout = min(max(float(request.args.get('timeout', 25)), 0), 30)
+        seq = int(request.args.get('since', -1))
+    except ValueError:
+        return jsonify({'error': 'since and timeout must be numbers'}), 400
+    if seq < 0:
+        events, reset, seq = [], False, changes.latest()
+    else:
+        events, reset = changes.wait(seq, timeout)
+        if reset:
+            seq = changes.latest()
+        elif events:
+            seq = events[-1]['seq']
+    return jsonify({'seq': seq, 'events': events, 'reset': reset}), 200, {'Cache-Control': 'no-cache'}
+
 @app.route('/analytics')
 def get_analytics():
     try:
-        stats = analytics.get_stats()
+        if request.args:
+            try:
+                stats = analytics.query(request.args.get('from'), request.args.get('to'),
+                                        request.args.get('bucket', 'day'))
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+        else:
+            stats = analytics.get_stats()
         return jsonify(stats)
     except Exception as e:
         print(f"❌ Analytics error: {str(e)}")
         return jsonify({'error': 'Analytics failed'}), 500
 
+@app.route('/bandwidth', methods=['GET', 'POST'])
+def bandwidth_limits():
+    try:
+        if request.method == 'GET':
+            return jsonify(bandwidth.stats())
+        
+        # Changing limits requires the ADMIN_TOKEN
+        admin_token = request.headers.get('X-Admin-Token')
+        if not ADMIN_TOKEN or not admin_token or not secrets.compare_digest(admin_token, ADMIN_TOKEN):
+            return jsonify({'error': 'Invalid admin token'}), 403
+        
+        limits = request.get_json(silent=True)
+        if not isinstance(limits, dict):
+            return jsonify({'error': 'Expected a JSON object of limits'}), 400
+        try:
+            bandwidth.configure(
+                global_rate=limits.get('global_rate'),
+                per_ip_rate=limits.get('per_ip_rate'),
+                per_transfer_rate=limits.get('per_transfer_rate')
+            )
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        print(f"🚦 Bandwidth limits changed: {bandwidth.limits()}")
+        return jsonify(bandwidth.limits())
+        
+    except Exception as e:
+        print(f"❌ Bandwidth error: {str(e)}")
+        return jsonify({'error': 'Bandwidth request failed'}), 500
+
+@app.route('/memory')
+def memory_stats():
+    """Transfer memory budget, reservations and spill counts"""
+    try:
+        return jsonify(memory.stats())
+    except Exception as e:
+        print(f"❌ Memory stats error: {str(e)}")
+        return jsonify({'error': 'Memory stats failed'}), 500
+
+@app.route('/profile', methods=['POST'])
+def run_profile():
+    """Sample all threads for a few seconds and return folded stacks, requires the ADMIN_TOKEN"""
+    try:
+        admin_token = request.headers.get('X-Admin-Token')
+        if not ADMIN_TOKEN or not admin_token or not secrets.compare_digest(admin_token, ADMIN_TOKEN):
+            return jsonify({'error': 'Invalid admin token'}), 403
+        
+        try:
+            seconds = float(request.args.get('seconds', 10))
+            interval = float(request.args.get('interval', DEFAULT_INTERVAL * 1000)) / 1000
+        except ValueError:
+            return jsonify({'error': 'seconds and interval must be numbers'}), 400
+        if not 0 < seconds <= MAX_PROFILE_SECONDS or not 0 < interval <= 1:
+            return jsonify({'error': f'seconds must be in (0, {MAX_PROFILE_SECONDS}], interval in (0, 1000] ms'}), 400
+        
+        print(f"🔬 Profiling for {seconds:g}s")
+        try:
+            stacks = sample_stacks(seconds, interval)
+        except RuntimeError as e:
+            return jsonify({'error': str(e)}), 409
+        return Response(stacks, mimetype='text/plain')
+        
+    except Exception as e:
+        print(f"❌ Profile error: {str(e)}")
+        return jsonify({'error': 'Profile failed'}), 500
+
+@app.route('/cache-stats')
+def get_cache_stats():
+    try:
+        stats = content_cache.stats()
+        stats.update(decode_flights.stats())
+        stats['thumbnails'] = thumbnails.stats()
+        return jsonify(stats)
+    except Exception as e:
+        print(f"❌ Cache stats error: {str(e)}")
+        return jsonify({'error': 'Cache stats failed'}), 500
+
+@app.route('/metrics')
+def get_metrics():
+    """Request, transfer and processing metrics in the Prometheus text format"""
+    try:
+        extra = (stats_families('btransfer_cache', content_cache.stats(),
+                                counters={'hits', 'misses', 'evictions', 'bypasses'})
+                 + stats_families('btransfer', decode_flights.stats(),
+                                  counters={'decode_executions', 'decode_coalesced'})
+                 + stats_families('btransfer_thumbnail', thumbnails.stats(),
+                                  counters={'hits', 'misses', 'evictions', 'bypasses', 'rendered', 'failures'})
+                 + stats_families('btransfer_bandwidth', bandwidth.stats(),
+                                  counters={'bytes_sent', 'transfers', 'throttled_seconds'})
+                 + stats_families('btransfer_memory', memory.stats(),
+                                  counters={'granted', 'waited', 'wait_seconds', 'over_budget', 'spills',
+                                            'spilled_bytes'})
+                 + stats_families('btransfer_processing', processing.stats(),
+                                  counters={'submitted', 'completed', 'failed'}))
+        if recompressor is not None:
+            extra += stats_families('btransfer_recompression', recompressor.stats(),
+                                    counters={'recompressed', 'kept', 'failed', 'bytes_saved', 'paused_seconds',
+                                              'throttled_seconds'})
+        return Response(REGISTRY.render(extra), mimetype='text/plain; version=0.0.4; charset=utf-8')
+    except Exception as e:
+        print(f"❌ Metrics error: {str(e)}")
+        return jsonify({'error': 'Metrics failed'}), 500
+
 @app.route('/health')
 def health_check():
     try:
-        uploads_ok = os.path.exists(UPLOAD_FOLDER)
+        uploads_ok = file_store.check()
         
         try:
             analytics.get_stats()
@@ -444,6 +940,7 @@ def health_check():
             'timestamp': datetime.now().isoformat(),
             'version': '3.1.0',
             'service': 'B-Transfer Pro by Balsim Productions',
+            'storage_backend': file_store.name,
             'checks': {
                 'uploads_directory': uploads_ok,
                 'database': db_ok,
@@ -0,0 +1,654 @@
+#!/usr/bin/env python3
+"""
+Storage backends shared by the B-Transfer servers
+
+Every server talks to a backend with the same small interface (reserve,
+put_stream, get_stream, delete, stat, list). LocalStorage keeps files on disk
+and is the default, S3Storage keeps them in an S3-compatible bucket. Set
+STORAGE_BACKEND=s3 plus the S3_* variables to switch (see create_storage).
+
+On disk, files are fanned out over two levels of hashed subdirectories so no single
+directory grows with the number of uploads:
+
+    uploads/3f/a2/report.pdf
+    uploads/3f/a2/report.pdf.meta
+    uploads/3f/a2/report.pdf.token
+
+The stored name is the file id (unique after de-duplication), the name the
+user uploaded is kept in the .meta sidecar. Files from the old flat layout are
+still found until migrate_uploads.py has moved them.
+
+Files of BULK_IO_MB (64) or more are preallocated when their size is known
+and read and written with page cache hints, so streaming one multi-GB file
+neither fragments on disk nor evicts the small files other clients want.
+"""
+
+import os
+import hmac
+import errno
+import shutil
+import uuid
+import hashlib
+import http.client
+import xml.etree.ElementTree as ET
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit, quote
+
+SIDECAR_EXTENSIONS = ('.meta', '.token')
+CHUNK_SIZE = 1024 * 1024  # 1MB
+BULK_IO_BYTES = int(float(os.environ.get('BULK_IO_MB', 64)) * 1024 * 1024)
+# Bulk transfers drop pages from the cache this far behind the current offset
+DROP_BEHIND_BYTES = 8 * 1024 * 1024
+
+def is_valid_file_id(file_id):
+    """Stored names are plain file names, never paths or hidden files"""
+    return bool(file_id) and os.path.basename(file_id) == file_id and not file_id.startswith('.')
+
+def shard_dir(upload_dir, file_id):
+    """Return the two-level hashed directory for a file id"""
+    digest = hashlib.sha1(file_id.encode('utf-8')).hexdigest()
+    return os.path.join(upload_dir, digest[0:2], digest[2:4])
+
+def sharded_path(upload_dir, file_id):
+    return os.path.join(shard_dir(upload_dir, file_id), file_id)
+
+def flat_path(upload_dir, file_id):
+    return os.path.join(upload_dir, file_id)
+
+def resolve_path(upload_dir, file_id):
+    """Return the blob path of a stored file, or None for invalid names.
+
+    The sharded location wins, the flat location is used for files that have
+    not been migrated yet. The returned path may not exist.
+    """
+    if not is_valid_file_id(file_id):
+        return None
+    path = sharded_path(upload_dir, file_id)
+    if os.path.exists(path):
+        return path
+    legacy = flat_path(upload_dir, file_id)
+    if os.path.isfile(legacy):
+        return legacy
+    return path
+
+def reserve_upload_path(upload_dir, filename):
+    """Atomically claim a free name in the upload folder, adding _1, _2... on clashes.
+
+    Raises StorageError for names is_valid_file_id() rejects, nothing is created for them.
+    """
+    if not is_valid_file_id(filename):
+        raise StorageError(f"Invalid key: {filename}")
+    name, ext = os.path.splitext(filename)
+    counter = 0
+    while True:
+        candidate = filename if counter == 0 else f"{name}_{counter}{ext}"
+        counter += 1
+        # Names still in the flat layout are taken as well
+        if os.path.exists(flat_path(upload_dir, candidate)):
+            continue
+        directory = shard_dir(upload_dir, candidate)
+        os.makedirs(directory, exist_ok=True)
+        filepath = os.path.join(directory, candidate)
+        try:
+            # O_EXCL makes the claim safe across threads and worker processes
+            fd = os.open(filepath, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            os.close(fd)
+            return filepath
+        except FileExistsError:
+            continue
+
+def is_blob_name(filename):
+    """Skip sidecars and hidden temporary files"""
+    return not filename.startswith('.') and not filename.endswith(SIDECAR_EXTENSIONS)
+
+def iter_stored_files(upload_dir):
+    """Yield (file id, blob path) for every stored file in both layouts"""
+    if not os.path.isdir(upload_dir):
+        return
+    with os.scandir(upload_dir) as top:
+        for entry in top:
+            if entry.is_file():
+                # Not migrated yet
+                if is_blob_name(entry.name):
+                    yield entry.name, entry.path
+            elif entry.is_dir() and len(entry.name) == 2:
+                with os.scandir(entry.path) as middle:
+                    for shard in middle:
+                        if not shard.is_dir():
+                            continue
+                        with os.scandir(shard.path) as files:
+                            for f in files:
+                                if f.is_file() and is_blob_name(f.name):
+                                    yield f.name, f.path
+
+def migrate_file(upload_dir, file_id):
+    """Move one flat file into its shard without a window where it is missing.
+
+    Sidecars are hard-linked first, then the blob, so readers resolving the
+    sharded path always find complete files. Flat copies are unlinked last.
+    Returns False when the file vanished (deleted meanwhile) or is already sharded.
+    """
+    source = flat_path(upload_dir, file_id)
+    directory = shard_dir(upload_dir, file_id)
+    target = os.path.join(directory, file_id)
+    if os.path.exists(target):
+        return False
+    os.makedirs(directory, exist_ok=True)
+
+    linked = []
+    try:
+        for ext in SIDECAR_EXTENSIONS:
+            if os.path.exists(f"{source}{ext}"):
+                os.link(f"{source}{ext}", f"{target}{ext}")
+                linked.append(f"{target}{ext}")
+        os.link(source, target)
+    except FileNotFoundError:
+        # Deleted while we were migrating it
+        for path in linked:
+            os.remove(path)
+        return False
+
+    for path in [source] + [f"{source}{ext}" for ext in SIDECAR_EXTENSIONS]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    return True
+
+def migrate_flat_layout(upload_dir):
+    """Reshard every file left in the flat layout, returns how many moved"""
+    moved = 0
+    with os.scandir(upload_dir) as entries:
+        names = [e.name for e in entries if e.is_file() and is_blob_name(e.name)]
+    for name in names:
+        if migrate_file(upload_dir, name):
+            moved += 1
+    return moved
+
+def split_key(key):
+    """Return (file id, sidecar extension) for a storage key"""
+    for ext in SIDECAR_EXTENSIONS:
+        if key.endswith(ext):
+            return key[:-len(ext)], ext
+    return key, ''
+
+def iter_chunks(data, chunk_size=CHUNK_SIZE):
+    """Split an in-memory payload into chunks without copying it"""
+    view = memoryview(data)
+    for offset in range(0, len(view), chunk_size):
+        yield view[offset:offset + chunk_size]
+
+def parse_range(header, size):
+    """Parse a single 'bytes=start-end' Range header.
+
+    Returns (start, length), None when the header is absent or not a single
+    byte range (serve the whole file), or False when it cannot be satisfied.
+    """
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+    start_text, _, end_text = header[6:].strip().partition('-')
+    try:
+        if not start_text:
+            # Suffix range: the last N bytes
+            suffix = int(end_text)
+            if suffix <= 0:
+                return False
+            start = max(size - suffix, 0)
+            end = size - 1
+        else:
+            start = int(start_text)
+            end = int(end_text) if end_text else size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        return False
+    end = min(end, size - 1)
+    return start, end - start + 1
+
+class StorageError(Exception):
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+INSUFFICIENT_STORAGE = 'Insufficient storage'
+
+def preallocate(fd, size):
+    """Reserve size bytes on disk for a file, raises StorageError (507) when they don't fit.
+
+    Filesystems without fallocate support are written the ordinary way.
+    """
+    if size <= 0 or not hasattr(os, 'posix_fallocate'):
+        return
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except OSError as e:
+        if e.errno in (errno.ENOSPC, errno.EDQUOT):
+            raise StorageError(INSUFFICIENT_STORAGE, 507)
+
+def advise(fd, offset, length, advice):
+    """posix_fadvise where the platform has it, hints never fail a transfer"""
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fd, offset, length, advice)
+        except OSError:
+            pass
+
+def drop_cache(fd, end):
+    """Ask the kernel to write back and forget the pages before end"""
+    if end > 0 and hasattr(os, 'POSIX_FADV_DONTNEED'):
+        advise(fd, 0, end, os.POSIX_FADV_DONTNEED)
+
+class LocalStorage:
+    """Files on the local disk in the sharded layout"""
+
+    name = 'local'
+
+    def __init__(self, upload_dir='uploads'):
+        self.upload_dir = upload_dir
+        os.makedirs(upload_dir, exist_ok=True)
+
+    def path(self, key):
+        """Filesystem path of a key, None for invalid names"""
+        file_id, ext = split_key(key)
+        blob_path = resolve_path(self.upload_dir, file_id)
+        if blob_path is None:
+            return None
+        return f"{blob_path}{ext}"
+
+    def reserve(self, filename):
+        """Claim a unique stored name, returns it"""
+        return os.path.basename(reserve_upload_path(self.upload_dir, filename))
+
+    def ensure_space(self, nbytes):
+        """Raise StorageError (507) up front when nbytes will not fit on the disk.
+
+        A quick check before a body is received, concurrent uploads can still
+        run out of space later, preallocation catches those.
+        """
+        if shutil.disk_usage(self.upload_dir).free < nbytes:
+            raise StorageError(INSUFFICIENT_STORAGE, 507)
+
+    def put_stream(self, key, chunks, size=None, mtime=None):
+        """Write chunks to a key, readers see either the old or the new content.
+
+        With the final size known up front the file is preallocated in one
+        extent. Bulk writes drop their pages from the cache as they go. An
+        mtime is kept on the new file, rewrites then leave its expiry alone.
+        """
+        path = self.path(key)
+        if path is None:
+            raise StorageError(f"Invalid key: {key}")
+        directory, name = os.path.split(path)
+        os.makedirs(directory, exist_ok=True)
+        # Hidden temporary name so listings and the cleaner skip it
+        temp_path = os.path.join(directory, f".{name}.{uuid.uuid4().hex}.tmp")
+        written = 0
+        try:
+            with open(temp_path, 'wb') as f:
+                fd = f.fileno()
+                if size is not None and size >= BULK_IO_BYTES:
+                    preallocate(fd, size)
+                dropped = 0
+                for chunk in chunks:
+                    f.write(chunk)
+                    written += len(chunk)
+                    if written >= BULK_IO_BYTES and written - dropped >= 2 * DROP_BEHIND_BYTES:
+                        # Starts writeback of all but the last window, pages already written back are freed
+                        f.flush()
+                        dropped = written - DROP_BEHIND_BYTES
+                        drop_cache(fd, dropped)
+                if size is not None and written != size:
+                    # Preallocation set the length, the estimate was off
+                    f.truncate(written)
+                if written >= BULK_IO_BYTES:
+                    f.flush()
+                    drop_cache(fd, written)
+            if mtime is not None:
+                os.utime(temp_path, (mtime, mtime))
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return written
+
+    def get_stream(self, key, start=0, length=None, chunk_size=CHUNK_SIZE):
+        """Yield the content of a key, optionally only a byte range.
+
+        Bulk reads ask for aggressive readahead and drop what the client
+        already has from the cache.
+        """
+        path = self.path(key)
+        if path is None:
+            raise FileNotFoundError(key)
+        with open(path, 'rb') as f:
+            fd = f.fileno()
+            span = os.fstat(fd).st_size - start if length is None else length
+            bulk = span >= BULK_IO_BYTES and hasattr(os, 'POSIX_FADV_SEQUENTIAL')
+            if bulk:
+                advise(fd, start, span, os.POSIX_FADV_SEQUENTIAL)
+            if start:
+                f.seek(start)
+            offset = dropped = start
+            remaining = length
+            while remaining is None or remaining > 0:
+                chunk = f.read(chunk_size if remaining is None else min(chunk_size, remaining))
+                if not chunk:
+                    break
+                offset += len(chunk)
+                if remaining is not None:
+                    remaining -= len(chunk)
+                if bulk and offset - dropped >= DROP_BEHIND_BYTES:
+                    advise(fd, dropped, offset - dropped, os.POSIX_FADV_DONTNEED)
+                    dropped = offset
+                yield chunk
+            if bulk and offset > dropped:
+                advise(fd, dropped, offset - dropped, os.POSIX_FADV_DONTNEED)
+
+    def delete(self, key):
+        path = self.path(key)
+        if path is None:
+            return False
+        try:
+            os.remove(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def stat(self, key):
+        """Return size, modification time and a version tag, or None"""
+        path = self.path(key)
+        if path is None:
+            return None
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return {'size': st.st_size, 'mtime': st.st_mtime, 'version': (st.st_mtime_ns, st.st_size)}
+
+    def list(self):
+        """Yield (file id, stat) for every stored file, sidecars excluded"""
+        for file_id, path in iter_stored_files(self.upload_dir):
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            yield file_id, {'size': st.st_size, 'mtime': st.st_mtime, 'version': (st.st_mtime_ns, st.st_size)}
+
+    def check(self):
+        return os.path.isdir(self.upload_dir)
+
+    def put_bytes(self, key, data):
+        return self.put_stream(key, iter_chunks(data), len(data))
+
+    def get_bytes(self, key):
+        path = self.path(key)
+        if path is None:
+            raise FileNotFoundError(key)
+        with open(path, 'rb') as f:
+            fd = f.fileno()
+            bulk = os.fstat(fd).st_size >= BULK_IO_BYTES and hasattr(os, 'POSIX_FADV_SEQUENTIAL')
+            if bulk:
+                advise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            data = f.read()
+            if bulk:
+                advise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            return data
+
+    def exists(self, key):
+        return self.stat(key) is not None
+
+class S3Storage:
+    """Files in an S3-compatible bucket (AWS, MinIO, Ceph...), stdlib only.
+
+    Requests are signed with AWS Signature V4 using UNSIGNED-PAYLOAD so bodies
+    can be streamed. Uploads larger than one part use multipart upload, reads
+    use ranged GETs.
+    """
+
+    name = 's3'
+
+    def __init__(self, endpoint, bucket, access_key, secret_key, region='us-east-1',
+                 part_size=8 * 1024 * 1024, timeout=300):
+        parts = urlsplit(endpoint)
+        self.secure = parts.scheme == 'https'
+        self.host = parts.netloc
+        self.bucket = bucket
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        # S3 rejects parts smaller than 5MB except for the last one
+        self.part_size = max(part_size, 5 * 1024 * 1024)
+        self.timeout = timeout
+
+    # Request signing
+
+    def _signing_key(self, date_stamp):
+        key = ('AWS4' + self.secret_key).encode()
+        for msg in (date_stamp, self.region, 's3', 'aws4_request'):
+            key = hmac.new(key, msg.encode(), hashlib.sha256).digest()
+        return key
+
+    def _sign(self, method, path, query, headers):
+        now = datetime.now(timezone.utc)
+        amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+        date_stamp = now.strftime('%Y%m%d')
+        headers['Host'] = self.host
+        headers['x-amz-date'] = amz_date
+        headers['x-amz-content-sha256'] = 'UNSIGNED-PAYLOAD'
+
+        canonical_query = '&'.join(
+            f"{quote(k, safe='-_.~')}={quote(v, safe='-_.~')}" for k, v in sorted(query.items())
+        )
+        signed = sorted((k.lower(), ' '.join(str(v).split())) for k, v in headers.items())
+        canonical_headers = ''.join(f"{k}:{v}\n" for k, v in signed)
+        signed_headers = ';'.join(k for k, _ in signed)
+        canonical_request = '\n'.join([
+            method, path, canonical_query, canonical_headers, signed_headers, 'UNSIGNED-PAYLOAD'
+        ])
+        scope = f"{date_stamp}/{self.region}/s3/aws4_request"
+        string_to_sign = '\n'.join([
+            'AWS4-HMAC-SHA256', amz_date, scope, hashlib.sha256(canonical_request.encode()).hexdigest()
+        ])
+        signature = hmac.new(self._signing_key(date_stamp), string_to_sign.encode(), hashlib.sha256).hexdigest()
+        headers['Authorization'] = (
+            f"AWS4-HMAC-SHA256 Credential={self.access_key}/{scope}, "
+            f"SignedHeaders={signed_headers}, Signature={signature}"
+        )
+        return canonical_query
+
+    def _request(self, method, key='', query=None, headers=None, body=None, expect=(200,)):
+        """Send a signed request, returns the open response (caller reads it)"""
+        query = query or {}
+        headers = dict(headers or {})
+        path = '/' + quote(self.bucket, safe='')
+        if key:
+            path += '/' + quote(key, safe='-_.~')
+        if body is not None:
+            headers['Content-Length'] = str(len(body))
+        canonical_query = self._sign(method, path, query, headers)
+        url = f"{path}?{canonical_query}" if canonical_query else path
+
+        conn_class = http.client.HTTPSConnection if self.secure else http.client.HTTPConnection
+        conn = conn_class(self.host, timeout=self.timeout)
+        conn.request(method, url, body=body, headers=headers)
+        response = conn.getresponse()
+        if response.status not in expect:
+            detail = response.read()[:200]
+            conn.close()
+            if response.status == 404:
+                raise FileNotFoundError(key)
+            raise StorageError(f"S3 {method} {key} failed: {response.status} {detail!r}", response.status)
+        response.connection = conn
+        return response
+
+    def _call(self, method, key='', **kwargs):
+        """Send a request and return (response, body)"""
+        response = self._request(method, key, **kwargs)
+        body = response.read()
+        response.connection.close()
+        return response, body
+
+    @staticmethod
+    def _xml_text(body, tag):
+        for element in ET.fromstring(body).iter():
+            if element.tag.split('}')[-1] == tag:
+                return element.text
+        return None
+
+    # Backend interface
+
+    def reserve(self, filename):
+        """Claim a unique stored name with a conditional (If-None-Match) PUT"""
+        if not is_valid_file_id(filename):
+            raise StorageError(f"Invalid key: {filename}")
+        name, ext = os.path.splitext(filename)
+        counter = 0
+        while True:
+            candidate = filename if counter == 0 else f"{name}_{counter}{ext}"
+            counter += 1
+            try:
+                self._call('PUT', candidate, body=b'', headers={'If-None-Match': '*'})
+                return candidate
+            except StorageError as e:
+                # 412: name already taken, 409: concurrent conditional write
+                if e.status in (409, 412):
+                    continue
+                raise
+
+    def ensure_space(self, nbytes):
+        """Buckets have no fixed size, nothing to check"""
+
+    def put_stream(self, key, chunks, size=None, mtime=None):
+        """Upload chunks, switching to multipart upload once a part is full.
+
+        S3 sets Last-Modified itself, mtime is ignored.
+        """
+        buffer = bytearray()
+        upload_id = None
+        etags = []
+        size = 0
+        try:
+            for chunk in chunks:
+                buffer += chunk
+                size += len(chunk)
+                while len(buffer) >= self.part_size:
+                    if upload_id is None:
+                        _, body = self._call('POST', key, query={'uploads': ''})
+                        upload_id = self._xml_text(body, 'UploadId')
+                    part = bytes(buffer[:self.part_size])
+                    del buffer[:self.part_size]
+                    etags.append(self._upload_part(key, upload_id, len(etags) + 1, part))
+
+            if upload_id is None:
+                # Small object, a single PUT is enough
+                self._call('PUT', key, body=bytes(buffer))
+                return size
+
+            if buffer:
+                etags.append(self._upload_part(key, upload_id, len(etags) + 1, bytes(buffer)))
+            parts = ''.join(
+                f"<Part><PartNumber>{n}</PartNumber><ETag>{etag}</ETag></Part>"
+                for n, etag in enumerate(etags, 1)
+            )
+            self._call('POST', key, query={'uploadId': upload_id},
+                       body=f"<CompleteMultipartUpload>{parts}</CompleteMultipartUpload>".encode())
+            return size
+        except BaseException:
+            if upload_id is not None:
+                try:
+                    self._call('DELETE', key, query={'uploadId': upload_id}, expect=(200, 204))
+                except Exception:
+                    pass
+            raise
+
+    def _upload_part(self, key, upload_id, number, data):
+        response, _ = self._call('PUT', key, query={'partNumber': str(number), 'uploadId': upload_id}, body=data)
+        return response.getheader('ETag')
+
+    def get_stream(self, key, start=0, length=None, chunk_size=CHUNK_SIZE):
+        """Yield the object, using a ranged GET for partial reads"""
+        headers = {}
+        if start or length is not None:
+            end = '' if length is None else str(start + length - 1)
+            headers['Range'] = f"bytes={start}-{end}"
+        response = self._request('GET', key, headers=headers, expect=(200, 206))
+        try:
+            while True:
+                chunk = response.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            response.connection.close()
+
+    def delete(self, key):
+        try:
+            self._call('DELETE', key, expect=(200, 204))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def stat(self, key):
+        try:
+            response, _ = self._call('HEAD', key)
+        except FileNotFoundError:
+            return None
+        modified = response.getheader('Last-Modified')
+        mtime = parsedate_to_datetime(modified).timestamp() if modified else 0
+        size = int(response.getheader('Content-Length', 0))
+        return {'size': size, 'mtime': mtime, 'version': response.getheader('ETag') or (mtime, size)}
+
+    def list(self):
+        """Yield (file id, stat) for every object, sidecars excluded"""
+        token = None
+        while True:
+            query = {'list-type': '2'}
+            if token:
+                query['continuation-token'] = token
+            _, body = self._call('GET', query=query)
+            root = ET.fromstring(body)
+            for element in root:
+                if element.tag.split('}')[-1] != 'Contents':
+                    continue
+                fields = {child.tag.split('}')[-1]: child.text for child in element}
+                key = fields.get('Key', '')
+                if not is_blob_name(key):
+                    continue
+                modified = datetime.fromisoformat(fields['LastModified'].replace('Z', '+00:00')).timestamp()
+                size = int(fields.get('Size', 0))
+                yield key, {'size': size, 'mtime': modified, 'version': fields.get('ETag') or (modified, size)}
+            if self._xml_text(body, 'IsTruncated') != 'true':
+                break
+            token = self._xml_text(body, 'NextContinuationToken')
+
+    def check(self):
+        try:
+            self._call('HEAD')
+            return True
+        except Exception:
+            return False
+
+    def put_bytes(self, key, data):
+        return self.put_stream(key, iter_chunks(data))
+
+    def get_bytes(self, key):
+        return b''.join(self.get_stream(key))
+
+    def exists(self, key):
+        return self.stat(key) is not None
+
+def create_storage(upload_dir='uploads'):
+    """Build the backend selected by STORAGE_BACKEND (local or s3)"""
+    backend = os.environ.get('STORAGE_BACKEND', 'local').lower()
+    if backend == 's3':
+        return S3Storage(
+            endpoint=os.environ.get('S3_ENDPOINT', 'http://localhost:9000'),
+            bucket=os.environ['S3_BUCKET'],
+            access_key=os.environ.get('S3_ACCESS_KEY', ''),
+            secret_key=os.environ.get('S3_SECRET_KEY', ''),
+            region=os.environ.get('S3_REGION', 'us-east-1'),
+            part_size=int(os.environ.get('S3_PART_SIZE', 8 * 1024 * 1024))
+        )
+    return LocalStorage(upload_dir)
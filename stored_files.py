@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+"""
+Stored files as both servers present and decode them
+
+StoredFiles holds what reads of a stored file need: the storage backend,
+the key, the payload cache, the memory budget and the processing queue
+whose staged copies stand in for uploads not yet processed. server.py keeps
+one per TransferApp, simple_server.py one at module level.
+"""
+
+import os
+import json
+from storage import iter_chunks, INSUFFICIENT_STORAGE
+from zip_stream import ZipStreamWriter, gzip_deflate_body
+from metrics import COMPRESSION_SECONDS, ENCRYPTION_SECONDS
+from memory_governor import decode_cost, iter_file, compress_spooled_file, close_spill, plaintext_chunks
+from fernet_stream import encrypt_stream, decrypt_stream, token_size
+from profiling import StageTimer
+from delta import make_signature
+from preview import token_prefix_length, decrypt_token_prefix, decode_prefix, text_snippet, SNIPPET_BYTES
+from processing import is_staged
+from compression_control import COMPRESSION_LEVEL
+from recompression import decompress, decompress_chunks
+
+def decompress_file_data(data, filename, was_compressed):
+    """Decompress file data if it was compressed"""
+    if not was_compressed:
+        return data
+    
+    try:
+        with COMPRESSION_SECONDS.labels('decompress').time():
+            return decompress(data)
+    except Exception as e:
+        print(f"⚠️ Decompression failed for {filename}: {e}")
+        return data  # Fallback to original if decompression fails
+
+def file_entry(filename, size, metadata):
+    """How a stored file appears in /files and in change events"""
+    staged = is_staged(metadata)
+    return {
+        'name': filename,
+        # Until processed only the staged copy holds the content
+        'size': metadata['stored_size'] if staged else size,
+        'original_size': metadata.get('original_size', size),
+        'was_compressed': metadata.get('was_compressed', False),
+        'file_id': metadata.get('file_id'),
+        'processing': staged
+    }
+
+def upload_error_status(result):
+    """HTTP status for a failed upload result"""
+    if result['error'] == INSUFFICIENT_STORAGE:
+        return 507
+    return 400 if result['error'] in ('Invalid filename', 'Checksum mismatch') else 500
+
+def read_metadata(file_store, filename):
+    """Load the .meta sidecar of a stored file, empty if it is missing"""
+    try:
+        return json.loads(file_store.get_bytes(f"{filename}.meta"))
+    except Exception:
+        return {}
+
+def in_flight(file_store, filename):
+    """Whether a name is only reserved so far, uploads write the .meta sidecar last"""
+    return file_store.stat(f"{filename}.meta") is None
+
+def list_stored_files(file_store):
+    """Yield (file id, stat, metadata) for every stored file, names reserved by uploads in flight excluded"""
+    for filename, info in file_store.list():
+        metadata = read_metadata(file_store, filename)
+        if metadata:
+            yield filename, info, metadata
+
+class StoredFiles:
+    """Decoding, previews, signatures, archives and background processing of the files in a storage backend"""
+    
+    def __init__(self, file_store, key, fernet, content_cache, decode_flights, signatures, memory, processing,
+                 analytics, changes):
+        self.file_store = file_store
+        self.key = key
+        self.fernet = fernet
+        self.content_cache = content_cache
+        self.decode_flights = decode_flights
+        self.signatures = signatures
+        self.memory = memory
+        self.processing = processing
+        self.analytics = analytics
+        self.changes = changes
+    
+    def read_metadata(self, filename):
+        return read_metadata(self.file_store, filename)
+    
+    def process_staged(self, filename):
+        """Compress, encrypt and index a staged upload, the job run by the processing queue"""
+        staged = self.processing.claim(filename)
+        if staged is None:
+            # Processed or deleted already, or another job is on it
+            return
+        with staged:
+            metadata = self.read_metadata(filename)
+            if not is_staged(metadata):
+                return
+            original_size = metadata['original_size']
+            # Same rules as uploads processed on the request thread
+            if original_size > 100 * 1024 * 1024:
+                payload, compressed_size, was_compressed = staged, original_size, False
+            else:
+                payload, compressed_size, was_compressed = compress_spooled_file(
+                    staged, original_size, filename, self.memory.spill_dir, COMPRESSION_LEVEL, self.processing.backlog())
+            try:
+                stored_size = self.file_store.put_stream(filename, encrypt_stream(self.key, iter_file(payload)),
+                                                         token_size(compressed_size))
+            finally:
+                if payload is not staged:
+                    close_spill(payload)
+            
+            client_ip = metadata.pop('client_ip', None)
+            del metadata['state']
+            metadata.update(compressed_size=compressed_size, was_compressed=was_compressed, stored_size=stored_size)
+            self.file_store.put_bytes(f"{filename}.meta", json.dumps(metadata).encode())
+            # Readers move from the staged copy to the stored file once it is gone
+            if not self.processing.discard(filename):
+                # Deleted while it was processed
+                for key in [filename, f"{filename}.meta", f"{filename}.token"]:
+                    self.file_store.delete(key)
+                return
+        
+        file_type = os.path.splitext(filename)[1].lower() or 'unknown'
+        self.analytics.log_uploads([(metadata['file_id'], filename, original_size, file_type, client_ip,
+                                     compressed_size, was_compressed)])
+        self.changes.publish('add', filename, file_entry(filename, stored_size, metadata))
+        print(f"⚙️ Processed upload: {filename}")
+    
+    def open_staged(self, filename, metadata, info):
+        """(staged copy, metadata, info) of a stored file.
+        
+        The staged copy is an open file while the upload is being processed,
+        else None. metadata and info are read again if processing finished
+        since they were.
+        """
+        if not is_staged(metadata):
+            return None, metadata, info
+        staged = self.processing.open_staged(filename)
+        if staged is None:
+            return None, self.read_metadata(filename), self.file_store.stat(filename) or info
+        return staged, metadata, info
+    
+    def decode_stored_file(self, filename, was_compressed, version, timer=None):
+        """Decrypt and decompress a stored file, caching the result"""
+        timer = timer or StageTimer()
+        with timer.stage('read'):
+            encrypted_data = self.file_store.get_bytes(filename)
+        
+        # Decrypt first, then decompress if needed
+        with timer.stage('decrypt'), ENCRYPTION_SECONDS.labels('decrypt').time():
+            decrypted_data = self.fernet.decrypt(encrypted_data)
+        with timer.stage('decompress'):
+            final_data = decompress_file_data(decrypted_data, filename, was_compressed)
+        self.content_cache.put(filename, version, final_data)
+        return final_data
+    
+    def decode_to_spill(self, filename, was_compressed):
+        """Decrypt and decompress a stored file into a temporary file, returns (file, size).
+        
+        Holds a chunk at a time in memory. Raises InvalidToken for a damaged
+        file, only after the whole file has been checked.
+        """
+        chunks = decrypt_stream(self.key, self.file_store.get_stream(filename))
+        if was_compressed:
+            chunks = decompress_chunks(chunks)
+        return self.memory.spool(chunks)
+    
+    def open_plaintext(self, filename, metadata, info):
+        """Decoded content of a stored file as (data, size, reservation).
+        
+        data is bytes from the payload cache or a decode within the memory
+        budget, else a temporary file. Close it with close_spill and release
+        the reservation, if any, when done.
+        """
+        staged, metadata, info = self.open_staged(filename, metadata, info)
+        if staged is not None:
+            return staged, metadata['original_size'], None
+        version = info['version']
+        data = self.content_cache.get(filename, version)
+        if data is not None:
+            return data, len(data), None
+        was_compressed = metadata.get('was_compressed', False)
+        reservation = self.memory.reserve(decode_cost(info['size'], metadata.get('original_size', info['size'])))
+        if reservation is None:
+            spill, size = self.decode_to_spill(filename, was_compressed)
+            return spill, size, None
+        try:
+            data = self.decode_flights.do((filename, version),
+                                          lambda: self.decode_stored_file(filename, was_compressed, version))
+        except BaseException:
+            reservation.release()
+            raise
+        return data, len(data), reservation
+    
+    def read_plaintext(self, filename, metadata, version):
+        """Whole decoded content of a stored file, from the staged copy while it is being processed"""
+        staged, metadata, _ = self.open_staged(filename, metadata, None)
+        if staged is not None:
+            with staged:
+                return staged.read()
+        return self.decode_stored_file(filename, metadata.get('was_compressed', False), version)
+
+    def file_signature(self, filename, info):
+        """Delta signature of a stored file, computed once per version"""
+        signature = self.signatures.get(filename, info['version'])
+        if signature is None:
+            data, size, reservation = self.open_plaintext(filename, self.read_metadata(filename), info)
+            try:
+                signature = make_signature(plaintext_chunks(data), size)
+            finally:
+                close_spill(data)
+                if reservation is not None:
+                    reservation.release()
+            self.signatures.put(filename, info['version'], signature)
+        return signature
+    
+    def text_preview(self, filename, metadata, info):
+        """Snippet of the start of a file from its first few encrypted blocks, None if binary"""
+        staged, metadata, info = self.open_staged(filename, metadata, info)
+        stored_size = info['size']
+        was_compressed = metadata.get('was_compressed', False)
+        # Compressed text expands, twice the snippet in ciphertext is plenty
+        wanted = SNIPPET_BYTES * 2 if was_compressed else SNIPPET_BYTES
+        length = token_prefix_length(wanted)
+        if staged is not None:
+            with staged:
+                data = staged.read(SNIPPET_BYTES + 1)
+            complete = len(data) <= SNIPPET_BYTES
+        elif stored_size <= length:
+            # Small file, decode it whole
+            data = decompress_file_data(self.fernet.decrypt(self.file_store.get_bytes(filename)), filename, was_compressed)
+            complete = len(data) <= SNIPPET_BYTES
+        else:
+            prefix = b''.join(self.file_store.get_stream(filename, 0, length))
+            data = decode_prefix(decrypt_token_prefix(self.key, prefix, wanted), was_compressed, SNIPPET_BYTES)
+            complete = False
+        data = data[:SNIPPET_BYTES]
+        snippet = text_snippet(data, complete)
+        if snippet is None:
+            return None
+        return {'snippet': snippet, 'truncated': not complete}
+    
+    def stream_archive(self, entries):
+        """Yield a ZIP64 archive of stored files, decoding one member at a time"""
+        archive = ZipStreamWriter()
+        for filename, info in entries:
+            metadata = self.read_metadata(filename)
+            spill, metadata, info = self.open_staged(filename, metadata, info)
+            cached = self.content_cache.get(filename, info['version']) if spill is None else None
+            reservation = None
+            if cached is None and spill is None:
+                reservation = self.memory.reserve(decode_cost(info['size'], metadata.get('original_size', info['size'])))
+            if spill is not None:
+                members = archive.add(filename, iter_file(spill), modified=info['mtime'])
+            elif cached is not None:
+                members = archive.add(filename, iter_chunks(cached), modified=info['mtime'])
+            elif reservation is None:
+                spill, _ = self.decode_to_spill(filename, metadata.get('was_compressed'))
+                members = archive.add(filename, iter_file(spill), modified=info['mtime'])
+            else:
+                with ENCRYPTION_SECONDS.labels('decrypt').time():
+                    payload = self.fernet.decrypt(self.file_store.get_bytes(filename))
+                deflated = gzip_deflate_body(payload) if metadata.get('was_compressed') else None
+                if deflated:
+                    # Gzip payloads already hold a raw deflate stream, copy it as is
+                    body, crc, size = deflated
+                    members = archive.add_deflated(filename, iter_chunks(body), crc, size, modified=info['mtime'])
+                else:
+                    payload = decompress_file_data(payload, filename, metadata.get('was_compressed'))
+                    members = archive.add(filename, iter_chunks(payload), modified=info['mtime'])
+            try:
+                for piece in members:
+                    yield piece
+            finally:
+                close_spill(spill)
+                if reservation is not None:
+                    reservation.release()
+            # Drop this member's payload before decrypting the next one
+            members = cached = payload = None
+            self.analytics.increment_download(metadata.get('file_id'), filename)
+        for piece in archive.finish():
+            yield piece
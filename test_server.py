@@ -8,7 +8,115 @@ import tempfile
 import requests
 import time
 import threading
-from server import FileTransferHandler, get_or_create_key, compress_file_data, decompress_file_data
+from contextlib import contextmanager
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs, unquote
+from server import FileTransferHandler, FileCleaner, get_or_create_key, compress_file_data, decompress_file_data
+
+def app_paths(folder):
+    """create_app() arguments keeping every file of an app in folder"""
+    return dict(key_file=os.path.join(folder, 'encryption.key'), db_path=os.path.join(folder, 'analytics.db'),
+                upload_dir=os.path.join(folder, 'uploads'))
+
+@contextmanager
+def running_app(folder):
+    """A server.py app with its files in folder, served on a free port, yields (app, url)"""
+    from server import create_app, ThreadedHTTPServer
+    app = create_app(**app_paths(folder))
+    server = ThreadedHTTPServer(('127.0.0.1', 0), FileTransferHandler, app)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield app, f"http://127.0.0.1:{server.server_address[1]}"
+    finally:
+        server.shutdown()
+        server.server_close()
+        app.stop()
+
+class FakeS3Handler(BaseHTTPRequestHandler):
+    """Minimal in-memory S3 stand-in for the storage backend tests"""
+    objects = {}
+    uploads = {}
+    
+    def log_message(self, format, *args):
+        return
+    
+    def _target(self):
+        parts = urlsplit(self.path)
+        segments = parts.path.lstrip('/').split('/', 1)
+        key = unquote(segments[1]) if len(segments) > 1 else ''
+        return key, {k: v[0] for k, v in parse_qs(parts.query, keep_blank_values=True).items()}
+    
+    def _reply(self, status, body=b'', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+    
+    def _body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+    
+    def do_PUT(self):
+        key, query = self._target()
+        body = self._body()
+        if 'uploadId' in query:
+            self.uploads[query['uploadId']][int(query['partNumber'])] = body
+            return self._reply(200, headers={'ETag': f'"part{query["partNumber"]}"'})
+        if self.headers.get('If-None-Match') == '*' and key in self.objects:
+            return self._reply(412)
+        self.objects[key] = body
+        self._reply(200, headers={'ETag': f'"{len(body)}"'})
+    
+    def do_POST(self):
+        key, query = self._target()
+        self._body()
+        if 'uploads' in query:
+            upload_id = f"upload{len(self.uploads)}"
+            self.uploads[upload_id] = {}
+            return self._reply(200, f"<InitiateMultipartUploadResult><UploadId>{upload_id}</UploadId></InitiateMultipartUploadResult>".encode())
+        parts = self.uploads.pop(query['uploadId'])
+        self.objects[key] = b''.join(parts[n] for n in sorted(parts))
+        self._reply(200, b"<CompleteMultipartUploadResult/>")
+    
+    def do_GET(self):
+        key, query = self._target()
+        if not key:
+            contents = ''.join(
+                f"<Contents><Key>{k}</Key><LastModified>2024-01-01T00:00:00.000Z</LastModified><Size>{len(v)}</Size></Contents>"
+                for k, v in sorted(self.objects.items())
+            )
+            return self._reply(200, f"<ListBucketResult><IsTruncated>false</IsTruncated>{contents}</ListBucketResult>".encode())
+        if key not in self.objects:
+            return self._reply(404)
+        data = self.objects[key]
+        byte_range = self.headers.get('Range')
+        if byte_range:
+            start, _, end = byte_range[6:].partition('-')
+            end = int(end) if end else len(data) - 1
+            return self._reply(206, data[int(start):end + 1])
+        self._reply(200, data)
+    
+    def do_HEAD(self):
+        key, _ = self._target()
+        if key and key not in self.objects:
+            return self._reply(404)
+        size = len(self.objects.get(key, b''))
+        self.send_response(200)
+        self.send_header('Content-Length', str(size))
+        self.send_header('Last-Modified', 'Mon, 01 Jan 2024 00:00:00 GMT')
+        self.end_headers()
+    
+    def do_DELETE(self):
+        key, query = self._target()
+        if 'uploadId' in query:
+            self.uploads.pop(query['uploadId'], None)
+        elif key not in self.objects:
+            return self._reply(404)
+        else:
+            del self.objects[key]
+        self._reply(204)
 
 def test_encryption():
     """Test encryption key generation and persistence"""
@@ -55,6 +163,1136 @@ def test_compression():
     
     return True
 
+def test_adaptive_compression():
+    """Test the compression level picked from load and measured speed and ratio"""
+    print("🎚️ Testing adaptive compression levels...")
+    
+    from compression_control import LevelController, EXPLORE_EVERY
+    
+    MB = 1024 * 1024
+    controller = LevelController(min_speed=20 * MB, cpus=1)
+    load = {'pressure': 0.0}
+    controller.pressure = lambda queued=0: (load['pressure'], load['pressure'], queued)
+    
+    if controller.choose('first.txt') != 9:
+        print("❌ An idle server should try the strongest level on a new file type")
+        return False
+    # Level 9 costs more than 6 on this type and shrinks it no further
+    controller.record('a.txt', 9, 8 * MB, 3.74 * MB, 8 / 30)
+    controller.record('a.txt', 6, 8 * MB, 3.75 * MB, 8 / 35)
+    if controller.choose('b.txt') != 6:
+        print("❌ A stronger level should only be used when it saves space")
+        return False
+    load['pressure'] = 0.5
+    if controller.choose('c.txt') != 3:
+        print("❌ Under load only levels fast enough should be used")
+        return False
+    load['pressure'] = 0.95
+    if controller.choose('d.txt') != 1 or controller.choose('e.bin') != 0:
+        print("❌ A saturated server should store files unless they compress well")
+        return False
+    
+    load['pressure'] = 0.0
+    controller.record('e.bin', 1, 8 * MB, 7.9 * MB, 8 / 60)
+    levels = [controller.choose('f.bin') for _ in range(EXPLORE_EVERY)]
+    if levels.count(0) != EXPLORE_EVERY - 1 or levels.count(1) != 1:
+        print(f"❌ Types that barely compress should be stored and remeasured now and then, got {levels}")
+        return False
+    
+    data = b"Level zero keeps the data as it is. " * 1000
+    if compress_file_data(data, 'stored.txt', 0) != (data, len(data), False):
+        print("❌ Level 0 should store the data as is")
+        return False
+    payload, _, was_compressed = compress_file_data(data, 'chosen.txt', None)
+    if not was_compressed or decompress_file_data(payload, 'chosen.txt', True) != data:
+        print("❌ A level chosen by the controller should round-trip")
+        return False
+    
+    print("✅ Compression levels follow load, speed and ratio")
+    return True
+
+def test_content_cache():
+    """Test decoded content cache budget, eviction and invalidation"""
+    print("🧠 Testing content cache...")
+    
+    from content_cache import ContentCache
+    
+    cache = ContentCache(max_bytes=300, max_item_bytes=200)
+    cache.put("a.txt", 1, b"a" * 100)
+    cache.put("b.txt", 1, b"b" * 100)
+    cache.get("a.txt", 1)  # a is now most recently used
+    cache.put("c.txt", 1, b"c" * 150)
+    
+    if cache.get("b.txt", 1) is not None or cache.get("a.txt", 1) is None:
+        print("❌ Least recently used entry was not evicted")
+        return False
+    
+    if cache.put("big.bin", 1, b"x" * 250) or cache.get("a.txt", 2) is not None:
+        print("❌ Oversized entries or stale versions should bypass the cache")
+        return False
+    
+    cache.invalidate("a.txt")
+    stats = cache.stats()
+    if cache.get("a.txt", 1) is not None or stats['evictions'] != 1 or stats['current_bytes'] != 150:
+        print("❌ Cache invalidation or accounting failed")
+        return False
+    
+    print("✅ Content cache evicts, bypasses and invalidates correctly")
+    return True
+
+def test_single_flight():
+    """Test that concurrent decodes of the same key run only once"""
+    print("🛫 Testing single-flight coalescing...")
+    
+    from content_cache import SingleFlight
+    
+    flights = SingleFlight()
+    calls = []
+    release = threading.Event()
+    
+    def slow_decode():
+        calls.append(1)
+        release.wait(5)
+        return b"decoded"
+    
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(flights.do("f.txt", slow_decode))) for _ in range(8)]
+    for t in threads:
+        t.start()
+    while flights.stats()['decode_coalesced'] < 7:
+        time.sleep(0.01)
+    release.set()
+    for t in threads:
+        t.join()
+    
+    if len(calls) != 1 or results != [b"decoded"] * 8:
+        print(f"❌ Expected one decode for 8 callers, got {len(calls)}")
+        return False
+    
+    print("✅ Concurrent callers shared a single decode")
+    return True
+
+def test_reserve_upload_path():
+    """Test that duplicate uploads claim distinct names"""
+    print("📛 Testing upload name reservation...")
+    
+    from storage import reserve_upload_path, StorageError
+    
+    with tempfile.TemporaryDirectory() as upload_dir:
+        paths = [reserve_upload_path(upload_dir, "report.pdf") for _ in range(3)]
+        names = [os.path.basename(p) for p in paths]
+        
+        if names != ["report.pdf", "report_1.pdf", "report_2.pdf"]:
+            print(f"❌ Unexpected reserved names: {names}")
+            return False
+        
+        try:
+            reserve_upload_path(upload_dir, ".env")
+            print("❌ Hidden names should not be reserved")
+            return False
+        except StorageError:
+            pass
+    
+    # Dot files are stored without the leading dot, not left behind as hidden placeholders
+    with tempfile.TemporaryDirectory() as tmp:
+        with running_app(tmp) as (app, url):
+            raw = requests.put(f"{url}/upload/.env", data=b"SECRET=1\n")
+            form = requests.post(f"{url}/upload", files={'file': ('.bashrc', b"alias ll='ls -l'\n")})
+            if raw.status_code != 200 or form.status_code != 200:
+                print(f"❌ Dot file uploads failed with {raw.status_code} and {form.status_code}")
+                return False
+            if sorted(entry['name'] for entry in requests.get(f"{url}/files").json()) != ['bashrc', 'env']:
+                print("❌ Dot files should be stored without the leading dot")
+                return False
+            if requests.get(f"{url}/download/env").content != b"SECRET=1\n":
+                print("❌ A renamed dot file should download unchanged")
+                return False
+            hidden = [name for _, _, files in os.walk(os.path.join(tmp, 'uploads')) for name in files if name.startswith('.')]
+            if hidden:
+                print(f"❌ Uploads left hidden files behind: {hidden}")
+                return False
+            
+            # A name reserved by an upload still in flight is not a file yet
+            pending = app.file_store.reserve('pending.txt')
+            if pending in [entry['name'] for entry in requests.get(f"{url}/files").json()]:
+                print("❌ /files should leave out names reserved by uploads in flight")
+                return False
+            if requests.delete(f"{url}/delete/{pending}", headers={'X-Owner-Token': 'guess'}).status_code != 404:
+                print("❌ Deleting a name reserved by an upload in flight should be a 404")
+                return False
+            
+            # Abandoned for a day, the cleaner removes it without announcing an expiry
+            day_ago = time.time() - 86400 - 60
+            os.utime(app.file_store.path(pending), (day_ago, day_ago))
+            seq = app.changes.latest()
+            cleaner = FileCleaner(app)
+            cleaner.start()
+            deadline = time.time() + 10
+            while app.file_store.stat(pending) is not None and time.time() < deadline:
+                time.sleep(0.05)
+            cleaner.stopped.set()
+            if app.file_store.stat(pending) is not None or app.changes.latest() != seq:
+                print("❌ The cleaner should quietly remove abandoned reservations")
+                return False
+            if len(requests.get(f"{url}/files").json()) != 2:
+                print("❌ The cleaner should leave fresh files alone")
+                return False
+    
+    print("✅ Duplicate names are reserved atomically, dot files get visible names and reservations stay hidden")
+    return True
+
+def test_sharded_layout():
+    """Test hashed upload layout and online migration from the flat layout"""
+    print("🗂️ Testing sharded upload layout...")
+    
+    from storage import resolve_path, iter_stored_files, migrate_flat_layout
+    
+    with tempfile.TemporaryDirectory() as upload_dir:
+        # A file left over from the flat layout
+        for name in ["old.txt", "old.txt.meta", "old.txt.token"]:
+            with open(os.path.join(upload_dir, name), 'w') as f:
+                f.write(name)
+        
+        if resolve_path(upload_dir, "old.txt") != os.path.join(upload_dir, "old.txt"):
+            print("❌ Flat layout files should still resolve before migration")
+            return False
+        
+        if migrate_flat_layout(upload_dir) != 1:
+            print("❌ Migration did not move the flat file")
+            return False
+        
+        path = resolve_path(upload_dir, "old.txt")
+        if path == os.path.join(upload_dir, "old.txt") or not os.path.exists(f"{path}.meta"):
+            print("❌ File and sidecars should live in a shard after migration")
+            return False
+        
+        if [name for name, _ in iter_stored_files(upload_dir)] != ["old.txt"]:
+            print("❌ Listing should only return the stored blob")
+            return False
+        
+        if resolve_path(upload_dir, "../secret") is not None:
+            print("❌ Path traversal names must be rejected")
+            return False
+    
+    print("✅ Files are sharded and migrated online")
+    return True
+
+def check_storage_backend(store):
+    """Exercise the storage interface shared by all backends"""
+    name = store.reserve("data.bin")
+    if store.reserve("data.bin") != "data_1.bin":
+        return "duplicate reservation"
+    
+    payload = os.urandom(200 * 1024)
+    chunks = [payload[i:i + 50000] for i in range(0, len(payload), 50000)]
+    if store.put_stream(name, iter(chunks)) != len(payload):
+        return "put_stream size"
+    store.put_bytes(f"{name}.meta", b"{}")
+    
+    if b"".join(store.get_stream(name)) != payload:
+        return "get_stream content"
+    if b"".join(store.get_stream(name, 1000, 5000)) != payload[1000:6000]:
+        return "ranged get_stream"
+    if store.stat(name)['size'] != len(payload) or store.stat("missing.bin") is not None:
+        return "stat"
+    if sorted(n for n, _ in store.list()) != ["data.bin", "data_1.bin"]:
+        return "list"
+    
+    store.delete(name)
+    if store.exists(name) or store.delete(name):
+        return "delete"
+    return None
+
+def test_storage_backends():
+    """Test local and S3 storage backends against the same interface"""
+    print("🗄️ Testing storage backends...")
+    
+    from storage import LocalStorage, S3Storage
+    
+    with tempfile.TemporaryDirectory() as upload_dir:
+        problem = check_storage_backend(LocalStorage(upload_dir))
+        if problem:
+            print(f"❌ Local storage failed: {problem}")
+            return False
+    
+    # S3 backend against an in-process stand-in, small parts force multipart upload
+    FakeS3Handler.objects = {}
+    FakeS3Handler.uploads = {}
+    fake_s3 = HTTPServer(('127.0.0.1', 0), FakeS3Handler)
+    threading.Thread(target=fake_s3.serve_forever, daemon=True).start()
+    try:
+        store = S3Storage(f"http://127.0.0.1:{fake_s3.server_address[1]}", "bucket", "key", "secret")
+        store.part_size = 64 * 1024
+        problem = check_storage_backend(store)
+        if problem:
+            print(f"❌ S3 storage failed: {problem}")
+            return False
+    finally:
+        fake_s3.shutdown()
+        fake_s3.server_close()
+    
+    print("✅ Local and S3 backends behave the same")
+    return True
+
+def test_bulk_io():
+    """Test preallocated bulk writes, cache hints on reads and the disk space check"""
+    print("🗄️ Testing bulk disk I/O...")
+    
+    import http.client
+    import storage
+    from storage import LocalStorage, StorageError
+    
+    threshold = storage.BULK_IO_BYTES
+    storage.BULK_IO_BYTES = 1024 * 1024
+    try:
+        with tempfile.TemporaryDirectory() as upload_dir:
+            store = LocalStorage(upload_dir)
+            payload = os.urandom(20 * 1024 * 1024 + 123)
+            # An estimate above the real size must not leave preallocated bytes behind
+            if store.put_stream("bulk.bin", storage.iter_chunks(payload), len(payload) + 5000) != len(payload):
+                print("❌ put_stream should return the bytes written")
+                return False
+            if store.stat("bulk.bin")['size'] != len(payload) or store.get_bytes("bulk.bin") != payload:
+                print("❌ Preallocated files should be truncated to what was written")
+                return False
+            if (b"".join(store.get_stream("bulk.bin")) != payload
+                    or b"".join(store.get_stream("bulk.bin", 3000, 9 * 1024 * 1024)) != payload[3000:3000 + 9 * 1024 * 1024]):
+                print("❌ Bulk reads should return the stored content")
+                return False
+            try:
+                store.ensure_space(1 << 62)
+                print("❌ An upload larger than the disk should be refused")
+                return False
+            except StorageError as e:
+                if e.status != 507:
+                    print(f"❌ Expected 507 for a full disk, got {e.status}")
+                    return False
+    finally:
+        storage.BULK_IO_BYTES = threshold
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        with running_app(tmp) as (app, url):
+            # Only the headers are sent, the answer must not wait for the body
+            conn = http.client.HTTPConnection('127.0.0.1', urlsplit(url).port, timeout=5)
+            conn.putrequest('PUT', '/upload/huge.bin')
+            conn.putheader('Content-Length', str(1 << 62))
+            conn.endheaders()
+            status = conn.getresponse().status
+            conn.close()
+            if status != 507:
+                print(f"❌ Uploads the disk cannot hold should get 507 up front, got {status}")
+                return False
+    
+    print("✅ Bulk writes are preallocated and full disks are reported early")
+    return True
+
+def test_zip_stream():
+    """Test streamed ZIP64 archives open with the zipfile module"""
+    print("📦 Testing streaming ZIP archives...")
+    
+    import io
+    import gzip
+    import zipfile
+    from zip_stream import ZipStreamWriter, gzip_deflate_body
+    
+    text = b"B-Transfer archive test line. " * 5000
+    binary = os.urandom(300 * 1024)
+    
+    deflated = gzip_deflate_body(gzip.compress(text, compresslevel=6))
+    if deflated is None:
+        print("❌ Gzip payload should split into a raw deflate stream")
+        return False
+    body, crc, size = deflated
+    
+    archive = ZipStreamWriter()
+    out = io.BytesIO()
+    for piece in archive.add_deflated("notes.txt", [body], crc, size):
+        out.write(piece)
+    for piece in archive.add("photo.jpg", [binary[:100000], binary[100000:]]):
+        out.write(piece)
+    for piece in archive.add("café.txt", [text], compress=True):
+        out.write(piece)
+    for piece in archive.finish():
+        out.write(piece)
+    
+    with zipfile.ZipFile(io.BytesIO(out.getvalue())) as zf:
+        if zf.testzip() is not None:
+            print("❌ Archive failed its CRC check")
+            return False
+        if zf.namelist() != ["notes.txt", "photo.jpg", "café.txt"]:
+            print(f"❌ Unexpected members: {zf.namelist()}")
+            return False
+        if zf.read("notes.txt") != text or zf.read("photo.jpg") != binary or zf.read("café.txt") != text:
+            print("❌ Archive members do not round-trip")
+            return False
+        if zf.getinfo("photo.jpg").compress_type != zipfile.ZIP_STORED:
+            print("❌ Stored members should not be recompressed")
+            return False
+    
+    print("✅ Streamed archives round-trip")
+    return True
+
+def test_multipart_stream():
+    """Test the streaming multipart parser on a multi-file body"""
+    print("📨 Testing streaming multipart parser...")
+    
+    import io
+    from multipart_stream import MultipartReader, get_boundary
+    
+    boundary = get_boundary('multipart/form-data; boundary="----b-transfer"')
+    if boundary != '----b-transfer':
+        print(f"❌ Wrong boundary: {boundary}")
+        return False
+    
+    files = [("a.txt", b"hello\r\n--not-a-boundary\r\n"), ("b.bin", os.urandom(10000)), ("c.txt", b"")]
+    body = b"preamble\r\n"
+    body += f'--{boundary}\r\nContent-Disposition: form-data; name="note"\r\n\r\nbatch\r\n'.encode()
+    for name, data in files:
+        body += (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{name}"\r\n'
+                 'Content-Type: application/octet-stream\r\n\r\n').encode() + data + b"\r\n"
+    body += f'--{boundary}--\r\n'.encode()
+    
+    # A tiny block size makes delimiters straddle reads
+    parts = [(part.name, part.filename, part.read())
+             for part in MultipartReader(io.BytesIO(body), boundary, len(body), block_size=7)]
+    if parts != [("note", None, b"batch")] + [("file", name, data) for name, data in files]:
+        print("❌ Parts were not split correctly")
+        return False
+    
+    # Unread parts are skipped, a truncated body is an error
+    if [part.filename for part in MultipartReader(io.BytesIO(body), boundary, len(body))] != [None, "a.txt", "b.bin", "c.txt"]:
+        print("❌ Skipping unread parts failed")
+        return False
+    try:
+        for part in MultipartReader(io.BytesIO(body[:-100]), boundary, len(body) - 100):
+            part.read()
+        print("❌ Truncated body should raise")
+        return False
+    except ValueError:
+        pass
+    
+    print("✅ Multipart bodies are streamed part by part")
+    return True
+
+def test_request_body():
+    """Test raw request bodies with Content-Length and chunked encoding"""
+    print("📥 Testing raw request bodies...")
+    
+    import io
+    from request_body import RequestBodyError, iter_request_body
+    
+    payload = os.urandom(5000)
+    body = b"".join(iter_request_body(io.BytesIO(payload), {'Content-Length': '5000'}, 10000, chunk_size=1024))
+    if body != payload:
+        print("❌ Content-Length body was not read back")
+        return False
+    
+    chunked = b"".join(b"%x;ext=1\r\n" % len(payload[i:i + 1500]) + payload[i:i + 1500] + b"\r\n"
+                       for i in range(0, len(payload), 1500)) + b"0\r\nX-Trailer: 1\r\n\r\n"
+    body = b"".join(iter_request_body(io.BytesIO(chunked), {'Transfer-Encoding': 'chunked'}, 10000))
+    if body != payload:
+        print("❌ Chunked body was not decoded")
+        return False
+    
+    for stream, headers, status in [
+        (io.BytesIO(payload), {}, 411),
+        (io.BytesIO(payload), {'Content-Length': '5000'}, 413),
+        (io.BytesIO(chunked), {'Transfer-Encoding': 'chunked'}, 413),
+        (io.BytesIO(payload[:100]), {'Content-Length': '200'}, 400),
+    ]:
+        try:
+            b"".join(iter_request_body(stream, headers, 4000))
+            print(f"❌ Expected a {status} error")
+            return False
+        except RequestBodyError as e:
+            if e.status != status:
+                print(f"❌ Expected status {status}, got {e.status}")
+                return False
+    
+    print("✅ Raw and chunked bodies are read correctly")
+    return True
+
+def test_checksums():
+    """Test upload digests, client digest headers and ETag matching"""
+    print("🔏 Testing checksums...")
+    
+    import base64
+    import hashlib
+    import zlib
+    from checksums import StreamDigest, expected_sha256, content_digest, etag_for, etag_matches
+    
+    payload = os.urandom(100000)
+    digest = StreamDigest()
+    if digest.read([payload[:30000], payload[30000:]]) != payload:
+        print("❌ Digest read changed the payload")
+        return False
+    sha256 = hashlib.sha256(payload).hexdigest()
+    if digest.checksums() != {'sha256': sha256, 'crc32': f'{zlib.crc32(payload):08x}'}:
+        print("❌ Incremental checksums are wrong")
+        return False
+    
+    encoded = base64.b64encode(bytes.fromhex(sha256)).decode()
+    for headers in [{'content-digest': content_digest(sha256)},
+                    {'content-digest': f'md5=:abc:, sha-256=:{encoded}:'},
+                    {'digest': f'SHA-256={encoded}'},
+                    {'x-content-sha256': sha256.upper()}]:
+        if expected_sha256(headers) != sha256:
+            print(f"❌ Digest header not understood: {headers}")
+            return False
+    if expected_sha256({}) is not None or expected_sha256({'content-digest': 'sha-256=:!!:'}) == sha256:
+        print("❌ Missing or broken digest headers must not match")
+        return False
+    
+    etag = etag_for({'sha256': sha256})
+    if not etag_matches(f'"other", W/{etag}', etag) or not etag_matches('*', etag) or etag_matches('"other"', etag):
+        print("❌ If-None-Match comparison is wrong")
+        return False
+    if etag_for({}) is not None or etag_matches('*', None):
+        print("❌ Files without a checksum must not get an ETag")
+        return False
+    
+    print("✅ Checksums and validators work")
+    return True
+
+def test_bandwidth():
+    """Test download rate limits and fair sharing"""
+    print("🚦 Testing bandwidth shaping...")
+    
+    from bandwidth import BandwidthManager
+    
+    manager = BandwidthManager(global_rate=0, per_ip_rate=0, per_transfer_rate=0)
+    payload = os.urandom(1024 * 1024)
+    if list(manager.shape("10.0.0.1", [payload])) != [payload]:
+        print("❌ Unlimited transfers should pass chunks through")
+        return False
+    
+    # 1MB at 2MB/s with a 0.5MB burst takes about a quarter of a second
+    manager.configure(per_transfer_rate=2 * 1024 * 1024)
+    started = time.time()
+    if b"".join(manager.shape("10.0.0.1", [payload])) != payload:
+        print("❌ Shaped transfer changed the data")
+        return False
+    elapsed = time.time() - started
+    if not 0.15 < elapsed < 1.0:
+        print(f"❌ Shaped transfer took {elapsed:.2f}s")
+        return False
+    
+    # Shares split per client and across everyone
+    manager.configure(global_rate=3000, per_ip_rate=1000, per_transfer_rate=0)
+    a1, a2, b = manager.open("10.0.0.1"), manager.open("10.0.0.1"), manager.open("10.0.0.2")
+    if (manager.rate_for(a1), manager.rate_for(b)) != (500, 1000):
+        print(f"❌ Unfair shares: {manager.rate_for(a1)}, {manager.rate_for(b)}")
+        return False
+    for transfer in (a1, a2, b):
+        manager.close(transfer)
+    
+    stats = manager.stats()
+    if stats['active_transfers'] != 0 or stats['bytes_sent'] != 2 * len(payload) or stats['throttled_seconds'] <= 0:
+        print(f"❌ Unexpected stats: {stats}")
+        return False
+    try:
+        manager.configure(global_rate=-1)
+        print("❌ Negative limits must be rejected")
+        return False
+    except ValueError:
+        pass
+    
+    print("✅ Downloads are shaped fairly")
+    return True
+
+def test_preview():
+    """Test partial decoding of encrypted files and thumbnail rendering"""
+    print("🔍 Testing previews...")
+    
+    import gzip
+    from cryptography.fernet import Fernet
+    from preview import (ThumbnailWorker, token_prefix_length, decrypt_token_prefix, decode_prefix,
+                         text_snippet, SNIPPET_BYTES)
+    
+    key = Fernet.generate_key()
+    fernet = Fernet(key)
+    text = ("Zeile mit Umlauten äöü und Text. " * 4000).encode()
+    
+    for payload, compressed in [(text, False), (gzip.compress(text, compresslevel=6), True)]:
+        wanted = SNIPPET_BYTES * 2 if compressed else SNIPPET_BYTES
+        token = fernet.encrypt(payload)
+        prefix = token[:token_prefix_length(wanted)]
+        data = decode_prefix(decrypt_token_prefix(key, prefix, wanted), compressed, SNIPPET_BYTES)
+        if data != text[:SNIPPET_BYTES]:
+            print(f"❌ Partial decode is wrong (compressed={compressed})")
+            return False
+    
+    snippet = text_snippet(text[:SNIPPET_BYTES], complete=False)
+    if snippet is None or not text.decode().startswith(snippet) or text_snippet(os.urandom(2000), True) is not None:
+        print("❌ Text detection is wrong")
+        return False
+    
+    worker = ThumbnailWorker(workers=1)
+    if worker.available:
+        import io
+        from PIL import Image
+        image = io.BytesIO()
+        Image.new('RGB', (1200, 800), (200, 30, 30)).save(image, 'PNG')
+        if worker.get("red.png", 1, image.getvalue) is not None:
+            print("❌ First thumbnail request should be pending")
+            return False
+        deadline = time.time() + 10
+        thumbnail = None
+        while thumbnail is None and time.time() < deadline:
+            time.sleep(0.05)
+            thumbnail = worker.get("red.png", 1, image.getvalue)
+        if thumbnail is None or Image.open(io.BytesIO(thumbnail)).size != (256, 171):
+            print("❌ Thumbnail was not rendered")
+            return False
+        worker.get("broken.png", 1, lambda: b"not an image")
+        time.sleep(0.5)
+        try:
+            worker.get("broken.png", 1, lambda: b"not an image")
+            print("❌ Broken images should be reported")
+            return False
+        except ValueError:
+            pass
+    else:
+        print("ℹ️ Pillow not installed, skipping thumbnails")
+    
+    print("✅ Previews decode only what they need")
+    return True
+
+def test_analytics_rollups():
+    """Test analytics rollups, file ID accounting, time-series queries and retention"""
+    print("📊 Testing analytics rollups...")
+    
+    import sqlite3
+    from datetime import datetime, timedelta
+    from analytics_db import AnalyticsDB
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "analytics.db")
+        
+        # A database from before the rollups, with a year old upload
+        old = datetime.now() - timedelta(days=365)
+        conn = sqlite3.connect(db_path)
+        conn.execute('''CREATE TABLE uploads (id INTEGER PRIMARY KEY AUTOINCREMENT, filename TEXT, file_size INTEGER,
+                        file_type TEXT, upload_time TIMESTAMP, ip_address TEXT, compressed_size INTEGER,
+                        download_count INTEGER DEFAULT 0, is_compressed BOOLEAN DEFAULT 0)''')
+        conn.execute("INSERT INTO uploads (filename, file_size, file_type, upload_time, compressed_size, download_count) "
+                     "VALUES ('old.txt', 1000, '.txt', ?, 400, 3)", (old,))
+        conn.commit()
+        conn.close()
+        
+        db = AnalyticsDB(db_path)
+        AnalyticsDB(db_path)  # a second worker must not backfill again
+        db.log_uploads([("id-a", "a.txt", 2000, ".txt", "1.2.3.4", 500, True),
+                        ("id-b", "b.jpg", 5000, ".jpg", "1.2.3.4", 5000, False)])
+        db.increment_download("id-a", "a.txt")
+        
+        # Downloads land on exactly one row, found through the file ID index
+        conn = db.connect()
+        counts = conn.execute("SELECT file_id, download_count FROM uploads ORDER BY id").fetchall()
+        plan = str(conn.execute("EXPLAIN QUERY PLAN UPDATE uploads SET download_count = download_count + 1 "
+                                "WHERE file_id = 'id-a'").fetchall())
+        conn.close()
+        if counts != [(None, 3), ('id-a', 1), ('id-b', 0)] or 'idx_uploads_file_id' not in plan:
+            print(f"❌ Download not counted by file ID: {counts} {plan}")
+            return False
+        
+        stats = db.get_stats()
+        if (stats['total_files'], stats['total_size'], stats['today_uploads']) != (3, 8000, 2):
+            print(f"❌ Unexpected totals: {stats}")
+            return False
+        if stats['popular_types'][0] != ('.txt', 2):
+            print(f"❌ Unexpected popular types: {stats['popular_types']}")
+            return False
+        
+        today = db.query(bucket='hour')['series']
+        if len(today) != 1 or today[0]['uploads'] != 2 or today[0]['downloads'] != 1 or set(today[0]['by_type']) != {'.txt', '.jpg'}:
+            print(f"❌ Unexpected hourly series: {today}")
+            return False
+        history = db.query((old - timedelta(days=1)).isoformat(), None, 'month')['series']
+        if [point['uploads'] for point in history] != [1, 2] or history[0]['downloads'] != 3:
+            print(f"❌ Unexpected monthly series: {history}")
+            return False
+        
+        if db.compact() != 1 or db.get_stats()['total_files'] != 3:
+            print("❌ Compaction should drop old rows but keep their totals")
+            return False
+        
+        for args in [(None, None, 'week'), ('yesterday', None, 'day'), ('2000-01-01', None, 'hour')]:
+            try:
+                db.query(*args)
+                print(f"❌ Query {args} should be rejected")
+                return False
+            except ValueError:
+                pass
+    
+    print("✅ Analytics are rolled up and compacted")
+    return True
+
+def test_app_lifecycle():
+    """Test that importing does no I/O and apps in separate folders run side by side"""
+    print("🏗️ Testing app lifecycle...")
+    
+    import sys
+    import subprocess
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        here = os.path.dirname(os.path.abspath(__file__))
+        subprocess.run([sys.executable, '-c', 'import server'], cwd=tmp, check=True,
+                       env=dict(os.environ, PYTHONPATH=here))
+        if os.listdir(tmp):
+            print(f"❌ Importing server created {os.listdir(tmp)}")
+            return False
+        
+        for name in ('a', 'b'):
+            os.makedirs(os.path.join(tmp, name))
+        with running_app(os.path.join(tmp, 'a')) as (_, base_a), running_app(os.path.join(tmp, 'b')) as (_, base_b):
+            if os.listdir(os.path.join(tmp, 'a')) or os.listdir(os.path.join(tmp, 'b')):
+                print("❌ Creating an app should not touch the disk")
+                return False
+            upload = requests.post(f"{base_a}/upload", files={'file': ('hello.txt', b'hello ' * 500)})
+            download = requests.get(f"{base_a}/download/hello.txt")
+            other = requests.get(f"{base_b}/files").json()
+            if upload.status_code != 200 or download.content != b'hello ' * 500 or other:
+                print("❌ Apps should serve their own files only")
+                return False
+            if sorted(os.listdir(os.path.join(tmp, 'b'))) != ['analytics.db', 'uploads']:
+                print("❌ Resources should be opened on first use only")
+                return False
+    
+    print("✅ Import is side-effect free and apps are isolated")
+    return True
+
+def test_change_feed():
+    """Test file list change events, resuming and trimming"""
+    print("📡 Testing change feed...")
+    
+    import change_feed
+    from change_feed import ChangeFeed, sse_message
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        feed = ChangeFeed(os.path.join(tmp, "events.db"))
+        if feed.latest() != 0 or feed.since(0) != ([], False):
+            print("❌ A new feed should be empty")
+            return False
+        
+        entry = {'name': 'a.txt', 'size': 10}
+        feed.publish_many([('add', 'a.txt', entry), ('add', 'b.txt', None)])
+        feed.publish('delete', 'a.txt')
+        events, reset = feed.since(1)
+        if reset or [(e['seq'], e['type'], e['name']) for e in events] != [(2, 'add', 'b.txt'), (3, 'delete', 'a.txt')]:
+            print(f"❌ Unexpected events after 1: {events}")
+            return False
+        if feed.since(0)[0][0]['file'] != entry or feed.since(7) != ([], True):
+            print("❌ Events should carry their entry and unknown sequences reset")
+            return False
+        if not sse_message(events[0]).startswith(b'id: 2\nevent: add\ndata: {'):
+            print("❌ Unexpected server-sent event frame")
+            return False
+        
+        # A waiting client wakes up as soon as something is published
+        timer = threading.Timer(0.1, feed.publish, ('expire', 'b.txt'))
+        timer.start()
+        started = time.time()
+        events, reset = feed.wait(3, 5)
+        timer.join()
+        if [e['type'] for e in events] != ['expire'] or time.time() - started > 1:
+            print("❌ Waiting client was not woken by the publish")
+            return False
+        
+        # Clients behind the trimmed part of the feed must reload the list
+        original = change_feed.MAX_EVENTS
+        change_feed.MAX_EVENTS = 2
+        try:
+            removed = feed.trim()
+        finally:
+            change_feed.MAX_EVENTS = original
+        if removed != 2 or feed.since(1) != ([], True) or feed.since(2)[1] or feed.latest() != 4:
+            print("❌ Trimming should keep sequence numbers and reset stale clients")
+            return False
+    
+    print("✅ Change feed works")
+    return True
+
+def test_metrics():
+    """Test the metrics registry, exposition format and WSGI middleware"""
+    print("📈 Testing metrics...")
+    
+    import io
+    from metrics import Registry, WSGIMetrics, route_of, stats_families, REGISTRY
+    
+    registry = Registry()
+    requests_total = registry.counter('t_requests_total', 'Requests', ['route'])
+    latency = registry.histogram('t_seconds', 'Latency', buckets=(0.1, 1))
+    requests_total.labels('/files').inc()
+    requests_total.labels('/files').inc(2)
+    for value in (0.05, 0.5, 5):
+        latency.observe(value)
+    text = registry.render(stats_families('t_cache', {'hits': 4, 'entries': 2, 'by_ip': {}}, counters={'hits'})).decode()
+    expected = [
+        '# TYPE t_requests_total counter',
+        't_requests_total{route="/files"} 3',
+        't_seconds_bucket{le="0.1"} 1',
+        't_seconds_bucket{le="1"} 2',
+        't_seconds_bucket{le="+Inf"} 3',
+        't_seconds_count 3',
+        't_cache_hits_total 4',
+        't_cache_entries 2'
+    ]
+    missing = [line for line in expected if line not in text.splitlines()]
+    if missing or 'by_ip' in text:
+        print(f"❌ Unexpected exposition, missing {missing}")
+        return False
+    
+    if [route_of(p) for p in ('/download/a.txt?x=1', '/files', '/../../etc')] != ['/download/<name>', '/files', 'other']:
+        print("❌ Routes should be low cardinality")
+        return False
+    
+    def wsgi_app(environ, start_response):
+        body = environ['wsgi.input'].read()
+        start_response('201 Created', [('Content-Type', 'text/plain')])
+        return [b'got ', body]
+    
+    environ = {'REQUEST_METHOD': 'PUT', 'PATH_INFO': '/upload/a.txt', 'wsgi.input': io.BytesIO(b'hello')}
+    body = WSGIMetrics(wsgi_app)(environ, lambda status, headers, exc_info=None: None)
+    if b''.join(body) != b'got hello':
+        print("❌ Middleware changed the response")
+        return False
+    body.close()
+    text = REGISTRY.render().decode()
+    if 'btransfer_http_requests_total{method="PUT",route="/upload/<name>",status="201"} 1' not in text:
+        print("❌ Middleware did not record the request")
+        return False
+    
+    print("✅ Metrics work")
+    return True
+
+def test_stage_timing():
+    """Test Server-Timing stages of an upload and the admin-only sampling profiler"""
+    print("⏱️ Testing stage timing and profiler...")
+    
+    from profiling import StageTimer, sample_stacks
+    
+    timer = StageTimer()
+    for _ in range(2):
+        with timer.stage('write'):
+            time.sleep(0.01)
+    timer.add('compress', 0.0025)
+    header = timer.header()
+    if not header.startswith('write;dur=') or 'compress;dur=2.5' not in header or 'total;dur=' not in header:
+        print(f"❌ Unexpected Server-Timing value {header}")
+        return False
+    if timer.stages['write'] < 0.02:
+        print("❌ Repeated stages should add up")
+        return False
+    
+    def busy_profiled_function(stop):
+        while not stop.is_set():
+            sum(range(1000))
+    
+    stop = threading.Event()
+    worker = threading.Thread(target=busy_profiled_function, args=(stop,), name='busy worker')
+    worker.start()
+    try:
+        stacks = sample_stacks(0.3, 0.002)
+    finally:
+        stop.set()
+        worker.join()
+    lines = [line for line in stacks.splitlines() if 'busy_profiled_function' in line]
+    if not lines or not lines[0].startswith('busy_worker;') or not lines[0].rsplit(' ', 1)[1].isdigit():
+        print("❌ Profile should hold folded stacks of the busy thread")
+        return False
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        with running_app(tmp) as (app, base):
+            app.admin_token = 'secret'
+            upload = requests.post(f"{base}/upload", files={'file': ('timed.txt', b'timed ' * 2000)})
+            stages = [part.split(';')[0] for part in upload.headers.get('Server-Timing', '').split(', ')]
+            if stages != ['parse', 'compress', 'encrypt', 'write', 'analytics', 'events', 'total']:
+                print(f"❌ Upload stages were {stages}")
+                return False
+            if requests.post(f"{base}/profile?seconds=0.1").status_code != 403:
+                print("❌ Profiling should require the admin token")
+                return False
+            profile = requests.post(f"{base}/profile?seconds=0.2", headers={'X-Admin-Token': 'secret'})
+            if profile.status_code != 200 or 'serve_forever' not in profile.text:
+                print("❌ Admin profile should return the server's stacks")
+                return False
+    
+    print("✅ Stage timing and profiler work")
+    return True
+
+def test_memory_governor():
+    """Test memory reservations, streaming Fernet tokens and spilled transfers"""
+    print("💾 Testing memory governor...")
+    
+    from cryptography.fernet import Fernet, InvalidToken
+    from memory_governor import MemoryGovernor
+    from fernet_stream import encrypt_stream, decrypt_stream
+    
+    governor = MemoryGovernor(budget=1000, wait_seconds=0.05)
+    first = governor.reserve(600)
+    if first is None or governor.reserve(600) is not None or governor.reserve(5000, wait=0) is not None:
+        print("❌ Reservations beyond the budget should be refused after waiting")
+        return False
+    threading.Timer(0.05, first.release).start()
+    second = governor.reserve(600, wait=2)
+    if second is None or governor.stats()['reserved_bytes'] != 600:
+        print("❌ A waiting reservation should get released memory")
+        return False
+    second.release()
+    second.release()
+    if governor.stats()['reserved_bytes'] != 0 or governor.stats()['over_budget'] != 2:
+        print(f"❌ Unexpected governor stats {governor.stats()}")
+        return False
+    
+    key = Fernet.generate_key()
+    data = os.urandom(100003)
+    token = b''.join(encrypt_stream(key, (data[i:i + 4096] for i in range(0, len(data), 4096))))
+    if Fernet(key).decrypt(token) != data:
+        print("❌ Streamed tokens should be regular Fernet tokens")
+        return False
+    library_token = Fernet(key).encrypt(data)
+    if b''.join(decrypt_stream(key, (library_token[i:i + 999] for i in range(0, len(library_token), 999)))) != data:
+        print("❌ Fernet tokens should decrypt chunk by chunk")
+        return False
+    try:
+        b''.join(decrypt_stream(key, [token[:-8] + b'AAAAAAAA']))
+        print("❌ A damaged token should be rejected")
+        return False
+    except InvalidToken:
+        pass
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        with running_app(tmp) as (app, base):
+            app.memory = MemoryGovernor(budget=1024, wait_seconds=0, spill_dir=tmp)
+            text = b'spilled text ' * 20000
+            upload = requests.post(f"{base}/upload", files={'file': ('spill.txt', text)}).json()
+            raw = requests.put(f"{base}/upload/spill.bin", data=iter([data[:50000], data[50000:]])).json()
+            if not upload['was_compressed'] or raw['status'] != 'success':
+                print("❌ Spilled uploads should be stored like in-memory ones")
+                return False
+            if (requests.get(f"{base}/download/spill.txt").content != text
+                    or requests.get(f"{base}/download/spill.bin").content != data):
+                print("❌ Spilled downloads should return the original files")
+                return False
+            stats = requests.get(f"{base}/memory").json()
+            if stats['spills'] != 4 or stats['granted'] != 0 or sorted(os.listdir(tmp)) != ['analytics.db', 'encryption.key', 'uploads']:
+                print(f"❌ Transfers should have spilled to temporary files, got {stats}")
+                return False
+    
+    print("✅ Memory governor and spilling work")
+    return True
+
+def test_delta_upload():
+    """Test rsync-style signatures, deltas and delta uploads of new versions"""
+    print("🔁 Testing delta uploads...")
+    
+    import io
+    import random
+    from delta import make_signature, make_delta, DeltaReader, DeltaError, upload_version
+    from storage import iter_chunks
+    
+    rng = random.Random(7)
+    base = rng.randbytes(300000)
+    versions = [base, b'', base + b'tail', b'head' + base, base[:1000] + b'edit' + base[1004:],
+                base[:50000] + base[60000:], rng.randbytes(1000)]
+    for new in versions:
+        signature = make_signature(iter_chunks(base, 5000), len(base))
+        delta = make_delta(signature, new)
+        for old in (base, io.BytesIO(base)):
+            reader = DeltaReader(iter_chunks(delta, 777))
+            if b''.join(bytes(piece) for piece in reader.apply(old, len(base))) != new:
+                print("❌ Applying a delta should rebuild the new version")
+                return False
+    if len(make_delta(signature, versions[4])) > 20000:
+        print("❌ A small edit should give a small delta")
+        return False
+    try:
+        reader = DeltaReader([delta[:-2]])
+        b''.join(reader.apply(base, len(base)))
+        print("❌ A truncated delta should be rejected")
+        return False
+    except DeltaError:
+        pass
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        with running_app(tmp) as (app, url):
+            text = b''.join(f"line {i} of the report\n".encode() for i in range(50000))
+            requests.put(f"{url}/upload/report.txt", data=text)
+            edited = text.replace(b"line 25000 of", b"line 25000, revised, of")
+            path = os.path.join(tmp, 'report_v2.txt')
+            with open(path, 'wb') as f:
+                f.write(edited)
+            result, sent = upload_version(url, path, 'report.txt')
+            if sent > len(edited) // 10 or result['delta_bytes'] > 20000:
+                print(f"❌ A delta upload should send a fraction of the file, sent {sent} bytes")
+                return False
+            if requests.get(f"{url}/download/report_v2.txt").content != edited:
+                print("❌ The rebuilt version should download like an upload")
+                return False
+            
+            stale = make_delta(make_signature([b'older content'], 13), edited)
+            if requests.put(f"{url}/delta/x.txt?base=report.txt", data=stale).status_code != 409:
+                print("❌ A delta against another version of the base should get 409")
+                return False
+            if requests.put(f"{url}/delta/x.txt?base=report.txt", data=b'not a delta at all, just some bytes').status_code != 400:
+                print("❌ Malformed deltas should get 400")
+                return False
+            if requests.get(f"{url}/signature/missing.txt").status_code != 404:
+                print("❌ Signatures of missing files should get 404")
+                return False
+    
+    print("✅ Delta uploads send only the changes")
+    return True
+
+def test_async_processing():
+    """Test uploads acknowledged once staged and processed in the background"""
+    print("⚙️ Testing asynchronous upload processing...")
+    
+    import io
+    import zipfile
+    from server import create_app
+    
+    def wait_for(check):
+        deadline = time.time() + 10
+        while not check() and time.time() < deadline:
+            time.sleep(0.05)
+        return check()
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        with running_app(tmp) as (app, url):
+            app.processing.enabled = True
+            # Hold jobs back until the staged copy has been checked
+            gate = threading.Event()
+            app.processing.handler = lambda name: gate.wait() and app.files.process_staged(name)
+            text = b''.join(f"row {i}, still being processed\n".encode() for i in range(20000))
+            response = requests.put(f"{url}/upload/notes.txt", data=text)
+            if response.status_code != 200 or response.json().get('processing') != 'queued':
+                print("❌ An async upload should be acknowledged as queued")
+                return False
+            if requests.get(f"{url}/status/notes.txt").json()['state'] not in ('queued', 'processing'):
+                print("❌ The status of a held job should be queued or processing")
+                return False
+            entry = requests.get(f"{url}/files").json()[0]
+            if not entry['processing'] or entry['size'] != len(text):
+                print(f"❌ /files should list a staged file with its size, got {entry}")
+                return False
+            if (requests.get(f"{url}/download/notes.txt").content != text
+                    or requests.head(f"{url}/download/notes.txt").headers['Content-Length'] != str(len(text))):
+                print("❌ A file being processed should download from its staged copy")
+                return False
+            archive = requests.get(f"{url}/download-archive?name=notes.txt").content
+            if zipfile.ZipFile(io.BytesIO(archive)).read('notes.txt') != text:
+                print("❌ Archives should include files being processed")
+                return False
+            if not requests.get(f"{url}/preview/notes.txt").json()['snippet'].startswith('row 0,'):
+                print("❌ Previews should read the staged copy")
+                return False
+            
+            gate.set()
+            if not wait_for(lambda: requests.get(f"{url}/status/notes.txt").json()['state'] == 'done'):
+                print("❌ The job should finish once released")
+                return False
+            entry = requests.get(f"{url}/files").json()[0]
+            if entry['processing'] or not entry['was_compressed'] or os.listdir(app.processing.directory):
+                print(f"❌ A processed file should be compressed and its staged copy gone, got {entry}")
+                return False
+            if requests.get(f"{url}/download/notes.txt").content != text:
+                print("❌ A processed file should download unchanged")
+                return False
+            if app.analytics.get_stats()['total_files'] != 1:
+                print("❌ The job should log the upload in analytics")
+                return False
+            
+            # Jobs that never ran: one left for a restart, one deleted while staged
+            app.processing.handler = lambda name: None
+            requests.put(f"{url}/upload/later.txt", data=text)
+            token = requests.put(f"{url}/upload/gone.txt", data=text).headers['X-Owner-Token']
+            requests.delete(f"{url}/delete/gone.txt", headers={'X-Owner-Token': token})
+            app.files.process_staged('gone.txt')
+            if app.file_store.stat('gone.txt') is not None or app.files.read_metadata('gone.txt'):
+                print("❌ A file deleted while staged should not come back")
+                return False
+        
+        restarted = create_app(**app_paths(tmp)).start()
+        try:
+            if not wait_for(lambda: (restarted.processing.status('later.txt') or {}).get('state') == 'done'):
+                print("❌ Uploads staged before a restart should be processed on start")
+                return False
+            data, size, _ = restarted.files.open_plaintext('later.txt', restarted.files.read_metadata('later.txt'),
+                                                           restarted.file_store.stat('later.txt'))
+            if data != text:
+                print("❌ A file processed after a restart should decode unchanged")
+                return False
+        finally:
+            restarted.stop()
+    
+    print("✅ Async uploads are served while staged and processed in the background")
+    return True
+
+def test_recompression():
+    """Test cold files re-encoded with xz and served unchanged"""
+    print("🧊 Testing cold file recompression...")
+    
+    import io
+    import json
+    import zipfile
+    from datetime import datetime, timedelta
+    from recompression import Recompressor, XZ_MAGIC
+    from fernet_stream import decrypt_stream
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        with running_app(tmp) as (app, url):
+            text = b''.join(f"{i:06d} cold row, rarely read again {i % 97}\n".encode() for i in range(20000))
+            for name in ('cold.txt', 'warm.txt'):
+                requests.put(f"{url}/upload/{name}", data=text)
+                # Uploaded three hours ago
+                metadata = app.files.read_metadata(name)
+                metadata['upload_time'] = (datetime.now() - timedelta(hours=3)).isoformat()
+                app.file_store.put_bytes(f"{name}.meta", json.dumps(metadata).encode())
+            requests.get(f"{url}/download/warm.txt")
+            mtime = app.file_store.stat('cold.txt')['mtime']
+            
+            recompressor = Recompressor(app.file_store, app.key, app.analytics.last_downloads, busy=lambda: False,
+                                        cold_after=3600, cpu_share=1, spill_dir=tmp)
+            if [name for name, _, _ in recompressor.cold_files()] != ['cold.txt']:
+                print("❌ Only files not downloaded for cold_after should be cold")
+                return False
+            if recompressor.run_once() != 1 or recompressor.cold_files():
+                print("❌ The cold file should be recompressed once")
+                return False
+            metadata = app.files.read_metadata('cold.txt')
+            payload = b''.join(decrypt_stream(app.key, app.file_store.get_stream('cold.txt')))
+            if metadata.get('codec') != 'xz' or metadata.get('tier') != 'cold' or not payload.startswith(XZ_MAGIC):
+                print(f"❌ A recompressed file should be stored as xz, got {metadata}")
+                return False
+            if metadata['compressed_size'] >= app.files.read_metadata('warm.txt')['compressed_size']:
+                print("❌ xz should beat the gzip it replaced")
+                return False
+            if abs(app.file_store.stat('cold.txt')['mtime'] - mtime) > 0.001:
+                print("❌ Recompression should keep the modification time the expiry is based on")
+                return False
+            
+            if requests.get(f"{url}/download/cold.txt").content != text:
+                print("❌ A recompressed file should download unchanged")
+                return False
+            archive = requests.get(f"{url}/download-archive?name=cold.txt").content
+            if zipfile.ZipFile(io.BytesIO(archive)).read('cold.txt') != text:
+                print("❌ Archives should decode recompressed files")
+                return False
+            if not requests.get(f"{url}/preview/cold.txt").json()['snippet'].startswith('000000 cold row'):
+                print("❌ Previews should decode recompressed files")
+                return False
+            spilled, size = app.files.decode_to_spill('cold.txt', True)
+            with spilled:
+                if spilled.read() != text or size != len(text):
+                    print("❌ Spilled decodes should handle xz")
+                    return False
+            print(f"✅ Cold file recompressed: {app.files.read_metadata('warm.txt')['compressed_size']} -> "
+                  f"{metadata['compressed_size']} bytes")
+    
+    return True
+
 def test_file_operations():
     """Test basic file operations"""
     print("📁 Testing file operations...")
@@ -102,6 +1340,28 @@ def main():
         test_server_imports,
         test_encryption,
         test_compression,
+        test_adaptive_compression,
+        test_content_cache,
+        test_single_flight,
+        test_reserve_upload_path,
+        test_sharded_layout,
+        test_storage_backends,
+        test_bulk_io,
+        test_zip_stream,
+        test_multipart_stream,
+        test_request_body,
+        test_checksums,
+        test_bandwidth,
+        test_preview,
+        test_analytics_rollups,
+        test_app_lifecycle,
+        test_change_feed,
+        test_metrics,
+        test_stage_timing,
+        test_memory_governor,
+        test_delta_upload,
+        test_async_processing,
+        test_recompression,
         test_file_operations
     ]
     
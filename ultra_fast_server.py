@@ -6,17 +6,17 @@ Ultra-fast file transfer server - Simple and fast
 import os
 import time
 import threading
-from flask import Flask, request, jsonify, send_file, render_template_string
+from flask import Flask, Response, request, jsonify, render_template_string
 from werkzeug.utils import secure_filename
 import socket
+from storage import create_storage, parse_range, StorageError
 
 app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 10 * 1024 * 1024 * 1024  # 10GB limit
 
-# Setup upload directory
+# Setup file storage, local upload directory unless STORAGE_BACKEND says otherwise
 UPLOAD_FOLDER = 'uploads'
-if not os.path.exists(UPLOAD_FOLDER):
-    os.makedirs(UPLOAD_FOLDER)
+file_store = create_storage(UPLOAD_FOLDER)
 
 def get_file_size(size_bytes):
     if size_bytes == 0:
@@ -33,13 +33,11 @@ def cleanup_old_files():
     while True:
         try:
             now = time.time()
-            for filename in os.listdir(UPLOAD_FOLDER):
-                filepath = os.path.join(UPLOAD_FOLDER, filename)
-                if os.path.isfile(filepath):
-                    file_age = now - os.path.getctime(filepath)
-                    if file_age > 86400:  # 24 hours
-                        os.remove(filepath)
-                        print(f"🗑️ Auto-deleted: {filename}")
+            for filename, info in list(file_store.list()):
+                file_age = now - info['mtime']
+                if file_age > 86400:  # 24 hours
+                    file_store.delete(filename)
+                    print(f"🗑️ Auto-deleted: {filename}")
         except Exception as e:
             print(f"⚠️ Cleaner error: {e}")
         time.sleep(3600)  # Check every hour
@@ -54,6 +52,9 @@ def index():
 @app.route('/upload', methods=['POST'])
 def upload_file():
     try:
+        # Refuse before receiving anything the disk cannot hold
+        file_store.ensure_space(request.content_length or 0)
+        
         if 'file' not in request.files:
             return jsonify({'error': 'No file part'}), 400
         
@@ -67,19 +68,47 @@ def upload_file():
             return jsonify({'error': 'Invalid filename'}), 400
         
         # Handle duplicate filenames
-        counter = 1
-        original_filename = filename
-        while os.path.exists(os.path.join(UPLOAD_FOLDER, filename)):
-            name, ext = os.path.splitext(original_filename)
-            filename = f"{name}_{counter}{ext}"
-            counter += 1
+        filename = file_store.reserve(filename)
+        
+        # Stream file directly - no processing, no encryption, no compression
+        chunks = iter(lambda: file.stream.read(1024 * 1024), b'')
+        file_size = file_store.put_stream(filename, chunks)
+        print(f"✅ File uploaded: {filename} ({get_file_size(file_size)})")
+        
+        return jsonify({
+            'status': 'success',
+            'filename': filename,
+            'size': file_size
+        }), 200
+        
+    except StorageError as e:
+        print(f"❌ Upload error: {str(e)}")
+        if 'chunks' in locals():
+            file_store.delete(filename)
+        return jsonify({'error': str(e)}), e.status or 500
+    except Exception as e:
+        print(f"❌ Upload error: {str(e)}")
+        if 'chunks' in locals():
+            file_store.delete(filename)
+        return jsonify({'error': f'Upload failed: {str(e)}'}), 500
+
+@app.route('/upload/<filename>', methods=['PUT'])
+def upload_raw(filename):
+    try:
+        # Secure filename
+        filename = secure_filename(filename)
+        if not filename:
+            return jsonify({'error': 'Invalid filename'}), 400
         
-        filepath = os.path.join(UPLOAD_FOLDER, filename)
+        # Refuse before receiving anything the disk cannot hold
+        file_store.ensure_space(request.content_length or 0)
         
-        # Save file directly - no processing, no encryption, no compression
-        file.save(filepath)
+        # Handle duplicate filenames
+        filename = file_store.reserve(filename)
         
-        file_size = os.path.getsize(filepath)
+        # The request body is the file, stream it straight to storage
+        chunks = iter(lambda: request.stream.read(1024 * 1024), b'')
+        file_size = file_store.put_stream(filename, chunks, request.content_length)
         print(f"✅ File uploaded: {filename} ({get_file_size(file_size)})")
         
         return jsonify({
@@ -88,21 +117,26 @@ def upload_file():
             'size': file_size
         }), 200
         
+    except StorageError as e:
+        print(f"❌ Upload error: {str(e)}")
+        if 'chunks' in locals():
+            file_store.delete(filename)
+        return jsonify({'error': str(e)}), e.status or 500
     except Exception as e:
         print(f"❌ Upload error: {str(e)}")
+        if 'chunks' in locals():
+            file_store.delete(filename)
         return jsonify({'error': f'Upload failed: {str(e)}'}), 500
 
 @app.route('/files')
 def list_files():
     try:
         files = []
-        for filename in os.listdir(UPLOAD_FOLDER):
-            filepath = os.path.join(UPLOAD_FOLDER, filename)
-            if os.path.isfile(filepath):
-                files.append({
-                    'name': filename,
-                    'size': os.path.getsize(filepath)
-                })
+        for filename, info in file_store.list():
+            files.append({
+                'name': filename,
+                'size': info['size']
+            })
         
         files.sort(key=lambda x: x['name'])
         return jsonify(files)
@@ -114,12 +148,30 @@ def list_files():
 @app.route('/download/<filename>')
 def download_file(filename):
     try:
-        filepath = os.path.join(UPLOAD_FOLDER, filename)
-        if not os.path.exists(filepath) or not os.path.isfile(filepath):
+        info = file_store.stat(filename)
+        if info is None:
             return jsonify({'error': 'File not found'}), 404
         
+        headers = {
+            'Content-Disposition': f'attachment; filename="{filename}"',
+            'Accept-Ranges': 'bytes'
+        }
+        
+        # Resume / partial downloads use ranged reads from the backend
+        byte_range = parse_range(request.headers.get('Range'), info['size'])
+        if byte_range is False:
+            headers['Content-Range'] = f"bytes */{info['size']}"
+            return Response(status=416, headers=headers)
+        if byte_range:
+            start, length = byte_range
+            headers['Content-Range'] = f"bytes {start}-{start + length - 1}/{info['size']}"
+            headers['Content-Length'] = str(length)
+            return Response(file_store.get_stream(filename, start, length), status=206,
+                            mimetype='application/octet-stream', headers=headers)
+        
         print(f"📥 File downloaded: {filename}")
-        return send_file(filepath, as_attachment=True, download_name=filename)
+        headers['Content-Length'] = str(info['size'])
+        return Response(file_store.get_stream(filename), mimetype='application/octet-stream', headers=headers)
         
     except Exception as e:
         print(f"❌ Download error: {str(e)}")
@@ -128,11 +180,9 @@ def download_file(filename):
 @app.route('/delete/<filename>', methods=['DELETE'])
 def delete_file(filename):
     try:
-        filepath = os.path.join(UPLOAD_FOLDER, filename)
-        if not os.path.exists(filepath) or not os.path.isfile(filepath):
+        if not file_store.delete(filename):
             return jsonify({'error': 'File not found'}), 404
         
-        os.remove(filepath)
         print(f"🗑️ File deleted: {filename}")
         return jsonify({'status': 'success', 'message': 'File deleted successfully'})
         
@@ -143,13 +193,14 @@ def delete_file(filename):
 @app.route('/health')
 def health_check():
     try:
-        uploads_ok = os.path.exists(UPLOAD_FOLDER)
+        uploads_ok = file_store.check()
         
         health_status = {
             'status': 'healthy' if uploads_ok else 'unhealthy',
             'timestamp': time.strftime('%Y-%m-%d %H:%M:%S'),
             'version': '1.0.0',
             'service': 'Ultra-Fast File Transfer',
+            'storage_backend': file_store.name,
             'checks': {
                 'uploads_directory': uploads_ok
             }
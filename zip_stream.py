@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Streaming ZIP64 writer for multi-file downloads
+
+Members are written one after the other with a data descriptor after each, so
+the archive never needs seeking, temp files or knowing sizes up front. Every
+member carries ZIP64 fields, archives and members may exceed 4GB.
+"""
+
+import time
+import zlib
+import struct
+
+ZIP64_VERSION = 45
+FLAG_DATA_DESCRIPTOR = 0x0008
+FLAG_UTF8 = 0x0800
+METHOD_STORED = 0
+METHOD_DEFLATED = 8
+
+def dos_datetime(timestamp):
+    """Convert a unix timestamp to DOS (time, date) fields"""
+    t = time.localtime(timestamp)
+    year = max(t.tm_year, 1980)
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), ((year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+def gzip_deflate_body(data):
+    """Split a single-member gzip payload into (raw deflate data, crc32, size).
+
+    ZIP's deflate method uses the same raw stream as gzip, so compressed
+    payloads can be copied into an archive without recompressing. Returns None
+    when the payload is not a gzip stream we can pass through.
+    """
+    if len(data) < 18 or data[0:3] != b'\x1f\x8b\x08':
+        return None
+    flags = data[3]
+    pos = 10
+    if flags & 0x04:  # FEXTRA
+        pos += 2 + struct.unpack('<H', data[pos:pos + 2])[0]
+    if flags & 0x08:  # FNAME
+        pos = data.index(b'\x00', pos) + 1
+    if flags & 0x10:  # FCOMMENT
+        pos = data.index(b'\x00', pos) + 1
+    if flags & 0x02:  # FHCRC
+        pos += 2
+    crc, size = struct.unpack('<II', data[-8:])
+    return memoryview(data)[pos:-8], crc, size
+
+class ZipStreamWriter:
+    """Produce a ZIP64 archive as a sequence of byte strings"""
+
+    def __init__(self):
+        self.offset = 0
+        self.entries = []
+
+    def _local_header(self, name, method, modified):
+        encoded = name.encode('utf-8')
+        mod_time, mod_date = dos_datetime(modified)
+        # Sizes are unknown yet: ZIP64 placeholders, real values follow in the data descriptor
+        extra = struct.pack('<HHQQ', 0x0001, 16, 0, 0)
+        header = struct.pack(
+            '<IHHHHHIIIHH', 0x04034b50, ZIP64_VERSION, FLAG_DATA_DESCRIPTOR | FLAG_UTF8, method,
+            mod_time, mod_date, 0, 0xFFFFFFFF, 0xFFFFFFFF, len(encoded), len(extra)
+        )
+        return header + encoded + extra
+
+    def _member(self, name, method, modified, body, crc=None, size=None):
+        """Yield header, body pieces and data descriptor for one member"""
+        header_offset = self.offset
+        header = self._local_header(name, method, modified)
+        self.offset += len(header)
+        yield header
+
+        compressed_size = 0
+        uncompressed_size = 0
+        running_crc = 0
+        for piece, raw in body:
+            if piece:
+                compressed_size += len(piece)
+                self.offset += len(piece)
+                yield piece
+            if raw is not None:
+                uncompressed_size += len(raw)
+                running_crc = zlib.crc32(raw, running_crc)
+        if crc is None:
+            crc = running_crc
+            size = uncompressed_size
+
+        descriptor = struct.pack('<IIQQ', 0x08074b50, crc, compressed_size, size)
+        self.offset += len(descriptor)
+        yield descriptor
+        self.entries.append((name, method, modified, crc, compressed_size, size, header_offset))
+
+    def add(self, name, chunks, compress=False, modified=None):
+        """Yield a member from raw content chunks, deflating on the fly if asked"""
+        modified = modified or time.time()
+        if not compress:
+            body = ((chunk, chunk) for chunk in chunks)
+            return self._member(name, METHOD_STORED, modified, body)
+
+        def deflated():
+            compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+            for chunk in chunks:
+                yield compressor.compress(chunk), chunk
+            yield compressor.flush(), None
+        return self._member(name, METHOD_DEFLATED, modified, deflated())
+
+    def add_deflated(self, name, deflate_chunks, crc, size, modified=None):
+        """Yield a member from an already deflated stream with known crc and size"""
+        modified = modified or time.time()
+        body = ((chunk, None) for chunk in deflate_chunks)
+        return self._member(name, METHOD_DEFLATED, modified, body, crc=crc, size=size & 0xFFFFFFFFFFFFFFFF)
+
+    def finish(self):
+        """Yield the central directory and end records"""
+        cd_offset = self.offset
+        cd_size = 0
+        for name, method, modified, crc, compressed_size, size, header_offset in self.entries:
+            encoded = name.encode('utf-8')
+            mod_time, mod_date = dos_datetime(modified)
+            extra = struct.pack('<HHQQQ', 0x0001, 24, size, compressed_size, header_offset)
+            record = struct.pack(
+                '<IHHHHHHIIIHHHHHII', 0x02014b50, (3 << 8) | ZIP64_VERSION, ZIP64_VERSION,
+                FLAG_DATA_DESCRIPTOR | FLAG_UTF8, method, mod_time, mod_date, crc,
+                0xFFFFFFFF, 0xFFFFFFFF, len(encoded), len(extra), 0, 0, 0, 0o100644 << 16, 0xFFFFFFFF
+            ) + encoded + extra
+            cd_size += len(record)
+            yield record
+
+        count = len(self.entries)
+        zip64_end_offset = cd_offset + cd_size
+        yield struct.pack(
+            '<IQHHIIQQQQ', 0x06064b50, 44, (3 << 8) | ZIP64_VERSION, ZIP64_VERSION,
+            0, 0, count, count, cd_size, cd_offset
+        )
+        yield struct.pack('<IIQI', 0x07064b50, 0, zip64_end_offset, 1)
+        yield struct.pack(
+            '<IHHHHIIH', 0x06054b50, 0, 0, min(count, 0xFFFF), min(count, 0xFFFF),
+            min(cd_size, 0xFFFFFFFF), 0xFFFFFFFF, 0
+        )